@@ -0,0 +1,91 @@
+"""HTTP client for the FinSolve FastAPI backend, used by the Streamlit UI.
+
+One pooled ``requests.Session`` serves every user of the UI process.
+Credentials are passed per call, so the session holds no user state, and
+cookies are refused so nothing set for one user is replayed for another.
+"""
+import os
+from http.cookiejar import DefaultCookiePolicy
+
+import requests
+from requests.adapters import HTTPAdapter
+from requests.auth import HTTPBasicAuth
+from urllib3.util.retry import Retry
+
+# (connect, read) timeouts in seconds. For streamed answers the read timeout
+# bounds the wait for each chunk, not the whole answer.
+CONNECT_TIMEOUT = float(os.getenv("FINSOLVE_CONNECT_TIMEOUT", "3.05"))
+READ_TIMEOUT = float(os.getenv("FINSOLVE_READ_TIMEOUT", "60"))
+UPLOAD_TIMEOUT = float(os.getenv("FINSOLVE_UPLOAD_TIMEOUT", "300"))
+POOL_SIZE = int(os.getenv("FINSOLVE_POOL_SIZE", "32"))
+RETRIES = int(os.getenv("FINSOLVE_RETRIES", "3"))
+
+
+class FinSolveClient:
+    def __init__(self, base_url, pool_size=POOL_SIZE, retries=RETRIES):
+        self.base_url = base_url.rstrip("/")
+        self.session = requests.Session()
+        self.session.cookies.set_policy(DefaultCookiePolicy(allowed_domains=[]))
+        # GETs are retried on connection errors and gateway failures. Other
+        # methods only when the connection was never made, since a chat or
+        # upload may already have run on the server.
+        retry = Retry(
+            total=retries,
+            connect=retries,
+            read=retries,
+            status=retries,
+            backoff_factor=0.3,
+            status_forcelist=(502, 503, 504),
+            allowed_methods=frozenset({"GET", "HEAD"}),
+            raise_on_status=False,
+        )
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=pool_size, max_retries=retry)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+
+    def _request(self, method, path, auth, timeout=None, **kwargs):
+        return self.session.request(
+            method,
+            f"{self.base_url}{path}",
+            auth=HTTPBasicAuth(*auth),
+            timeout=(CONNECT_TIMEOUT, timeout or READ_TIMEOUT),
+            **kwargs,
+        )
+
+    def login(self, username, password):
+        return self._request("GET", "/login", (username, password))
+
+    def roles(self, auth):
+        res = self._request("GET", "/roles", auth)
+        res.raise_for_status()
+        return res.json().get("roles", [])
+
+    def chat(self, question, role, auth, stream=True):
+        payload = {"question": question, "role": role}
+        if stream:
+            res = self._request("POST", "/chat/stream", auth, json=payload, stream=True)
+            if res.status_code != 404:
+                return res
+            # Backend without the streaming endpoint: fall back to the full answer
+            res.close()
+        return self._request("POST", "/chat", auth, json=payload)
+
+    def upload(self, file, role, auth):
+        return self._request("POST", "/upload-docs", auth, timeout=UPLOAD_TIMEOUT,
+                             files={"file": file}, data={"role": role})
+
+    def upload_job(self, job_id, auth):
+        # Ingestion status of an upload: pending/loading/embedding/done/failed
+        res = self._request("GET", f"/upload-jobs/{job_id}", auth)
+        res.raise_for_status()
+        return res.json()
+
+    def create_user(self, username, password, role, auth):
+        return self._request("POST", "/create-user", auth,
+                             data={"username": username, "password": password, "role": role})
+
+    def create_role(self, role_name, auth):
+        return self._request("POST", "/create-role", auth, data={"role_name": role_name})
+
+    def close(self):
+        self.session.close()
@@ -0,0 +1,86 @@
+"""Deterministic stand-ins for the OpenAI embedding and chat models.
+
+They let the indexer and the RAG chain run offline with reproducible
+results. Latency can be simulated so that concurrency and batching
+behave roughly like they do against the real API.
+"""
+import hashlib
+import re
+import time
+from typing import Any, List, Optional
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+from langchain_core.language_models.chat_models import BaseChatModel
+from langchain_core.messages import AIMessage
+from langchain_core.outputs import ChatGeneration, ChatResult
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def _bucket(feature: str, dim: int) -> int:
+    return int.from_bytes(hashlib.blake2b(feature.encode(), digest_size=8).digest(), "little") % dim
+
+
+class FakeEmbeddings(Embeddings):
+    """Hashed bag of words and bigrams, L2-normalised.
+
+    Texts that share vocabulary end up close, so retrieval quality stays
+    meaningful. ``latency_ms`` is charged once per call plus
+    ``per_text_ms`` per input.
+    """
+
+    def __init__(self, dim: int = 256, latency_ms: float = 0.0, per_text_ms: float = 0.0):
+        self.dim = dim
+        self.latency_ms = latency_ms
+        self.per_text_ms = per_text_ms
+        self.calls = 0
+        self.texts = 0
+
+    def _vector(self, text: str):
+        vector = np.zeros(self.dim, dtype=np.float32)
+        tokens = TOKEN_RE.findall(text.lower())
+        for feature in tokens + [f"{a} {b}" for a, b in zip(tokens, tokens[1:])]:
+            vector[_bucket(feature, self.dim)] += 1.0
+        norm = np.linalg.norm(vector)
+        return (vector / norm if norm else vector).tolist()
+
+    def _charge(self, count: int):
+        self.calls += 1
+        self.texts += count
+        delay = self.latency_ms + self.per_text_ms * count
+        if delay:
+            time.sleep(delay / 1000)
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        self._charge(len(texts))
+        return [self._vector(t) for t in texts]
+
+    def embed_query(self, text: str) -> List[float]:
+        self._charge(1)
+        return self._vector(text)
+
+
+class FakeChatModel(BaseChatModel):
+    """Answers with a fixed template over the prompt it was given.
+
+    The reply lists the sources named in the context. The prompt length is
+    reported as token usage, and ``latency_ms`` simulates generation time.
+    """
+
+    latency_ms: float = 0.0
+
+    @property
+    def _llm_type(self) -> str:
+        return "fake-chat"
+
+    def _generate(self, messages, stop: Optional[List[str]] = None, run_manager: Any = None, **kwargs):
+        if self.latency_ms:
+            time.sleep(self.latency_ms / 1000)
+        prompt = "\n".join(str(m.content) for m in messages)
+        sources = sorted(set(re.findall(r"\[Source: ([^\]|]+)", prompt)))
+        answer = f"## Answer\n- Based on {len(sources)} sources\n\n**Source**: {', '.join(sources) or 'none'}"
+        usage = {"input_tokens": len(prompt) // 4, "output_tokens": len(answer) // 4,
+                 "total_tokens": (len(prompt) + len(answer)) // 4}
+        message = AIMessage(content=answer, usage_metadata=usage)
+        return ChatResult(generations=[ChatGeneration(message=message)])
@@ -0,0 +1,286 @@
+"""Offline benchmark for indexing and question answering.
+
+The OpenAI embedding and chat models are swapped for the deterministic
+stand-ins in ``benchmarks.fakes``, so runs need no keys or network and can
+be compared between versions. The harness indexes ``resources/data/**``
+into a scratch directory, optionally replicated ``--scale`` times. It then
+replays a question workload and reports JSON with:
+
+- indexing throughput (files/sec and chunks/sec) and the time of a no-op
+  re-index
+- classification, retrieval and end-to-end ``ask_rag`` latency, as
+  p50/p95/p99 in milliseconds
+- context tokens per question after packing, against the old fixed
+  top-4 context
+- embedding call counts
+- peak RSS
+
+Usage (from the ``app`` directory):
+
+    python -m benchmarks.rag_benchmark --scale 10 --rounds 3 --output bench.json
+    python -m benchmarks.rag_benchmark --embed-latency-ms 40 --llm-latency-ms 400 --concurrency 8
+
+``--workload`` takes a JSON-lines file of ``{"role": ..., "question": ...}``.
+"""
+import argparse
+import asyncio
+import contextlib
+import json
+import os
+import platform
+import resource
+import shutil
+import sqlite3
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+APP_DIR = Path(__file__).resolve().parents[1]
+DATA_DIR = APP_DIR.parent / "resources" / "data"
+
+DEFAULT_WORKLOAD = [
+    ("finance", "What was the gross margin in Q3 2024?"),
+    ("finance", "Summarize the cash flow analysis for the second quarter."),
+    ("marketing", "Give me the campaign highlights from the Q4 marketing report."),
+    ("marketing", "How did customer acquisition cost change across 2024?"),
+    ("hr", "What is the leave balance of FINEMP1006?"),
+    ("hr", "List employees in the Finance department with a performance rating of 5."),
+    ("engineering", "Describe the microservices architecture and its deployment pipeline."),
+    ("engineering", "Which security controls are applied to the API gateway?"),
+    ("general", "What is the work from home policy?"),
+    ("general", "How many days of annual leave do employees get?"),
+    ("c-level", "Compare marketing spend with quarterly revenue growth."),
+    ("c-level", "Which risks were highlighted in the financial summary?"),
+]
+
+
+def prepare_corpus(source: Path, target: Path, scale: int):
+    """Copy the corpus ``scale`` times; replicas get distinct paths and a marker line."""
+    files = []
+    for path in sorted(source.glob("*/*")):
+        if path.suffix.lower() not in (".md", ".csv"):
+            continue
+        role = path.parent.name
+        (target / role).mkdir(parents=True, exist_ok=True)
+        for copy in range(scale):
+            name = path.name if copy == 0 else f"{path.stem}_replica{copy}{path.suffix}"
+            dest = target / role / name
+            if copy == 0 or path.suffix.lower() == ".csv":
+                shutil.copyfile(path, dest)
+            else:
+                dest.write_text(f"{path.read_text(encoding='utf-8')}\n\nReplica {copy} of {path.name}.\n",
+                                encoding="utf-8")
+            files.append((str(dest), role))
+    return files
+
+
+def register_documents(db_path: str, files):
+    # The same table the upload endpoint fills
+    conn = sqlite3.connect(db_path)
+    conn.execute("""
+        CREATE TABLE IF NOT EXISTS documents (
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            filepath TEXT NOT NULL,
+            role TEXT NOT NULL,
+            embedded INTEGER DEFAULT 0
+        )
+    """)
+    conn.executemany("INSERT INTO documents (filepath, role) VALUES (?, ?)", files)
+    conn.commit()
+    conn.close()
+
+
+def load_workload(path):
+    if not path:
+        return list(DEFAULT_WORKLOAD)
+    with open(path, encoding="utf-8") as f:
+        return [(row["role"], row["question"]) for row in map(json.loads, f) if row]
+
+
+def percentiles(samples_ms):
+    if not samples_ms:
+        return None
+    ordered = sorted(samples_ms)
+
+    def rank(p):
+        # Nearest-rank percentile
+        return round(ordered[max(0, min(len(ordered) - 1, int(-(-p * len(ordered) // 100)) - 1))], 2)
+
+    return {"count": len(ordered), "mean": round(sum(ordered) / len(ordered), 2),
+            "p50": rank(50), "p95": rank(95), "p99": rank(99), "max": round(ordered[-1], 2)}
+
+
+def peak_rss_mb():
+    # ru_maxrss is kilobytes on Linux and bytes on macOS
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return round(peak / (1024 * 1024 if sys.platform == "darwin" else 1024), 1)
+
+
+def timed(fn, *args):
+    started = time.perf_counter()
+    result = fn(*args)
+    return result, (time.perf_counter() - started) * 1000
+
+
+async def replay_end_to_end(rag_chain, questions, concurrency):
+    gate = asyncio.Semaphore(concurrency)
+    samples, errors = [], []
+
+    async def one(role, question):
+        async with gate:
+            started = time.perf_counter()
+            try:
+                await rag_chain.ask_rag(question, role)
+            except Exception as e:
+                errors.append(f"{role}: {question}: {e}")
+                return
+            samples.append((time.perf_counter() - started) * 1000)
+
+    started = time.perf_counter()
+    await asyncio.gather(*(one(role, q) for role, q in questions))
+    return samples, errors, time.perf_counter() - started
+
+
+def run(args):
+    from benchmarks.fakes import FakeChatModel, FakeEmbeddings
+    from rag_utils import metrics, rag_chain, rag_module
+    from rag_utils.answer_cache import answer_cache
+    from rag_utils.query_classifier import detect_query_type
+
+    embeddings = FakeEmbeddings(dim=args.dim, latency_ms=args.embed_latency_ms,
+                                per_text_ms=args.embed_per_text_ms)
+    rag_module.override_components(environment=True, embeddings=embeddings,
+                                   model=FakeChatModel(latency_ms=args.llm_latency_ms),
+                                   summary_model=FakeChatModel(latency_ms=args.llm_latency_ms))
+    if not args.answer_cache:
+        answer_cache.clear()
+        answer_cache.max_entries = 0
+        answer_cache.semantic_threshold = 0
+
+    files = prepare_corpus(Path(args.data), Path("data"), args.scale)
+    register_documents("roles_docs.db", files)
+
+    _, index_ms = timed(rag_module.run_indexer)
+    chunks = rag_module.vector_count()
+    index_calls = embeddings.calls
+    conn = sqlite3.connect("roles_docs.db")
+    conn.execute("UPDATE documents SET embedded = 0")
+    conn.commit()
+    conn.close()
+    _, reindex_ms = timed(rag_module.run_indexer)
+    rss_after_index = peak_rss_mb()
+
+    workload = load_workload(args.workload) * args.rounds
+    # Build retrievers, chains and the lexical index outside the timed loop
+    rag_module.prewarm_rag_chains(sorted({role for role, _ in workload}))
+
+    classify, retrieval = [], []
+    for role, question in workload:
+        classify.append(timed(detect_query_type, question)[1])
+        retriever = rag_module.get_retriever(role)
+        retrieval.append(timed(lambda q: rag_module.pack_retrieved_context(retriever.invoke(q)), question)[1])
+    context = context_tokens(rag_module, sorted(set(workload)))
+
+    calls_before = embeddings.calls
+    e2e, errors, wall_s = asyncio.run(replay_end_to_end(rag_chain, workload, args.concurrency))
+
+    return {
+        "config": {
+            "scale": args.scale, "rounds": args.rounds, "questions": len(workload),
+            "concurrency": args.concurrency, "embed_latency_ms": args.embed_latency_ms,
+            "embed_per_text_ms": args.embed_per_text_ms, "llm_latency_ms": args.llm_latency_ms,
+            "answer_cache": args.answer_cache, "python": platform.python_version(),
+            "env": {k: v for k, v in sorted(os.environ.items()) if k.startswith(("RAG_", "ROUTER_"))},
+        },
+        "indexing": {
+            "files": len(files), "chunks": chunks,
+            "seconds": round(index_ms / 1000, 3),
+            "files_per_sec": round(len(files) / (index_ms / 1000), 2),
+            "chunks_per_sec": round(chunks / (index_ms / 1000), 2),
+            "embedding_calls": index_calls,
+            "noop_reindex_seconds": round(reindex_ms / 1000, 3),
+            "peak_rss_mb": rss_after_index,
+        },
+        "latency_ms": {
+            "classification": percentiles(classify),
+            "retrieval": percentiles(retrieval),
+            "end_to_end": percentiles(e2e),
+        },
+        "context_tokens": context,
+        "throughput": {"questions_per_sec": round(len(e2e) / wall_s, 2) if wall_s else None,
+                       "query_embedding_calls": embeddings.calls - calls_before,
+                       "errors": errors[:20], "error_count": len(errors)},
+        "stages": metrics.stage_summary(),
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def context_tokens(rag_module, workload):
+    from rag_utils.context_packing import BASELINE_K, pack_context
+
+    baseline, packed = [], []
+    for role, question in workload:
+        _, stats = pack_context(rag_module.get_retriever(role).invoke(question))
+        baseline.append(stats["tokens_baseline"])
+        packed.append(stats["tokens_out"])
+    return {
+        "baseline_k": BASELINE_K,
+        "baseline_mean": round(sum(baseline) / len(baseline), 1),
+        "packed_mean": round(sum(packed) / len(packed), 1),
+        "saved_pct": round(100 * (1 - sum(packed) / sum(baseline)), 1) if sum(baseline) else None,
+        "questions_over_baseline": sum(p > b for p, b in zip(packed, baseline)),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--data", default=str(DATA_DIR), help="corpus root with one folder per role")
+    parser.add_argument("--scale", type=int, default=1, help="replicate the corpus N times (e.g. 10-1000)")
+    parser.add_argument("--workload", help="JSON-lines file of {role, question}")
+    parser.add_argument("--rounds", type=int, default=3, help="times the workload is replayed")
+    parser.add_argument("--concurrency", type=int, default=4, help="concurrent ask_rag calls")
+    parser.add_argument("--dim", type=int, default=256, help="fake embedding dimension")
+    parser.add_argument("--embed-latency-ms", type=float, default=0.0)
+    parser.add_argument("--embed-per-text-ms", type=float, default=0.0)
+    parser.add_argument("--llm-latency-ms", type=float, default=0.0)
+    parser.add_argument("--answer-cache", action="store_true", help="keep the answer cache enabled")
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    parser.add_argument("--keep", action="store_true", help="keep the scratch directory")
+    args = parser.parse_args()
+
+    sys.path.insert(0, str(APP_DIR))
+    args.data = str(Path(args.data).resolve())
+    if args.workload:
+        args.workload = str(Path(args.workload).resolve())
+    output = Path(args.output).resolve() if args.output else None
+    # Keep the embedding cache, the router's LLM fallback and remote tracing
+    # out of the measurements
+    os.environ.setdefault("RAG_EMBEDDING_CACHE_DIR", "")
+    os.environ.setdefault("ROUTER_LLM_FALLBACK", "false")
+    os.environ["LANGCHAIN_TRACING_V2"] = "false"
+
+    # Chroma, SQLite and the Parquet tables all live relative to the working directory
+    workdir = tempfile.mkdtemp(prefix="rag-bench-")
+    cwd = os.getcwd()
+    try:
+        os.chdir(workdir)
+        # Progress prints from the indexer and retrievers go to stderr
+        with contextlib.redirect_stdout(sys.stderr):
+            report = run(args)
+    finally:
+        os.chdir(cwd)
+        if args.keep:
+            print(f"Scratch directory kept at {workdir}", file=sys.stderr)
+        else:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2)
+    if output:
+        output.write_text(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
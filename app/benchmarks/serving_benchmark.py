@@ -0,0 +1,213 @@
+"""Multi-process serving from shared index snapshots.
+
+Starts 1, 2, 4, ... worker processes that search the current snapshot in a
+loop, as uvicorn workers would in ``RAG_VECTOR_BACKEND=snapshot`` mode.
+Halfway through, the parent adds chunks to the live store and publishes a
+new version. Per worker count, the JSON report gives:
+
+- RSS and PSS per worker in MB. PSS splits shared pages between the
+  processes mapping them, so it shows whether the index is held once.
+- search latency (p50/p95/p99 ms) and the number of failed searches
+- the versions each worker served, and how long after publishing it
+  switched
+
+``--compare-chroma`` runs the same loop with every worker opening its own
+persistent Chroma client, for reference. No keys or network are needed.
+
+Usage (from the ``app`` directory):
+
+    python -m benchmarks.serving_benchmark --rows 100000 --dim 1536 --workers 1 2 4 8
+"""
+import argparse
+import contextlib
+import json
+import multiprocessing
+import shutil
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from benchmarks.rag_benchmark import percentiles
+from benchmarks.vector_backend_benchmark import make_queries, synthetic_corpus
+
+
+def memory_mb():
+    # RSS and PSS of this process from /proc (Linux); PSS is None elsewhere
+    values = {}
+    try:
+        with open("/proc/self/smaps_rollup") as f:
+            for line in f:
+                key, _, rest = line.partition(":")
+                if key in ("Rss", "Pss"):
+                    values[key] = round(int(rest.split()[0]) / 1024, 1)
+    except OSError:
+        import resource
+
+        values["Rss"] = round(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, 1)
+    return values.get("Rss"), values.get("Pss")
+
+
+def snapshot_worker(root, queries, roles, k, duration, poll_seconds, results):
+    from rag_utils.snapshots import SnapshotManager
+
+    sys.stdout = sys.stderr  # keep the report on stdout clean
+    manager = SnapshotManager(root, poll_seconds=poll_seconds).start()
+    samples, errors, seen = [], 0, {}
+    deadline = time.time() + duration
+    i = 0
+    while time.time() < deadline:
+        store = manager.current()
+        started = time.perf_counter()
+        try:
+            store.search(queries[i % len(queries)], roles, k)
+        except Exception:
+            errors += 1
+        samples.append((time.perf_counter() - started) * 1000)
+        seen.setdefault(manager.version, time.time())
+        i += 1
+    rss, pss = memory_mb()
+    manager.stop()
+    results.put({"samples": samples, "errors": errors, "seen": seen, "rss_mb": rss, "pss_mb": pss})
+
+
+def chroma_worker(path, queries, roles, k, duration, results):
+    import chromadb
+
+    collection = chromadb.PersistentClient(path=path).get_collection("bench")
+    where = {"role": {"$in": roles}}
+    samples, errors = [], 0
+    deadline = time.time() + duration
+    i = 0
+    while time.time() < deadline:
+        started = time.perf_counter()
+        try:
+            collection.query(query_embeddings=[queries[i % len(queries)].tolist()], n_results=k, where=where)
+        except Exception:
+            errors += 1
+        samples.append((time.perf_counter() - started) * 1000)
+        i += 1
+    rss, pss = memory_mb()
+    results.put({"samples": samples, "errors": errors, "seen": {}, "rss_mb": rss, "pss_mb": pss})
+
+
+def run_workers(target, args, count, during=None):
+    context = multiprocessing.get_context("spawn")
+    results = context.Queue()
+    procs = [context.Process(target=target, args=(*args, results)) for _ in range(count)]
+    for proc in procs:
+        proc.start()
+    published = during() if during else None
+    reports = [results.get() for _ in procs]
+    for proc in procs:
+        proc.join()
+    return reports, published
+
+
+def summarize(reports, published=None):
+    summary = {
+        "rss_mb_per_worker": round(float(np.mean([r["rss_mb"] for r in reports])), 1),
+        "pss_mb_per_worker": (round(float(np.mean([r["pss_mb"] for r in reports])), 1)
+                              if all(r["pss_mb"] is not None for r in reports) else None),
+        "failed_searches": sum(r["errors"] for r in reports),
+        "latency_ms": percentiles([s for r in reports for s in r["samples"]]),
+    }
+    if published:
+        version, at = published
+        summary["versions_served"] = sorted({v for r in reports for v in r["seen"]})
+        lags = [r["seen"][version] - at for r in reports if version in r["seen"]]
+        summary["workers_swapped"] = f"{len(lags)}/{len(reports)}"
+        summary["swap_seconds_max"] = round(max(lags), 2) if lags else None
+    return summary
+
+
+def run(args, workdir):
+    from rag_utils.numpy_store import MemmapVectorStore
+    from rag_utils.snapshots import publish_snapshot
+
+    vectors, roles = synthetic_corpus(args.rows + args.added_rows, args.dim, args.clusters, args.seed)
+    queries = make_queries(vectors, 200, args.seed)
+    visible = ["finance", "general"]
+    live = MemmapVectorStore(workdir / "live", dtype=args.dtype)
+    step = 5000
+    for i in range(0, args.rows, step):
+        end = min(i + step, args.rows)
+        live.upsert([str(n) for n in range(i, end)], vectors[i:end], [{"role": r} for r in roles[i:end]],
+                    [""] * (end - i))
+    root = workdir / "snapshots"
+    publish_snapshot(live, root)
+
+    report = {"config": {"rows": args.rows, "added_rows": args.added_rows, "dim": args.dim, "dtype": args.dtype,
+                         "duration_seconds": args.duration, "poll_seconds": args.poll_seconds},
+              "snapshot": {}, "chroma": {}}
+    added = 0
+    for count in args.workers:
+
+        def publish_midway():
+            # More chunks arrive while the workers are serving
+            nonlocal added
+            time.sleep(args.duration / 2)
+            start, end = args.rows + added, min(args.rows + added + args.added_rows // len(args.workers),
+                                                len(vectors))
+            live.upsert([str(n) for n in range(start, end)], vectors[start:end],
+                        [{"role": r} for r in roles[start:end]], [""] * (end - start))
+            added = end - args.rows
+            return publish_snapshot(live, root), time.time()
+
+        reports, published = run_workers(
+            snapshot_worker, (str(root), queries, visible, args.k, args.duration, args.poll_seconds), count,
+            publish_midway,
+        )
+        report["snapshot"][str(count)] = summarize(reports, published)
+
+    if args.compare_chroma:
+        import chromadb
+
+        collection = chromadb.PersistentClient(path=str(workdir / "chroma_db")).get_or_create_collection("bench")
+        for i in range(0, args.rows, step):
+            end = min(i + step, args.rows)
+            collection.add(ids=[str(n) for n in range(i, end)], embeddings=vectors[i:end].tolist(),
+                           metadatas=[{"role": r} for r in roles[i:end]])
+        for count in args.workers:
+            reports, _ = run_workers(
+                chroma_worker, (str(workdir / "chroma_db"), queries, visible, args.k, args.duration), count,
+            )
+            report["chroma"][str(count)] = summarize(reports)
+    return report
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--added-rows", type=int, default=5000, help="chunks published while serving")
+    parser.add_argument("--dim", type=int, default=1536)
+    parser.add_argument("--dtype", default="float32", choices=["float32", "float16", "int8"])
+    parser.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    parser.add_argument("--duration", type=float, default=6.0, help="seconds each worker serves")
+    parser.add_argument("--poll-seconds", type=float, default=0.5)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--clusters", type=int, default=200)
+    parser.add_argument("--compare-chroma", action="store_true")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    workdir = Path(tempfile.mkdtemp(prefix="serving-bench-"))
+    try:
+        # Publish messages go to stderr, the report to stdout
+        with contextlib.redirect_stdout(sys.stderr):
+            report = run(args, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
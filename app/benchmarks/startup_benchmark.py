@@ -0,0 +1,76 @@
+"""Import-time / startup benchmark for the RAG backend modules.
+
+Each measurement runs in a fresh interpreter so module caches do not hide
+the cost. ``import_ms`` is what a worker (or the indexer, or a test) pays
+just for importing; ``warm_up_ms`` is the client/collection construction
+that used to happen at import time and now runs on first use or from
+``rag_module.warm_up()``. ``eager_equivalent_ms`` is their sum, i.e. what
+every import cost before initialization was made lazy.
+
+Usage (from the ``app`` directory):
+
+    python -m benchmarks.startup_benchmark --repeat 5
+"""
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import tempfile
+from pathlib import Path
+
+APP_DIR = Path(__file__).resolve().parents[1]
+
+PROBE = """
+import json, time
+t0 = time.perf_counter()
+import {module} as m
+t1 = time.perf_counter()
+warm_up_ms = None
+if {warm_up}:
+    m.warm_up()
+    warm_up_ms = (time.perf_counter() - t1) * 1000
+print(json.dumps({{"import_ms": (t1 - t0) * 1000, "warm_up_ms": warm_up_ms}}))
+"""
+
+
+def run_probe(module: str, warm_up: bool, workdir: str) -> dict:
+    env = dict(os.environ, PYTHONPATH=str(APP_DIR), LANGCHAIN_TRACING_V2="false")
+    out = subprocess.run(
+        [sys.executable, "-c", PROBE.format(module=module, warm_up=warm_up)],
+        cwd=workdir, env=env, capture_output=True, text=True, check=True,
+    )
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def median_of(samples, key):
+    values = [s[key] for s in samples if s[key] is not None]
+    return round(statistics.median(values), 1) if values else None
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--skip-warm-up", action="store_true",
+                        help="only time imports (warm-up needs rag_utils/secret_key.py)")
+    args = parser.parse_args()
+
+    results = {}
+    # Chroma persists relative to the working directory, so use a scratch one
+    with tempfile.TemporaryDirectory() as workdir:
+        for module, can_warm_up in [("rag_utils.rag_module", True),
+                                    ("rag_utils.query_classifier", False)]:
+            warm_up = can_warm_up and not args.skip_warm_up
+            samples = [run_probe(module, warm_up, workdir) for _ in range(args.repeat)]
+            row = {"import_ms": median_of(samples, "import_ms")}
+            if warm_up:
+                row["warm_up_ms"] = median_of(samples, "warm_up_ms")
+                row["eager_equivalent_ms"] = round(row["import_ms"] + row["warm_up_ms"], 1)
+            results[module] = row
+
+    print(json.dumps(results, indent=2))
+
+
+if __name__ == "__main__":
+    main()
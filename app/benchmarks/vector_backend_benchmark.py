@@ -0,0 +1,186 @@
+"""Recall and latency of the memory-mapped NumPy backend against Chroma.
+
+Both backends are loaded with the same synthetic corpus: clustered unit
+vectors, each tagged with one of a few roles. The same queries are then run
+against each, with the role filter a retriever would apply. Exact float32
+brute force is the ground truth for recall@k. The JSON report has, per
+backend and per visibility (one role plus general, or everything):
+
+- recall@k against the exact top-k
+- single-query latency (p50/p95/p99 ms) and batched throughput
+- load time and on-disk size
+
+plus peak RSS of the run. No keys or network are needed.
+
+Usage (from the ``app`` directory):
+
+    python -m benchmarks.vector_backend_benchmark --rows 200000 --dim 1536 --queries 200
+    python -m benchmarks.vector_backend_benchmark --dtypes float16 int8 --skip-chroma
+"""
+import argparse
+import json
+import shutil
+import tempfile
+import time
+from pathlib import Path
+
+import numpy as np
+
+from benchmarks.rag_benchmark import peak_rss_mb, percentiles
+
+ROLES = ["general", "finance", "marketing", "hr", "engineering"]
+
+
+def synthetic_corpus(rows, dim, clusters, seed):
+    # Clustered data is closer to real embeddings than uniform noise, and
+    # makes approximate indexes work for their recall
+    rng = np.random.default_rng(seed)
+    centers = rng.standard_normal((clusters, dim)).astype(np.float32)
+    assignment = rng.integers(0, clusters, rows)
+    vectors = centers[assignment] + 0.6 * rng.standard_normal((rows, dim)).astype(np.float32)
+    vectors /= np.linalg.norm(vectors, axis=1, keepdims=True)
+    roles = rng.choice(ROLES, rows, p=[0.3, 0.2, 0.2, 0.15, 0.15])
+    return vectors, roles
+
+
+def make_queries(vectors, count, seed):
+    # Perturbed corpus vectors: every query has close neighbours
+    rng = np.random.default_rng(seed + 1)
+    picks = vectors[rng.integers(0, len(vectors), count)]
+    queries = picks + 0.3 * rng.standard_normal(picks.shape).astype(np.float32) / np.sqrt(picks.shape[1])
+    return queries / np.linalg.norm(queries, axis=1, keepdims=True)
+
+
+def exact_top_k(vectors, roles, queries, visible, k):
+    allowed = np.ones(len(roles), dtype=bool) if visible is None else np.isin(roles, visible)
+    scores = queries @ vectors[allowed].T
+    ids = np.flatnonzero(allowed)
+    top = np.argsort(-scores, axis=1)[:, :k]
+    return [set(ids[row].tolist()) for row in top]
+
+
+def recall(found, truth):
+    return round(float(np.mean([len(f & t) / max(1, len(t)) for f, t in zip(found, truth)])), 4)
+
+
+def directory_mb(path):
+    return round(sum(f.stat().st_size for f in Path(path).rglob("*") if f.is_file()) / (1024 * 1024), 1)
+
+
+def measure(search_one, search_batch, queries, truth, batch_size):
+    found, samples = [], []
+    for query in queries:
+        started = time.perf_counter()
+        found.append(search_one(query))
+        samples.append((time.perf_counter() - started) * 1000)
+    started = time.perf_counter()
+    for i in range(0, len(queries), batch_size):
+        search_batch(queries[i:i + batch_size])
+    elapsed = time.perf_counter() - started
+    return {
+        "recall": recall(found, truth),
+        "latency_ms": percentiles(samples),
+        "batch_queries_per_sec": round(len(queries) / elapsed, 1),
+    }
+
+
+def bench_chroma(workdir, vectors, roles, queries, truths, k, batch_size):
+    import chromadb
+
+    client = chromadb.PersistentClient(path=str(workdir / "chroma_db"))
+    collection = client.get_or_create_collection("bench")
+    started = time.perf_counter()
+    step = 5000
+    for i in range(0, len(vectors), step):
+        collection.add(
+            ids=[str(n) for n in range(i, min(i + step, len(vectors)))],
+            embeddings=vectors[i:i + step].tolist(),
+            metadatas=[{"role": r} for r in roles[i:i + step]],
+        )
+    result = {"load_seconds": round(time.perf_counter() - started, 2)}
+
+    for label, visible in truths["visible"].items():
+        where = None if visible is None else {"role": {"$in": visible}}
+
+        def search(batch):
+            hits = collection.query(query_embeddings=np.atleast_2d(batch).tolist(), n_results=k, where=where)
+            return [{int(i) for i in ids} for ids in hits["ids"]]
+
+        result[label] = measure(lambda q: search(q)[0], search, queries, truths[label], batch_size)
+    result["disk_mb"] = directory_mb(workdir / "chroma_db")
+    return result
+
+
+def bench_numpy(workdir, dtype, vectors, roles, queries, truths, k, batch_size):
+    from rag_utils.numpy_store import MemmapVectorStore
+
+    directory = workdir / f"numpy_{dtype}"
+    store = MemmapVectorStore(directory, dtype=dtype)
+    started = time.perf_counter()
+    step = 5000
+    for i in range(0, len(vectors), step):
+        ids = [str(n) for n in range(i, min(i + step, len(vectors)))]
+        store.upsert(ids, vectors[i:i + step], [{"role": r} for r in roles[i:i + step]], [""] * len(ids))
+    result = {"load_seconds": round(time.perf_counter() - started, 2)}
+    # Rows are appended in id order, so row number == corpus index here
+    for label, visible in truths["visible"].items():
+
+        def search(batch):
+            return [{row for row, _ in hits} for hits in store.search(batch, visible, k)]
+
+        result[label] = measure(lambda q: search(q)[0], search, queries, truths[label], batch_size)
+    result["disk_mb"] = directory_mb(directory)
+    return result
+
+
+def run(args, workdir):
+    vectors, roles = synthetic_corpus(args.rows, args.dim, args.clusters, args.seed)
+    queries = make_queries(vectors, args.queries, args.seed)
+    visible = {"role_filtered": ["finance", "general"], "all_roles": None}
+    truths = {"visible": visible}
+    for label, roles_seen in visible.items():
+        truths[label] = exact_top_k(vectors, roles, queries, roles_seen, args.k)
+
+    backends = {}
+    for dtype in args.dtypes:
+        backends[f"numpy_{dtype}"] = bench_numpy(workdir, dtype, vectors, roles, queries, truths, args.k,
+                                                 args.batch_size)
+    if not args.skip_chroma:
+        backends["chroma"] = bench_chroma(workdir, vectors, roles, queries, truths, args.k, args.batch_size)
+    return {
+        "config": {"rows": args.rows, "dim": args.dim, "queries": args.queries, "k": args.k,
+                   "clusters": args.clusters, "batch_size": args.batch_size},
+        "backends": backends,
+        "peak_rss_mb": peak_rss_mb(),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--rows", type=int, default=50000)
+    parser.add_argument("--dim", type=int, default=1536, help="text-embedding-3-small is 1536")
+    parser.add_argument("--queries", type=int, default=200)
+    parser.add_argument("--k", type=int, default=4)
+    parser.add_argument("--clusters", type=int, default=200)
+    parser.add_argument("--batch-size", type=int, default=32, help="queries per batched search")
+    parser.add_argument("--dtypes", nargs="+", default=["float32", "float16", "int8"])
+    parser.add_argument("--skip-chroma", action="store_true")
+    parser.add_argument("--seed", type=int, default=7)
+    parser.add_argument("--output", help="write the JSON report here instead of stdout")
+    args = parser.parse_args()
+
+    workdir = Path(tempfile.mkdtemp(prefix="vector-bench-"))
+    try:
+        report = run(args, workdir)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    text = json.dumps(report, indent=2)
+    if args.output:
+        Path(args.output).write_text(text + "\n")
+    else:
+        print(text)
+
+
+if __name__ == "__main__":
+    main()
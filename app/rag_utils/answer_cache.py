@@ -0,0 +1,166 @@
+import os
+import re
+import threading
+import time
+from collections import OrderedDict
+
+import numpy as np
+
+
+# ==============================
+# ========== CONFIG ==========
+# ==============================
+RAG_CACHE_MAX_ENTRIES = int(os.getenv("RAG_CACHE_MAX_ENTRIES", "1024"))
+RAG_CACHE_TTL = float(os.getenv("RAG_CACHE_TTL", "3600"))
+# Cosine similarity above which a differently worded question reuses a cached
+# answer; 0 turns the semantic match (and its query embedding call) off.
+# Off by default: embeddings barely separate questions that differ in one
+# ID, quarter or year, so pick a threshold on real traffic first. Even
+# then, a match must name the same IDs and numbers.
+RAG_CACHE_SEMANTIC_THRESHOLD = float(os.getenv("RAG_CACHE_SEMANTIC_THRESHOLD", "0"))
+
+SPECIFIC_TOKEN = re.compile(r"\b\w*\d\w*\b")
+
+
+def normalize_question(question: str) -> str:
+    question = re.sub(r"\s+", " ", question.strip().lower())
+    return question.strip(" ?!.")
+
+
+def specific_tokens(question: str) -> frozenset:
+    # IDs, quarters, years and other numbers: finemp1006, q3, 2024, ...
+    return frozenset(SPECIFIC_TOKEN.findall(normalize_question(question)))
+
+
+def roles_affected_by(doc_role: str):
+    # Roles whose answers may change when documents of doc_role are indexed.
+    # None means every role (general documents are visible to everybody).
+    doc_role = doc_role.lower()
+    if doc_role == "general":
+        return None
+    return {doc_role, "c-level"}
+
+
+class AnswerCache:
+    """LRU + TTL cache of final answers keyed by (role, normalized question).
+
+    The role is part of every key and of the semantic lookup, so an answer
+    built from one role's documents is never returned to another role.
+    """
+
+    def __init__(self, max_entries=RAG_CACHE_MAX_ENTRIES, ttl=RAG_CACHE_TTL,
+                 semantic_threshold=RAG_CACHE_SEMANTIC_THRESHOLD):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self.semantic_threshold = semantic_threshold
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @property
+    def semantic_enabled(self) -> bool:
+        return self.semantic_threshold > 0
+
+    @staticmethod
+    def _key(role: str, question: str):
+        if not role:
+            raise ValueError("AnswerCache requires a role for every lookup")
+        return role.lower(), normalize_question(question)
+
+    def _expired(self, entry, now) -> bool:
+        return self.ttl > 0 and now - entry["created"] > self.ttl
+
+    def get(self, role: str, question: str, embedding=None, record_miss=True):
+        key = self._key(role, question)
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None and self._expired(entry, now):
+                del self._entries[key]
+                entry = None
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                return entry["answer"]
+
+            if embedding is not None and self.semantic_enabled:
+                match = self._semantic_match(key, embedding, now)
+                if match is not None:
+                    self._entries.move_to_end(match)
+                    self.hits += 1
+                    self.semantic_hits += 1
+                    return self._entries[match]["answer"]
+
+            if record_miss:
+                self.misses += 1
+            return None
+
+    def _semantic_match(self, asked, embedding, now):
+        # Only questions of the same role that name the same IDs and numbers
+        specifics = specific_tokens(asked[1])
+        keys, vectors = [], []
+        for key, entry in self._entries.items():
+            if (key[0] == asked[0] and entry["embedding"] is not None and not self._expired(entry, now)
+                    and specific_tokens(key[1]) == specifics):
+                keys.append(key)
+                vectors.append(entry["embedding"])
+        if not keys:
+            return None
+        scores = np.vstack(vectors) @ _unit(embedding)
+        best = int(np.argmax(scores))
+        return keys[best] if scores[best] >= self.semantic_threshold else None
+
+    def put(self, role: str, question: str, answer: str, embedding=None):
+        key = self._key(role, question)
+        entry = {
+            "answer": answer,
+            "created": time.monotonic(),
+            "embedding": _unit(embedding) if embedding is not None else None,
+        }
+        with self._lock:
+            self._entries[key] = entry
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate_for_document_roles(self, doc_roles):
+        # Drop cached answers of every role that can see the newly indexed documents
+        affected = set()
+        for doc_role in doc_roles:
+            roles = roles_affected_by(doc_role)
+            if roles is None:
+                self.clear()
+                return
+            affected |= roles
+        with self._lock:
+            for key in [k for k in self._entries if k[0] in affected]:
+                del self._entries[key]
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self) -> dict:
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "entries": len(self._entries),
+                "hits": self.hits,
+                "semantic_hits": self.semantic_hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
+
+
+def _unit(vector):
+    vector = np.asarray(vector, dtype=np.float32)
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+
+answer_cache = AnswerCache()
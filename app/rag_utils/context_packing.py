@@ -0,0 +1,133 @@
+import os
+import re
+import threading
+
+from langchain_core.documents import Document
+
+
+# ==============================
+# ========== CONFIG ==========
+# ==============================
+# Prompt tokens available for retrieved context per question. Each question
+# is further capped at the tokens of its own first BASELINE_K chunks, so
+# packing never sends more context than the old fixed top-4 did
+RAG_CONTEXT_TOKEN_BUDGET = int(os.getenv("RAG_CONTEXT_TOKEN_BUDGET", "600"))
+# Chunks the stuff chain received before packing; tokens_saved is measured
+# against the first BASELINE_K retrieved chunks
+BASELINE_K = 4
+# Word-shingle Jaccard similarity above which a chunk is a near duplicate
+RAG_NEAR_DUPLICATE_THRESHOLD = float(os.getenv("RAG_NEAR_DUPLICATE_THRESHOLD", "0.8"))
+# Shortest shared prefix/suffix between two chunks treated as splitter overlap
+MIN_OVERLAP_CHARS = 40
+MAX_OVERLAP_CHARS = 400
+
+_encoding = None
+_encoding_lock = threading.Lock()
+
+
+def count_tokens(text: str) -> int:
+    # cl100k_base is already loaded by OpenAIEmbeddings; fall back to a
+    # characters/4 estimate where tiktoken or its data is unavailable.
+    global _encoding
+    if _encoding is None:
+        with _encoding_lock:
+            if _encoding is None:
+                try:
+                    import tiktoken
+
+                    _encoding = tiktoken.get_encoding("cl100k_base")
+                except Exception:
+                    _encoding = False
+    if _encoding:
+        return len(_encoding.encode(text, disallowed_special=()))
+    return max(1, len(text) // 4)
+
+
+def _shingles(text: str, n: int = 5):
+    words = re.findall(r"\w+", text.lower())
+    if len(words) <= n:
+        return {" ".join(words)}
+    return {" ".join(words[i:i + n]) for i in range(len(words) - n + 1)}
+
+
+def _jaccard(a, b) -> float:
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+
+def _overlap(a: str, b: str) -> int:
+    # Length of the longest suffix of a that is also a prefix of b
+    for size in range(min(len(a), len(b), MAX_OVERLAP_CHARS), MIN_OVERLAP_CHARS - 1, -1):
+        if a.endswith(b[:size]):
+            return size
+    return 0
+
+
+def _with_source_header(doc: Document, text: str) -> Document:
+    # Put the citation next to the text so the model can name its **Source**
+    source = doc.metadata.get("source", "unknown")
+    section = doc.metadata.get("section")
+    if doc.metadata.get("row_start") is not None:
+        section = f"rows {doc.metadata['row_start']}-{doc.metadata['row_end']}"
+    header = f"[Source: {source}" + (f" | Section: {section}" if section else "") + "]"
+    return Document(page_content=f"{header}\n{text}", metadata=doc.metadata)
+
+
+def pack_context(docs, budget: int = RAG_CONTEXT_TOKEN_BUDGET):
+    """Assemble retrieved chunks into the prompt context within a token budget.
+
+    ``docs`` must be in relevance order. Exact and near-duplicate chunks are
+    dropped, text a kept chunk of the same source already contains through
+    splitter overlap is trimmed, and chunks are then added by relevance
+    until the budget is used (adaptive k). The budget is capped at the
+    tokens of the first ``BASELINE_K`` chunks, the old fixed context; only
+    the most relevant chunk is kept when even it does not fit. Returns
+    ``(docs, stats)``; ``tokens_saved`` is relative to that old context.
+    """
+    tokens = [count_tokens(d.page_content) for d in docs]
+    stats = {"candidates": len(docs), "duplicates": 0, "near_duplicates": 0, "trimmed_chars": 0,
+             "over_budget": 0, "tokens_in": sum(tokens), "tokens_baseline": sum(tokens[:BASELINE_K])}
+    kept = []  # (doc, text, shingles)
+    seen = set()
+    for doc in docs:
+        text = doc.page_content.strip()
+        key = re.sub(r"\s+", " ", text.lower())
+        if key in seen:
+            stats["duplicates"] += 1
+            continue
+        shingles = _shingles(text)
+        if any(_jaccard(shingles, other) >= RAG_NEAR_DUPLICATE_THRESHOLD for _, _, other in kept):
+            stats["near_duplicates"] += 1
+            continue
+        source = doc.metadata.get("source")
+        for other_doc, other_text, _ in kept:
+            if other_doc.metadata.get("source") != source:
+                continue
+            head = _overlap(other_text, text)
+            if head:
+                text = text[head:].lstrip()
+                stats["trimmed_chars"] += head
+            tail = _overlap(text, other_text)
+            if tail:
+                text = text[:-tail].rstrip()
+                stats["trimmed_chars"] += tail
+        if not text:
+            stats["duplicates"] += 1
+            continue
+        seen.add(key)
+        kept.append((doc, text, shingles))
+
+    budget = min(budget, stats["tokens_baseline"])
+    packed, used = [], 0
+    for doc, text, _ in kept:
+        candidate = _with_source_header(doc, text)
+        tokens = count_tokens(candidate.page_content)
+        if used + tokens > budget and packed:
+            stats["over_budget"] += 1
+            continue
+        packed.append(candidate)
+        used += tokens
+
+    stats["kept"] = len(packed)
+    stats["tokens_out"] = used
+    stats["tokens_saved"] = stats["tokens_baseline"] - used
+    return packed, stats
@@ -0,0 +1,195 @@
+import asyncio
+import hashlib
+import os
+import re
+import sqlite3
+import threading
+from pathlib import Path
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+from . import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-writer use only
+    fcntl = None
+
+
+# ==============================
+# ===== Embedding store =====
+# ==============================
+# Vectors live in one append-only float32 file per model, read through a
+# memory map. A small SQLite index maps content hash -> row. The row count
+# is always derived from the file size, so a crash between appending a
+# vector and recording it only leaves an unused row behind.
+
+class EmbeddingStore:
+    def __init__(self, cache_dir, model_name):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.model_name = model_name
+        safe_name = re.sub(r"[^A-Za-z0-9_.-]", "_", model_name)
+        self.vectors_path = self.cache_dir / f"{safe_name}.f32"
+        self._db = sqlite3.connect(self.cache_dir / "index.db", check_same_thread=False)
+        self._db.executescript("""
+            CREATE TABLE IF NOT EXISTS vectors (
+                model TEXT NOT NULL,
+                content_hash TEXT NOT NULL,
+                row INTEGER NOT NULL,
+                PRIMARY KEY (model, content_hash)
+            );
+            CREATE TABLE IF NOT EXISTS models (model TEXT PRIMARY KEY, dim INTEGER NOT NULL);
+        """)
+        self._lock = threading.Lock()
+        row = self._db.execute("SELECT dim FROM models WHERE model = ?", (model_name,)).fetchone()
+        self.dim = row[0] if row else None
+        self._rows = {
+            h: r for h, r in self._db.execute(
+                "SELECT content_hash, row FROM vectors WHERE model = ?", (model_name,))
+        }
+        self._matrix = None
+
+    def _mapped(self):
+        if self.dim is None:
+            # Opened before any vector existed; another process has written some since
+            row = self._db.execute("SELECT dim FROM models WHERE model = ?", (self.model_name,)).fetchone()
+            self.dim = row[0] if row else None
+            if self.dim is None:
+                return None
+        # (Re)open the memory map when rows were appended since it was created
+        rows = self.vectors_path.stat().st_size // (self.dim * 4) if self.vectors_path.exists() else 0
+        if self._matrix is None or self._matrix.shape[0] < rows:
+            self._matrix = np.memmap(self.vectors_path, dtype=np.float32, mode="r", shape=(rows, self.dim))
+        return self._matrix
+
+    def get_many(self, hashes):
+        """Return {hash: vector} for the hashes present in the store."""
+        with self._lock:
+            missing = [h for h in hashes if h not in self._rows]
+            if missing:
+                # Another process (e.g. the indexer) may have added them
+                for i in range(0, len(missing), 500):
+                    batch = missing[i:i + 500]
+                    placeholders = ",".join("?" * len(batch))
+                    self._rows.update(self._db.execute(
+                        f"SELECT content_hash, row FROM vectors WHERE model = ? AND content_hash IN ({placeholders})",
+                        [self.model_name, *batch],
+                    ))
+            found = {h: self._rows[h] for h in hashes if h in self._rows}
+            if not found:
+                return {}
+            matrix = self._mapped()
+            if matrix is None:
+                return {}
+            # A row past the end was recorded but its vector never reached
+            # the disk (see put_many's durable flag): treat it as missing
+            return {h: np.array(matrix[r]) for h, r in found.items() if r < matrix.shape[0]}
+
+    def put_many(self, hashes, vectors, durable=True):
+        # durable=False skips the fsync: for query vectors, whose loss in a
+        # crash only costs a cache miss
+        vectors = np.asarray(vectors, dtype=np.float32)
+        with self._lock:
+            if self.dim is None:
+                self.dim = int(vectors.shape[1])
+                self._db.execute("INSERT OR IGNORE INTO models (model, dim) VALUES (?, ?)", (self.model_name, self.dim))
+            with open(self.vectors_path, "ab") as f:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_EX)
+                try:
+                    f.seek(0, os.SEEK_END)
+                    first_row = f.tell() // (self.dim * 4)
+                    f.write(vectors.tobytes())
+                    f.flush()
+                    if durable:
+                        os.fsync(f.fileno())
+                finally:
+                    if fcntl is not None:
+                        fcntl.flock(f, fcntl.LOCK_UN)
+            rows = [(self.model_name, h, first_row + i) for i, h in enumerate(hashes)]
+            self._db.executemany("INSERT OR REPLACE INTO vectors (model, content_hash, row) VALUES (?, ?, ?)", rows)
+            self._db.commit()
+            self._rows.update({h: r for _, h, r in rows})
+
+    def __len__(self):
+        return len(self._rows)
+
+
+# ==============================
+# ===== Cache-backed embeddings =====
+# ==============================
+class CachedEmbeddings(Embeddings):
+    """Embeddings wrapper that serves repeated texts from an EmbeddingStore.
+
+    Documents and queries share the store, so a query that matches an
+    already embedded text (or a repeated question) costs no API call.
+    """
+
+    def __init__(self, underlying: Embeddings, model_name: str, cache_dir="embedding_cache"):
+        self.underlying = underlying
+        self.model_name = model_name
+        self.store = EmbeddingStore(cache_dir, model_name)
+        self._stats_lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def _hash(text: str) -> str:
+        return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+    def _lookup(self, texts):
+        hashes = [self._hash(t) for t in texts]
+        cached = self.store.get_many(list(dict.fromkeys(hashes)))
+        # Embed each distinct missing text once
+        missing = {}
+        for text, h in zip(texts, hashes):
+            if h not in cached and h not in missing:
+                missing[h] = text
+        hits = sum(1 for h in hashes if h in cached)
+        with self._stats_lock:
+            self.hits += hits
+            self.misses += len(texts) - hits
+        metrics.cache_lookup("embeddings", "hit", hits)
+        metrics.cache_lookup("embeddings", "miss", len(texts) - hits)
+        return hashes, cached, missing
+
+    def _merge(self, hashes, cached, missing, new_vectors, durable=True):
+        if missing:
+            self.store.put_many(list(missing), new_vectors, durable=durable)
+            cached.update(zip(missing, (np.asarray(v, dtype=np.float32) for v in new_vectors)))
+        return [cached[h].tolist() for h in hashes]
+
+    def embed_documents(self, texts):
+        hashes, cached, missing = self._lookup(texts)
+        new_vectors = self.underlying.embed_documents(list(missing.values())) if missing else []
+        return self._merge(hashes, cached, missing, new_vectors)
+
+    def embed_query(self, text):
+        hashes, cached, missing = self._lookup([text])
+        new_vectors = [self.underlying.embed_query(text)] if missing else []
+        return self._merge(hashes, cached, missing, new_vectors, durable=False)[0]
+
+    # The store's SQLite lookups and file appends block, and share a lock with
+    # the indexing threads, so the async paths run them off the event loop
+    async def aembed_documents(self, texts):
+        hashes, cached, missing = await asyncio.to_thread(self._lookup, texts)
+        new_vectors = await self.underlying.aembed_documents(list(missing.values())) if missing else []
+        return await asyncio.to_thread(self._merge, hashes, cached, missing, new_vectors)
+
+    async def aembed_query(self, text):
+        hashes, cached, missing = await asyncio.to_thread(self._lookup, [text])
+        new_vectors = [await self.underlying.aembed_query(text)] if missing else []
+        return (await asyncio.to_thread(self._merge, hashes, cached, missing, new_vectors, False))[0]
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            lookups = self.hits + self.misses
+            return {
+                "model": self.model_name,
+                "stored_vectors": len(self.store),
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": self.hits / lookups if lookups else 0.0,
+            }
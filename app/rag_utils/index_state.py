@@ -0,0 +1,252 @@
+import hashlib
+import os
+import sqlite3
+import time
+from collections import defaultdict
+
+
+# ==============================
+# ===== Indexing state (SQLite) =====
+# ==============================
+# Lives next to the `documents` table in roles_docs.db. `indexed_files`
+# remembers the content hash each file was last indexed with, and
+# `indexed_chunks` the deterministic id and content hash of every chunk
+# written to the vector store for it.
+
+DB_PATH = "roles_docs.db"
+
+# A file that fails this many times is left as failed instead of retried
+RAG_INDEX_MAX_ATTEMPTS = int(os.getenv("RAG_INDEX_MAX_ATTEMPTS", "3"))
+# Background retries of a failed file wait attempts * this many seconds
+RAG_INDEX_RETRY_SECONDS = float(os.getenv("RAG_INDEX_RETRY_SECONDS", "30"))
+# A loading or embedding job untouched for this long belongs to an indexer
+# that died; it goes back to the queue. Live indexers touch their jobs after
+# every written batch.
+RAG_INDEX_LEASE_SECONDS = float(os.getenv("RAG_INDEX_LEASE_SECONDS", "600"))
+
+
+def connect(db_path=DB_PATH):
+    # WAL lets the API, the UI pollers and the indexer read while the indexer
+    # commits its frequent checkpoints; NORMAL sync is durable across process
+    # crashes in WAL mode
+    conn = sqlite3.connect(db_path, timeout=30)
+    conn.execute("PRAGMA journal_mode=WAL")
+    conn.execute("PRAGMA synchronous=NORMAL")
+    ensure_schema(conn)
+    return conn
+
+
+def ensure_schema(conn):
+    conn.executescript("""
+        CREATE TABLE IF NOT EXISTS indexed_files (
+            filepath TEXT PRIMARY KEY,
+            role TEXT NOT NULL,
+            content_hash TEXT NOT NULL,
+            indexed_at REAL NOT NULL
+        );
+        CREATE TABLE IF NOT EXISTS indexed_chunks (
+            chunk_id TEXT PRIMARY KEY,
+            filepath TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content_hash TEXT NOT NULL
+        );
+        CREATE INDEX IF NOT EXISTS idx_indexed_chunks_filepath ON indexed_chunks(filepath);
+        -- Section and document summaries of each indexed file version (see summaries.py)
+        CREATE TABLE IF NOT EXISTS document_summaries (
+            filepath TEXT NOT NULL,
+            role TEXT NOT NULL,
+            content_hash TEXT NOT NULL,
+            level TEXT NOT NULL,
+            position INTEGER NOT NULL,
+            title TEXT NOT NULL,
+            summary TEXT NOT NULL,
+            created_at REAL NOT NULL,
+            PRIMARY KEY (filepath, level, position)
+        );
+    """)
+    ensure_job_columns(conn)
+
+
+# ==============================
+# ===== Ingestion job state =====
+# ==============================
+# Uploads are tracked as jobs on their `documents` row:
+# pending -> loading -> embedding -> done, or failed (with the error).
+# `embedded` stays the "indexed" flag older code reads.
+JOB_STATES = ("pending", "loading", "embedding", "done", "failed")
+JOB_COLUMNS = {
+    "status": "TEXT NOT NULL DEFAULT 'pending'",
+    "priority": "INTEGER NOT NULL DEFAULT 0",
+    "error": "TEXT",
+    "chunks": "INTEGER NOT NULL DEFAULT 0",
+    "submitted_at": "REAL",
+    "updated_at": "REAL",
+    "attempts": "INTEGER NOT NULL DEFAULT 0",
+}
+
+
+def ensure_job_columns(conn):
+    # The documents table belongs to the API server; add the job columns and
+    # lookup indexes to it once it exists, marking rows indexed before this
+    # as done
+    columns = {row[1] for row in conn.execute("PRAGMA table_info(documents)")}
+    if not columns:
+        return
+    missing = [name for name in JOB_COLUMNS if name not in columns]
+    for name in missing:
+        try:
+            conn.execute(f"ALTER TABLE documents ADD COLUMN {name} {JOB_COLUMNS[name]}")
+        except sqlite3.OperationalError as e:
+            # Another connection added it first
+            if "duplicate column" not in str(e):
+                raise
+    if "status" in missing:
+        conn.execute("UPDATE documents SET status = 'done' WHERE embedded = 1")
+    conn.executescript("""
+        CREATE INDEX IF NOT EXISTS idx_documents_embedded ON documents(embedded);
+        CREATE INDEX IF NOT EXISTS idx_documents_role ON documents(role);
+        CREATE INDEX IF NOT EXISTS idx_documents_status ON documents(status, priority, id);
+    """)
+
+
+def set_document_status(conn, doc_id, status, error=None, chunks=None):
+    conn.execute(
+        "UPDATE documents SET status = ?, error = ?, chunks = COALESCE(?, chunks), updated_at = ? WHERE id = ?",
+        (status, error, chunks, time.time(), doc_id),
+    )
+
+
+def claim_documents(conn, rows, claimable=("pending",)):
+    """Mark ``(id, ...)`` rows as loading; returns the rows this connection won.
+
+    The status check is part of the UPDATE, so when two indexers select the
+    same row only the first to write it gets it back.
+    """
+    placeholders = ",".join("?" * len(claimable))
+    claimed = []
+    for row in rows:
+        cursor = conn.execute(
+            "UPDATE documents SET status = 'loading', error = NULL, updated_at = ?"
+            f" WHERE id = ? AND status IN ({placeholders})",
+            (time.time(), row[0], *claimable),
+        )
+        if cursor.rowcount:
+            claimed.append(row)
+    return claimed
+
+
+def touch_documents(conn, ids):
+    # Heartbeat: the indexer holding these jobs is still working on them
+    conn.executemany(
+        "UPDATE documents SET updated_at = ? WHERE id = ? AND status IN ('loading', 'embedding')",
+        [(time.time(), i) for i in ids],
+    )
+
+
+def release_stale_jobs(conn, lease_seconds=RAG_INDEX_LEASE_SECONDS) -> int:
+    """Send in-progress jobs whose lease expired back to pending; returns how many."""
+    cursor = conn.execute(
+        "UPDATE documents SET status = 'pending'"
+        " WHERE status IN ('loading', 'embedding') AND COALESCE(updated_at, 0) < ?",
+        (time.time() - lease_seconds,),
+    )
+    return cursor.rowcount
+
+
+def record_failure(conn, doc_id, error, max_attempts=RAG_INDEX_MAX_ATTEMPTS):
+    """Count a failed attempt: back to pending for a retry, or failed once out of attempts."""
+    conn.execute("UPDATE documents SET attempts = attempts + 1 WHERE id = ?", (doc_id,))
+    attempts = conn.execute("SELECT attempts FROM documents WHERE id = ?", (doc_id,)).fetchone()[0]
+    status = "failed" if attempts >= max_attempts else "pending"
+    set_document_status(conn, doc_id, status, error=error)
+    return status
+
+
+def document_job(conn, doc_id):
+    keys = ("id", "filepath", "role", "status", "priority", "error", "chunks", "attempts",
+            "submitted_at", "updated_at")
+    row = conn.execute(f"SELECT {', '.join(keys)} FROM documents WHERE id = ?", (doc_id,)).fetchone()
+    if row is None:
+        return None
+    return dict(zip(keys, row))
+
+
+def content_hash(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def file_hash(filepath) -> str:
+    digest = hashlib.sha256()
+    with open(filepath, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            digest.update(block)
+    return digest.hexdigest()
+
+
+class ChunkIdAssigner:
+    """Deterministic ids for the chunks of one file, assigned in order.
+
+    The id depends on the file, the role and the chunk text, so an unchanged
+    chunk keeps its id across re-indexing runs. Identical chunks within the
+    same file are told apart by their occurrence number.
+    """
+
+    def __init__(self, filepath, role):
+        self.prefix = f"{filepath}|{role.lower()}"
+        self._seen = defaultdict(int)
+
+    def assign(self, text: str):
+        chunk_hash = content_hash(text)
+        occurrence = self._seen[chunk_hash]
+        self._seen[chunk_hash] += 1
+        key = f"{self.prefix}|{chunk_hash}|{occurrence}"
+        return hashlib.sha256(key.encode("utf-8")).hexdigest()[:40], chunk_hash
+
+
+def is_file_unchanged(conn, filepath, role, file_digest) -> bool:
+    row = conn.execute(
+        "SELECT role, content_hash FROM indexed_files WHERE filepath = ?", (str(filepath),)
+    ).fetchone()
+    return row is not None and row[0] == role.lower() and row[1] == file_digest
+
+
+def requeue_outdated_files(conn, chunker_version) -> int:
+    """Send indexed files whose digest predates ``chunker_version`` back to the queue.
+
+    Stored digests end in the chunker version they were split with, so a
+    splitter change re-chunks every file once. The latest documents row of
+    each such file goes back to pending. Returns the number of rows.
+    """
+    cursor = conn.execute(
+        "UPDATE documents SET embedded = 0, status = 'pending', attempts = 0, error = NULL, updated_at = ?"
+        " WHERE status = 'done' AND id IN ("
+        "   SELECT MAX(d.id) FROM documents d JOIN indexed_files f ON f.filepath = d.filepath"
+        "   WHERE f.content_hash NOT LIKE ? GROUP BY d.filepath)",
+        (time.time(), f"%:{chunker_version}"),
+    )
+    conn.commit()
+    return cursor.rowcount
+
+
+def stored_chunk_ids(conn, filepath):
+    rows = conn.execute("SELECT chunk_id FROM indexed_chunks WHERE filepath = ?", (str(filepath),))
+    return {r[0] for r in rows}
+
+
+def record_chunks(conn, rows):
+    # rows: (chunk_id, filepath, role, content_hash)
+    conn.executemany(
+        "INSERT OR REPLACE INTO indexed_chunks (chunk_id, filepath, role, content_hash) VALUES (?, ?, ?, ?)",
+        [(i, str(f), r.lower(), h) for i, f, r, h in rows],
+    )
+
+
+def forget_chunks(conn, ids):
+    conn.executemany("DELETE FROM indexed_chunks WHERE chunk_id = ?", [(i,) for i in ids])
+
+
+def record_file(conn, filepath, role, file_digest):
+    conn.execute(
+        "INSERT OR REPLACE INTO indexed_files (filepath, role, content_hash, indexed_at) VALUES (?, ?, ?, ?)",
+        (str(filepath), role.lower(), file_digest, time.time()),
+    )
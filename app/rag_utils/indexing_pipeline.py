@@ -0,0 +1,125 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+
+# ==============================
+# ========== CONFIG ==========
+# ==============================
+RAG_EMBED_BATCH_SIZE = int(os.getenv("RAG_EMBED_BATCH_SIZE", "128"))
+RAG_EMBED_WORKERS = int(os.getenv("RAG_EMBED_WORKERS", "4"))
+# Batches embedded or waiting to be written at once. Bounds memory: at most
+# this many batches of chunks and vectors exist beyond the one being filled.
+RAG_EMBED_MAX_IN_FLIGHT = int(os.getenv("RAG_EMBED_MAX_IN_FLIGHT", "8"))
+
+
+class EmbeddingPipeline:
+    """Embed chunks in fixed-size batches on a worker pool and write them to Chroma.
+
+    Chunks are fed one at a time with add(); full batches are embedded in
+    parallel while the caller keeps producing chunks, and written to the
+    collection in submission order from the calling thread. after_pending()
+    registers a callback that runs once everything added so far is written,
+    which is how callers finalize per-file bookkeeping. ``collection_for``
+    maps a chunk to the collection it belongs in (role-partitioned stores);
+    by default every chunk goes to the vector store's own collection.
+    ``before_batch`` is called before each batch is submitted for embedding
+    and may block to throttle the pipeline. With ``on_batch_failed`` set, a
+    batch whose embedding or write fails is reported to it and skipped
+    instead of aborting the run.
+    """
+
+    def __init__(self, vectorstore, embeddings, on_batch_written=None, on_batch_failed=None,
+                 batch_size=RAG_EMBED_BATCH_SIZE, workers=RAG_EMBED_WORKERS,
+                 max_in_flight=RAG_EMBED_MAX_IN_FLIGHT, collection_for=None, before_batch=None):
+        # vectorstore may be None when collection_for routes every chunk
+        self.collection = vectorstore._collection if vectorstore is not None else None
+        self.collection_for = collection_for
+        self.before_batch = before_batch
+        self.embeddings = embeddings
+        self.on_batch_written = on_batch_written
+        self.on_batch_failed = on_batch_failed
+        self.batch_size = batch_size
+        self.max_in_flight = max(1, max_in_flight)
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="embed")
+        self._batch = []
+        self._in_flight = deque()
+        self._callbacks = deque()
+        self._next_seq = 0
+        self._last_written = -1
+        self.written = 0
+
+    def add(self, chunk_id, document, info=None):
+        self._batch.append((chunk_id, document, info))
+        if len(self._batch) >= self.batch_size:
+            self._submit()
+
+    def after_pending(self, callback):
+        # The batch that will contain the last chunk added so far
+        seq = self._next_seq if self._batch else self._next_seq - 1
+        if seq <= self._last_written and not self._callbacks:
+            callback()
+        else:
+            self._callbacks.append((seq, callback))
+
+    def _submit(self):
+        batch, self._batch = self._batch, []
+        while len(self._in_flight) >= self.max_in_flight:
+            self._write_oldest()
+        if self.before_batch:
+            self.before_batch()
+        texts = [document.page_content for _, document, _ in batch]
+        future = self._executor.submit(self.embeddings.embed_documents, texts)
+        self._in_flight.append((self._next_seq, future, batch))
+        self._next_seq += 1
+
+    def _write_oldest(self):
+        seq, future, batch = self._in_flight.popleft()
+        try:
+            self._upsert(batch, future.result())
+        except Exception as e:
+            if self.on_batch_failed is None:
+                raise
+            self.on_batch_failed(batch, e)
+        else:
+            self.written += len(batch)
+            if self.on_batch_written:
+                self.on_batch_written(batch)
+        self._last_written = seq
+        while self._callbacks and self._callbacks[0][0] <= seq:
+            self._callbacks.popleft()[1]()
+
+    def _upsert(self, batch, vectors):
+        groups = {}
+        for item, vector in zip(batch, vectors):
+            collection = self.collection_for(item[1]) if self.collection_for else self.collection
+            groups.setdefault(id(collection), (collection, []))[1].append((item, vector))
+        for collection, items in groups.values():
+            collection.upsert(
+                ids=[chunk_id for (chunk_id, _, _), _ in items],
+                embeddings=[vector for _, vector in items],
+                metadatas=[document.metadata for (_, document, _), _ in items],
+                documents=[document.page_content for (_, document, _), _ in items],
+            )
+
+    def close(self):
+        try:
+            if self._batch:
+                self._submit()
+            while self._in_flight:
+                self._write_oldest()
+            while self._callbacks:
+                self._callbacks.popleft()[1]()
+        finally:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            # Do not write or finalize anything after a failure
+            self._executor.shutdown(wait=True, cancel_futures=True)
+        return False
@@ -0,0 +1,177 @@
+import os
+import threading
+import time
+
+from . import index_state
+
+
+# ==============================
+# ========== CONFIG ==========
+# ==============================
+# After a wake-up, wait this long so uploads arriving together share a pass
+# (and embedding batches) instead of each starting its own
+RAG_INGEST_COALESCE_MS = float(os.getenv("RAG_INGEST_COALESCE_MS", "500"))
+# Files claimed per pass; higher priority and older uploads go first
+RAG_INGEST_MAX_FILES = int(os.getenv("RAG_INGEST_MAX_FILES", "32"))
+RAG_INGEST_POLL_SECONDS = float(os.getenv("RAG_INGEST_POLL_SECONDS", "5"))
+# Fewer embedding workers than the foreground indexer, so uploads never take
+# most of the API concurrency
+RAG_INGEST_EMBED_WORKERS = int(os.getenv("RAG_INGEST_EMBED_WORKERS", "2"))
+# Embedding batches wait while this many questions are being answered...
+RAG_INGEST_PAUSE_AT_QUESTIONS = int(os.getenv("RAG_INGEST_PAUSE_AT_QUESTIONS", "1"))
+# ...but at most this long, so sustained chat traffic cannot stall uploads
+RAG_INGEST_MAX_PAUSE_SECONDS = float(os.getenv("RAG_INGEST_MAX_PAUSE_SECONDS", "5"))
+
+
+def enqueue_document(filepath, role, priority=0, db_path=index_state.DB_PATH):
+    """Insert an upload into the documents table as a pending job and wake the worker.
+
+    Returns the job id (the documents row id).
+    """
+    conn = index_state.connect(db_path)
+    try:
+        cur = conn.execute(
+            "INSERT INTO documents (filepath, role, embedded, status, priority, submitted_at, updated_at)"
+            " VALUES (?, ?, 0, 'pending', ?, ?, ?)",
+            (str(filepath), role, priority, time.time(), time.time()),
+        )
+        conn.commit()
+        doc_id = cur.lastrowid
+    finally:
+        conn.close()
+    if _worker is not None:
+        _worker.wake()
+    return doc_id
+
+
+def job_status(doc_id, db_path=index_state.DB_PATH):
+    """Status dict of one upload job, for e.g. GET /upload-jobs/{id}; None if unknown."""
+    conn = index_state.connect(db_path)
+    try:
+        job = index_state.document_job(conn, doc_id)
+        if job and job["status"] == "pending":
+            ahead = conn.execute(
+                "SELECT COUNT(*) FROM documents WHERE status = 'pending'"
+                " AND (priority > ? OR (priority = ? AND id < ?))",
+                (job["priority"], job["priority"], doc_id),
+            ).fetchone()[0]
+            job["queue_position"] = ahead + 1
+        return job
+    finally:
+        conn.close()
+
+
+def list_jobs(limit=50, db_path=index_state.DB_PATH):
+    conn = index_state.connect(db_path)
+    try:
+        ids = [r[0] for r in conn.execute("SELECT id FROM documents ORDER BY id DESC LIMIT ?", (limit,))]
+        return [index_state.document_job(conn, i) for i in ids]
+    finally:
+        conn.close()
+
+
+def _yield_to_chat():
+    # Hold back the next embedding batch while questions are being answered
+    from .rag_chain import questions_in_flight
+
+    deadline = time.monotonic() + RAG_INGEST_MAX_PAUSE_SECONDS
+    while questions_in_flight() >= RAG_INGEST_PAUSE_AT_QUESTIONS and time.monotonic() < deadline:
+        time.sleep(0.05)
+
+
+class IngestionWorker:
+    """Background thread that indexes pending uploads from the documents table.
+
+    Uploads are claimed in (priority desc, id) order and indexed together in
+    one pipeline pass, so small concurrent uploads share embedding batches.
+    Progress is visible per job through its ``status`` column. The worker is
+    meant to run inside the API process, where it can see chat load; a
+    second process running run_indexer is still safe, because indexing is
+    incremental.
+    """
+
+    def __init__(self, db_path=index_state.DB_PATH):
+        self.db_path = db_path
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name="ingestion", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+
+    def wake(self):
+        self._wake.set()
+
+    def _claim(self, conn):
+        # Jobs of an indexer that died (in this or another process) go back
+        # to the queue once their lease runs out
+        index_state.release_stale_jobs(conn)
+        # Files being retried wait attempts * RAG_INDEX_RETRY_SECONDS, so a
+        # failing file does not hold up the queue
+        rows = conn.execute(
+            "SELECT id, filepath, role FROM documents WHERE status = 'pending'"
+            " AND (attempts = 0 OR COALESCE(updated_at, 0) + attempts * ? <= ?)"
+            " ORDER BY priority DESC, id LIMIT ?",
+            (index_state.RAG_INDEX_RETRY_SECONDS, time.time(), RAG_INGEST_MAX_FILES),
+        ).fetchall()
+        claimed = index_state.claim_documents(conn, rows)
+        conn.commit()
+        return claimed
+
+    def _run(self):
+        from .rag_module import chunker_version, index_documents
+
+        conn = index_state.connect(self.db_path)
+        try:
+            index_state.requeue_outdated_files(conn, chunker_version())
+            while not self._stop.is_set():
+                rows = self._claim(conn)
+                if not rows:
+                    self._wake.wait(RAG_INGEST_POLL_SECONDS)
+                    if self._wake.is_set() and not self._stop.is_set():
+                        self._wake.clear()
+                        self._stop.wait(RAG_INGEST_COALESCE_MS / 1000)
+                    continue
+                try:
+                    index_documents(conn, rows, before_batch=_yield_to_chat, workers=RAG_INGEST_EMBED_WORKERS)
+                except Exception as e:
+                    print(f"[Ingestion] pass failed: {e}")
+                    conn.rollback()
+                    for doc_id, _, _ in rows:
+                        job = index_state.document_job(conn, doc_id)
+                        if job and job["status"] in ("loading", "embedding"):
+                            index_state.record_failure(conn, doc_id, str(e))
+                    conn.commit()
+        finally:
+            conn.close()
+
+
+_worker = None
+_worker_lock = threading.Lock()
+
+
+def start_worker(db_path=index_state.DB_PATH):
+    # Call from the API server's startup hook; enqueue_document() then wakes it
+    global _worker
+    with _worker_lock:
+        if _worker is None:
+            _worker = IngestionWorker(db_path)
+        return _worker.start()
+
+
+def stop_worker(timeout=None):
+    global _worker
+    with _worker_lock:
+        if _worker is not None:
+            _worker.stop(timeout)
+            _worker = None
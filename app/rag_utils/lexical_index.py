@@ -0,0 +1,148 @@
+import math
+import re
+import threading
+from collections import Counter, defaultdict
+from typing import Any, List, Optional
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from . import metrics
+
+
+TOKEN_RE = re.compile(r"[a-z0-9]+")
+
+
+def tokenize(text: str):
+    # Lower-cased alphanumeric runs: keeps ids like FINEMP1006 and "q3" whole
+    return TOKEN_RE.findall(text.lower())
+
+
+def document_key(doc: Document) -> str:
+    return doc.metadata.get("chunk_id") or doc.page_content
+
+
+class _Partition:
+    def __init__(self):
+        self.postings = defaultdict(dict)  # term -> {chunk_id: term frequency}
+        self.lengths = {}
+        self.docs = {}
+        self.total_length = 0
+
+
+class LexicalIndex:
+    """In-memory BM25 inverted index, partitioned by the `role` chunk metadata.
+
+    Chunks are added and removed one by one as the indexer writes them, so the
+    index never needs a rebuild. Searches only touch the partitions of the
+    roles a user can see.
+    """
+
+    def __init__(self, k1=1.5, b=0.75):
+        self.k1 = k1
+        self.b = b
+        self._partitions = defaultdict(_Partition)
+        self._roles = {}  # chunk_id -> role, for removal
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._roles)
+
+    def add(self, chunk_id: str, doc: Document):
+        role = doc.metadata.get("role", "general").lower()
+        terms = Counter(tokenize(doc.page_content))
+        with self._lock:
+            if chunk_id in self._roles:
+                self._remove(chunk_id)
+            part = self._partitions[role]
+            for term, tf in terms.items():
+                part.postings[term][chunk_id] = tf
+            length = sum(terms.values())
+            part.lengths[chunk_id] = length
+            part.total_length += length
+            part.docs[chunk_id] = doc
+            self._roles[chunk_id] = role
+
+    def add_many(self, items):
+        for chunk_id, doc in items:
+            self.add(chunk_id, doc)
+
+    def remove(self, chunk_ids):
+        with self._lock:
+            for chunk_id in chunk_ids:
+                if chunk_id in self._roles:
+                    self._remove(chunk_id)
+
+    def _remove(self, chunk_id):
+        part = self._partitions[self._roles.pop(chunk_id)]
+        doc = part.docs.pop(chunk_id)
+        for term in set(tokenize(doc.page_content)):
+            postings = part.postings.get(term)
+            if postings is not None:
+                postings.pop(chunk_id, None)
+                if not postings:
+                    del part.postings[term]
+        part.total_length -= part.lengths.pop(chunk_id)
+
+    def search(self, query: str, roles=None, k: int = 4):
+        """Top-k ``(Document, score)`` over the given role partitions (None = all)."""
+        terms = set(tokenize(query))
+        scores = {}
+        with self._lock:
+            partitions = self._partitions.items() if roles is None else (
+                (r, self._partitions[r]) for r in roles if r in self._partitions)
+            for _, part in partitions:
+                n = len(part.lengths)
+                if not n:
+                    continue
+                avg_length = part.total_length / n
+                for term in terms:
+                    postings = part.postings.get(term)
+                    if not postings:
+                        continue
+                    idf = math.log(1 + (n - len(postings) + 0.5) / (len(postings) + 0.5))
+                    for chunk_id, tf in postings.items():
+                        norm = tf + self.k1 * (1 - self.b + self.b * part.lengths[chunk_id] / avg_length)
+                        scores[chunk_id] = scores.get(chunk_id, 0.0) + idf * tf * (self.k1 + 1) / norm
+            top = sorted(scores.items(), key=lambda item: item[1], reverse=True)[:k]
+            return [(self._partitions[self._roles[cid]].docs[cid], score) for cid, score in top]
+
+
+def reciprocal_rank_fusion(result_lists, k: int, rrf_k: int = 60):
+    scores, docs = {}, {}
+    for results in result_lists:
+        for rank, doc in enumerate(results):
+            key = document_key(doc)
+            docs.setdefault(key, doc)
+            scores[key] = scores.get(key, 0.0) + 1.0 / (rrf_k + rank + 1)
+    ranked = sorted(scores, key=scores.get, reverse=True)[:k]
+    return [docs[key] for key in ranked]
+
+
+class HybridRetriever(BaseRetriever):
+    """Vector retriever fused with the lexical index by reciprocal rank fusion."""
+
+    vector_retriever: Any
+    lexical_index: Any
+    roles: Optional[List[str]] = None
+    k: int = 4
+    fetch_k: int = 8
+    rrf_k: int = 60
+
+    def _lexical(self, query: str):
+        with metrics.stage("lexical_search"):
+            return [doc for doc, _ in self.lexical_index.search(query, self.roles, self.fetch_k)]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun):
+        vector_docs = self.vector_retriever.invoke(query)
+        return reciprocal_rank_fusion([vector_docs, self._lexical(query)], self.k, self.rrf_k)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager):
+        vector_docs = await self.vector_retriever.ainvoke(query)
+        return reciprocal_rank_fusion([vector_docs, self._lexical(query)], self.k, self.rrf_k)
+
+    def search_batch(self, queries, vectors):
+        vector_results = self.vector_retriever.search_batch(queries, vectors)
+        return [reciprocal_rank_fusion([docs, self._lexical(query)], self.k, self.rrf_k)
+                for query, docs in zip(queries, vector_results)]
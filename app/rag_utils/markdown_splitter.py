@@ -0,0 +1,141 @@
+import os
+import re
+
+from langchain_core.documents import Document
+
+
+# ==============================
+# ========== CONFIG ==========
+# ==============================
+MARKDOWN_CHUNK_CHARS = int(os.getenv("RAG_MARKDOWN_CHUNK_CHARS", "1500"))
+# Sections shorter than this are merged with the following sibling or child
+MARKDOWN_MIN_CHUNK_CHARS = int(os.getenv("RAG_MARKDOWN_MIN_CHUNK_CHARS", "300"))
+
+HEADING_RE = re.compile(r"^(#{1,6})\s+(.*?)\s*#*\s*$")
+FENCE_RE = re.compile(r"^\s*(```|~~~)")
+RULE_RE = re.compile(r"^\s*([-*_])(\s*\1){2,}\s*$")
+TABLE_SEPARATOR_RE = re.compile(r"^\s*\|?\s*:?-{3,}")
+
+
+def _parse_blocks(text):
+    """Split markdown into heading, table, code and paragraph blocks."""
+    lines = text.splitlines()
+    blocks = []
+    i = 0
+    while i < len(lines):
+        line = lines[i]
+        if not line.strip() or RULE_RE.match(line):
+            i += 1
+        elif FENCE_RE.match(line):
+            fence = FENCE_RE.match(line).group(1)
+            j = i + 1
+            while j < len(lines) and not lines[j].strip().startswith(fence):
+                j += 1
+            blocks.append(("code", "\n".join(lines[i:j + 1])))
+            i = j + 1
+        elif HEADING_RE.match(line):
+            level, title = HEADING_RE.match(line).groups()
+            blocks.append(("heading", line.strip(), len(level), title))
+            i += 1
+        elif line.lstrip().startswith("|"):
+            j = i
+            while j < len(lines) and lines[j].lstrip().startswith("|"):
+                j += 1
+            blocks.append(("table", "\n".join(lines[i:j])))
+            i = j
+        else:
+            j = i
+            while (j < len(lines) and lines[j].strip() and not HEADING_RE.match(lines[j])
+                   and not FENCE_RE.match(lines[j]) and not lines[j].lstrip().startswith("|")):
+                j += 1
+            blocks.append(("text", "\n".join(lines[i:j])))
+            i = j
+    return blocks
+
+
+def _sections(blocks):
+    """Group blocks under their heading; each section carries its heading path."""
+    stack = []
+    sections = [{"path": [], "level": 0, "heading": None, "blocks": []}]
+    for block in blocks:
+        if block[0] == "heading":
+            _, line, level, title = block
+            stack = [entry for entry in stack if entry[0] < level] + [(level, title)]
+            sections.append({"path": [t for _, t in stack], "level": level, "heading": line, "blocks": [line]})
+        else:
+            sections[-1]["blocks"].append(block[1])
+    return [s for s in sections if s["blocks"]]
+
+
+def _split_oversized(block, max_chars):
+    lines = block.split("\n")
+    # Tables are split by rows, repeating the header so every part stays a table
+    header = lines[:2] if len(lines) > 2 and TABLE_SEPARATOR_RE.match(lines[1]) else []
+    body = lines[len(header):]
+    parts, current = [], list(header)
+    for line in body:
+        if len("\n".join(current + [line])) > max_chars and len(current) > len(header):
+            parts.append("\n".join(current))
+            current = list(header)
+        current.append(line)
+    if len(current) > len(header):
+        parts.append("\n".join(current))
+    # A single line longer than max_chars is cut hard as a last resort
+    return [p[i:i + max_chars] for p in parts for i in range(0, len(p), max_chars)]
+
+
+def _section_chunks(section, max_chars):
+    # Continuation chunks restate the heading so they stand on their own;
+    # pieces leave room for it so those chunks stay within max_chars too
+    continued = [f"{section['heading']} (continued)"] if section["heading"] else []
+    room = max(max_chars - sum(len(c) + 2 for c in continued), max_chars // 2)
+    chunks, current = [], []
+    for block in section["blocks"]:
+        pieces = [block] if len(block) <= room else _split_oversized(block, room)
+        for piece in pieces:
+            if current and len("\n\n".join(current + [piece])) > max_chars:
+                chunks.append("\n\n".join(current))
+                current = list(continued)
+            current.append(piece)
+    if current:
+        chunks.append("\n\n".join(current))
+    return chunks
+
+
+def _common_prefix(a, b):
+    prefix = []
+    for x, y in zip(a, b):
+        if x != y:
+            break
+        prefix.append(x)
+    return prefix
+
+
+def split_markdown(doc: Document, max_chars=MARKDOWN_CHUNK_CHARS, min_chars=MARKDOWN_MIN_CHUNK_CHARS):
+    """Split a markdown Document along its heading hierarchy without overlap.
+
+    Tables and code blocks are never cut in the middle (oversized tables are
+    split by rows with the header repeated), and every chunk records its
+    heading path as ``section`` metadata, e.g. "Q2 - April to June 2024 >
+    Cash Flow Analysis".
+    """
+    pieces = []
+    for section in _sections(_parse_blocks(doc.page_content)):
+        for text in _section_chunks(section, max_chars):
+            pieces.append([section["path"], text])
+
+    merged = []
+    for path, text in pieces:
+        if merged:
+            prev_path, prev_text = merged[-1]
+            related = path[:len(prev_path)] == prev_path or path[:-1] == prev_path[:-1]
+            if (related and len(prev_text) < min_chars
+                    and len(prev_text) + len(text) + 2 <= max_chars):
+                merged[-1] = [_common_prefix(prev_path, path), f"{prev_text}\n\n{text}"]
+                continue
+        merged.append([path, text])
+
+    return [
+        Document(page_content=text, metadata={**doc.metadata, "section": " > ".join(path)})
+        for path, text in merged
+    ]
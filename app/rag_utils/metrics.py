@@ -0,0 +1,243 @@
+import bisect
+import contextvars
+import json
+import os
+import sys
+import threading
+import time
+import uuid
+from contextlib import contextmanager
+
+
+# ==============================
+# ========== CONFIG ==========
+# ==============================
+RAG_METRICS = os.getenv("RAG_METRICS", "true").lower() == "true"
+# Structured JSON log of every stage: "" (off), "stderr", or a file path
+RAG_METRICS_LOG = os.getenv("RAG_METRICS_LOG", "")
+# Histogram upper bounds in seconds
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+TOKEN_BUCKETS = (16, 64, 128, 256, 512, 1024, 2048, 4096, 8192)
+
+PROMETHEUS_CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+# Correlates the log lines of one question across stages and threads
+trace_id = contextvars.ContextVar("rag_trace_id", default=None)
+
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self._values = {}
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _key(labels):
+        return tuple(sorted((k, str(v)) for k, v in labels.items()))
+
+
+class Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + value
+
+    def samples(self):
+        with self._lock:
+            return [(self.name, key, value) for key, value in self._values.items()]
+
+
+class Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name, help_text, buckets=LATENCY_BUCKETS):
+        super().__init__(name, help_text)
+        self.buckets = tuple(buckets)
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                state = self._values[key] = {"counts": [0] * (len(self.buckets) + 1), "sum": 0.0, "count": 0}
+            state["counts"][bisect.bisect_left(self.buckets, value)] += 1
+            state["sum"] += value
+            state["count"] += 1
+
+    def samples(self):
+        rows = []
+        with self._lock:
+            for key, state in self._values.items():
+                cumulative = 0
+                for bound, count in zip(self.buckets + (float("inf"),), state["counts"]):
+                    cumulative += count
+                    le = "+Inf" if bound == float("inf") else repr(bound)
+                    rows.append((f"{self.name}_bucket", key + (("le", le),), cumulative))
+                rows.append((f"{self.name}_sum", key, state["sum"]))
+                rows.append((f"{self.name}_count", key, state["count"]))
+        return rows
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = {}
+        self._lock = threading.Lock()
+
+    def _get(self, cls, name, help_text, **kwargs):
+        with self._lock:
+            metric = self._metrics.get(name)
+            if metric is None:
+                metric = self._metrics[name] = cls(name, help_text, **kwargs)
+            return metric
+
+    def counter(self, name, help_text=""):
+        return self._get(Counter, name, help_text)
+
+    def histogram(self, name, help_text="", buckets=LATENCY_BUCKETS):
+        return self._get(Histogram, name, help_text, buckets=buckets)
+
+    def render_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            metrics = sorted(self._metrics.values(), key=lambda m: m.name)
+        for metric in metrics:
+            lines.append(f"# HELP {metric.name} {metric.help}")
+            lines.append(f"# TYPE {metric.name} {metric.kind}")
+            for name, key, value in metric.samples():
+                labels = ",".join(f'{k}="{_escape(v)}"' for k, v in key)
+                lines.append(f"{name}{{{labels}}} {value}" if labels else f"{name} {value}")
+        return "\n".join(lines) + "\n"
+
+    def snapshot(self) -> dict:
+        # Plain dict of every sample, e.g. for the benchmark report or a debug endpoint
+        with self._lock:
+            metrics = list(self._metrics.values())
+        return {
+            f"{name}{{{','.join(f'{k}={v}' for k, v in key)}}}": value
+            for metric in metrics for name, key, value in metric.samples()
+        }
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+registry = Registry()
+
+stage_seconds = registry.histogram("rag_stage_duration_seconds", "Time spent per pipeline stage")
+stage_errors = registry.counter("rag_stage_errors_total", "Stages that raised")
+tokens_total = registry.counter("rag_tokens_total", "Tokens processed per stage and kind")
+context_tokens = registry.histogram("rag_context_tokens", "Context tokens sent to the model per question",
+                                    buckets=TOKEN_BUCKETS)
+cache_lookups = registry.counter("rag_cache_lookups_total", "Cache lookups by cache and result")
+events = registry.counter("rag_events_total", "Notable pipeline events (routes, budget overruns, ...)")
+
+
+# ==============================
+# ====== Structured log ========
+# ==============================
+_log_lock = threading.Lock()
+_log_file = None
+
+
+def _log_stream():
+    global _log_file
+    if RAG_METRICS_LOG == "stderr":
+        return sys.stderr
+    if _log_file is None:
+        _log_file = open(RAG_METRICS_LOG, "a", encoding="utf-8", buffering=1)
+    return _log_file
+
+
+def log_event(event: str, **fields):
+    if not RAG_METRICS_LOG:
+        return
+    record = {"ts": round(time.time(), 3), "event": event, "trace_id": trace_id.get(), **fields}
+    line = json.dumps(record, default=str)
+    with _log_lock:
+        _log_stream().write(line + "\n")
+
+
+def new_trace() -> str:
+    value = uuid.uuid4().hex[:16]
+    trace_id.set(value)
+    return value
+
+
+# ==============================
+# ====== Recording helpers =====
+# ==============================
+@contextmanager
+def stage(name: str, **labels):
+    """Time a pipeline stage. Works around sync code and across awaits alike.
+
+    Yields a dict; keys added to it (token counts, result sizes) go into
+    the JSON log line of the stage.
+    """
+    if not RAG_METRICS:
+        yield {}
+        return
+    extra = {}
+    started = time.perf_counter()
+    status = "ok"
+    try:
+        yield extra
+    except BaseException:
+        status = "error"
+        stage_errors.inc(stage=name, **labels)
+        raise
+    finally:
+        elapsed = time.perf_counter() - started
+        stage_seconds.observe(elapsed, stage=name, **labels)
+        log_event("stage", stage=name, ms=round(elapsed * 1000, 3), status=status, **labels, **extra)
+
+
+def observe_stage(name: str, seconds: float, **labels):
+    # For durations measured elsewhere (e.g. time to first token)
+    if RAG_METRICS:
+        stage_seconds.observe(seconds, stage=name, **labels)
+        log_event("stage", stage=name, ms=round(seconds * 1000, 3), **labels)
+
+
+def count_tokens(stage_name: str, kind: str, value: int):
+    if RAG_METRICS and value:
+        tokens_total.inc(value, stage=stage_name, kind=kind)
+
+
+def cache_lookup(cache: str, result: str, value: int = 1):
+    if RAG_METRICS and value:
+        cache_lookups.inc(value, cache=cache, result=result)
+
+
+def event(name: str, **labels):
+    if RAG_METRICS:
+        events.inc(event=name, **labels)
+        log_event(name, **labels)
+
+
+def stage_summary() -> dict:
+    # {stage: {"count", "mean_ms"}} summed over label sets
+    totals = {}
+    with stage_seconds._lock:
+        items = [(key, dict(state)) for key, state in stage_seconds._values.items()]
+    for key, state in items:
+        name = dict(key)["stage"]
+        entry = totals.setdefault(name, {"count": 0, "sum": 0.0})
+        entry["count"] += state["count"]
+        entry["sum"] += state["sum"]
+    return {name: {"count": e["count"], "mean_ms": round(e["sum"] / e["count"] * 1000, 3)}
+            for name, e in sorted(totals.items()) if e["count"]}
+
+
+def render_prometheus() -> str:
+    """Prometheus text exposition of every metric.
+
+    Serve it as ``PlainTextResponse(render_prometheus(),
+    media_type=PROMETHEUS_CONTENT_TYPE)`` from a /metrics route.
+    """
+    return registry.render_prometheus()
@@ -0,0 +1,539 @@
+import asyncio
+import json
+import os
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any, List, Optional
+
+import numpy as np
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from . import metrics
+
+try:
+    import fcntl
+except ImportError:  # Windows: single-writer use only
+    fcntl = None
+
+
+# ==============================
+# ========== CONFIG ==========
+# ==============================
+# "chroma" (default), "numpy": exact search over the memory-mapped store, or
+# "snapshot": the same store, but served from read-only versioned snapshots
+# shared by every worker process (see snapshots.py)
+RAG_VECTOR_BACKEND = os.getenv("RAG_VECTOR_BACKEND", "chroma").lower()
+RAG_NUMPY_STORE_DIR = os.getenv("RAG_NUMPY_STORE_DIR", "vector_store")
+# float32 (exact), float16 (half the memory; rankings barely move, but NumPy
+# widens it to float32 slower than int8) or int8 (a quarter, per-row scale)
+RAG_NUMPY_DTYPE = os.getenv("RAG_NUMPY_DTYPE", "float32")
+# Rows scored per matrix product; bounds the float32 working copy
+SEARCH_BLOCK_ROWS = int(os.getenv("RAG_NUMPY_BLOCK_ROWS", "16384"))
+# Share of deleted rows at which the indexer rewrites the files without them
+# (re-indexed files leave their old chunks behind as deleted rows)
+RAG_NUMPY_COMPACT_RATIO = float(os.getenv("RAG_NUMPY_COMPACT_RATIO", "0.2"))
+
+DTYPES = {"float32": np.float32, "float16": np.float16, "int8": np.int8}
+MAX_ROLES = 64  # one bit per role in a uint64 mask
+
+
+# ==============================
+# ===== Memory-mapped store =====
+# ==============================
+# Three append-only files hold one row per chunk:
+#   vectors.<dtype>  the L2-normalised embedding, quantized
+#   scales.f32       the per-row int8 scale (int8 only)
+#   roles.u64        a bitmask of the chunk's role; 0 marks a deleted row
+# roles.u64 is appended last and defines how many rows exist, so a reader
+# never sees a row whose vector or metadata is missing. Chunk text and
+# metadata live in meta.db next to them.
+#
+# Compaction renumbers the rows. It writes a new generation of the three
+# files (vectors.<n>.<dtype>, ...) and switches meta.db's chunk rows and
+# its `generation` setting in one transaction, so rows found in one
+# generation are always resolved against that generation's chunks.
+
+class MemmapVectorStore:
+    """Exact top-k over a memory-mapped embedding matrix with a role bitmask.
+
+    Exposes the subset of the Chroma collection API the indexer and the
+    lexical index use (upsert, delete, count, get), so it can stand in for
+    the collection. With ``read_only`` the directory is treated as an
+    immutable snapshot (see export) and writes are refused.
+    """
+
+    def __init__(self, directory=RAG_NUMPY_STORE_DIR, dtype=RAG_NUMPY_DTYPE, read_only=False):
+        self.directory = Path(directory)
+        self.read_only = read_only
+        if read_only:
+            # Immutable: no locking or journal, so any number of processes share it
+            self._db = sqlite3.connect(f"{(self.directory / 'meta.db').resolve().as_uri()}?mode=ro&immutable=1",
+                                       uri=True, check_same_thread=False)
+        else:
+            self.directory.mkdir(parents=True, exist_ok=True)
+            self._db = sqlite3.connect(self.directory / "meta.db", check_same_thread=False, timeout=30)
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._create_schema()
+        settings = dict(self._db.execute("SELECT key, value FROM settings"))
+        # An existing store keeps the dtype it was built with
+        self.dtype_name = settings.get("dtype", dtype)
+        if self.dtype_name not in DTYPES:
+            raise ValueError(f"Unsupported vector dtype {self.dtype_name!r}; use one of {sorted(DTYPES)}")
+        self.dtype = DTYPES[self.dtype_name]
+        self.dim = int(settings["dim"]) if "dim" in settings else None
+        self.lock_path = self.directory / "write.lock"
+        self._lock = threading.RLock()
+        self._use_generation(self._generation())
+        self._mapped_key = None
+        self._maps = None  # (generation, (vectors, scales, roles))
+
+    def _create_schema(self, db=None):
+        (db or self._db).executescript("""
+            CREATE TABLE IF NOT EXISTS settings (key TEXT PRIMARY KEY, value TEXT NOT NULL);
+            CREATE TABLE IF NOT EXISTS roles (role TEXT PRIMARY KEY, bit INTEGER NOT NULL UNIQUE);
+            CREATE TABLE IF NOT EXISTS chunks (
+                row INTEGER PRIMARY KEY,
+                chunk_id TEXT NOT NULL,
+                text TEXT NOT NULL,
+                metadata TEXT NOT NULL
+            );
+            CREATE TABLE IF NOT EXISTS live (chunk_id TEXT PRIMARY KEY, row INTEGER NOT NULL);
+        """)
+
+    def _paths(self, generation):
+        suffix = f".{generation}" if generation else ""
+        return (self.directory / f"vectors{suffix}.{self.dtype_name}",
+                self.directory / f"scales{suffix}.f32",
+                self.directory / f"roles{suffix}.u64")
+
+    def _generation(self):
+        with self._lock:
+            row = self._db.execute("SELECT value FROM settings WHERE key = 'generation'").fetchone()
+        return int(row[0]) if row else 0
+
+    def _use_generation(self, generation):
+        # The files writers append to; readers look the generation up per search
+        self.generation = generation
+        self.vectors_path, self.scales_path, self.roles_path = self._paths(generation)
+
+    def current(self):
+        # The store a search should use; a SnapshotManager returns its latest snapshot
+        return self
+
+    # ----- role bits -----
+    def _role_bits(self):
+        return dict(self._db.execute("SELECT role, bit FROM roles"))
+
+    def _bit_for(self, role):
+        role = role.lower()
+        bits = self._role_bits()
+        if role not in bits:
+            if len(bits) >= MAX_ROLES:
+                raise ValueError(f"MemmapVectorStore supports at most {MAX_ROLES} roles")
+            self._db.execute("INSERT OR IGNORE INTO roles (role, bit) VALUES (?, ?)", (role, len(bits)))
+            bits = self._role_bits()
+        return bits[role]
+
+    def role_mask(self, roles=None) -> np.uint64:
+        # roles=None: every role (C-level)
+        if roles is None:
+            return np.uint64(0xFFFFFFFFFFFFFFFF)
+        bits = self._role_bits()
+        mask = 0
+        for role in roles:
+            if role.lower() in bits:
+                mask |= 1 << bits[role.lower()]
+        return np.uint64(mask)
+
+    # ----- reading -----
+    def _mapped(self):
+        """(vectors, scales, roles) memory maps of the current generation, or None while empty."""
+        return self._mapped_generation()[1]
+
+    def _mapped_generation(self):
+        # Maps are reopened after appends or a compaction. A snapshot never
+        # changes: it keeps its maps, even once its files are pruned.
+        if self.read_only and self._maps is not None:
+            return self._maps
+        if self.dim is None:
+            with self._lock:
+                row = self._db.execute("SELECT value FROM settings WHERE key = 'dim'").fetchone()
+            self.dim = int(row[0]) if row else None
+            if self.dim is None:
+                return self.generation, None
+        for _ in range(3):
+            generation = self._generation()
+            vectors_path, scales_path, roles_path = self._paths(generation)
+            with self._lock:
+                try:
+                    stat = roles_path.stat()
+                    key = (generation, stat.st_ino, stat.st_size)
+                    if key != self._mapped_key:
+                        rows = stat.st_size // 8
+                        if rows == 0:
+                            return generation, None
+                        vectors = np.memmap(vectors_path, dtype=self.dtype, mode="r", shape=(rows, self.dim))
+                        scales = (np.memmap(scales_path, dtype=np.float32, mode="r", shape=(rows,))
+                                  if self.dtype_name == "int8" else None)
+                        roles = np.memmap(roles_path, dtype=np.uint64, mode="r", shape=(rows,))
+                        self._maps = (generation, (vectors, scales, roles))
+                        self._mapped_key = key
+                    return self._maps
+                except FileNotFoundError:
+                    if generation == self._generation():
+                        return generation, None
+                    # Another process compacted the store meanwhile: look again
+        raise RuntimeError(f"{self.directory} kept changing generation while being mapped")
+
+    def search(self, query_vectors, roles=None, k=4):
+        """Exact top-k per query: a list of ``[(row, cosine similarity), ...]`` best first.
+
+        Rows are only meaningful until the next compaction; use
+        ``search_documents`` to turn hits into chunks.
+        """
+        return self._search(query_vectors, roles, k)[1]
+
+    def search_documents(self, query_vectors, roles=None, k=4):
+        """Top-k Documents per query, best first.
+
+        The rows are resolved against the same generation they were found
+        in; a search that raced a compaction is run again.
+        """
+        for _ in range(3):
+            generation, hits = self._search(query_vectors, roles, k)
+            docs = self.documents([row for query_hits in hits for row, _ in query_hits], generation)
+            if docs is not None:
+                return [[docs[row] for row, _ in query_hits if row in docs] for query_hits in hits]
+        raise RuntimeError(f"{self.directory} kept being compacted during a search")
+
+    def _search(self, query_vectors, roles, k):
+        queries = np.atleast_2d(np.asarray(query_vectors, dtype=np.float32))
+        norms = np.linalg.norm(queries, axis=1, keepdims=True)
+        queries = queries / np.where(norms == 0, 1, norms)
+        generation, maps = self._mapped_generation()
+        if maps is None:
+            return generation, [[] for _ in queries]
+        vectors, scales, row_roles = maps
+        mask = self.role_mask(roles)
+        best_scores = np.full((len(queries), 0), -np.inf, dtype=np.float32)
+        best_rows = np.zeros((len(queries), 0), dtype=np.int64)
+        for start in range(0, len(row_roles), SEARCH_BLOCK_ROWS):
+            end = min(start + SEARCH_BLOCK_ROWS, len(row_roles))
+            visible = (row_roles[start:end] & mask) != 0
+            if not visible.any():
+                continue
+            if visible.mean() < 0.5:
+                # Few visible rows: score only those
+                rows = np.flatnonzero(visible)
+                scores = queries @ np.asarray(vectors[start + rows], dtype=np.float32).T
+                if scales is not None:
+                    scores *= np.asarray(scales[start + rows], dtype=np.float32) / 127.0
+            else:
+                # Mostly visible: scoring the whole block and masking beats gathering a copy
+                rows = np.arange(end - start)
+                scores = queries @ np.asarray(vectors[start:end], dtype=np.float32).T
+                if scales is not None:
+                    scores *= np.asarray(scales[start:end], dtype=np.float32) / 127.0
+                scores[:, ~visible] = -np.inf
+            if scores.shape[1] > k:
+                top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+                scores = np.take_along_axis(scores, top, axis=1)
+            else:
+                top = np.broadcast_to(np.arange(scores.shape[1]), scores.shape)
+            best_scores = np.concatenate([best_scores, scores], axis=1)
+            best_rows = np.concatenate([best_rows, rows[top] + start], axis=1)
+            if best_scores.shape[1] > k:
+                keep = np.argpartition(-best_scores, k - 1, axis=1)[:, :k]
+                best_scores = np.take_along_axis(best_scores, keep, axis=1)
+                best_rows = np.take_along_axis(best_rows, keep, axis=1)
+        results = []
+        for scores, rows in zip(best_scores, best_rows):
+            order = np.argsort(-scores)[:k]
+            results.append([(int(rows[i]), float(scores[i])) for i in order if scores[i] > -np.inf])
+        return generation, results
+
+    def documents(self, rows, generation=None):
+        """Chunks by row. With ``generation``, None if the store was compacted since then."""
+        placeholders = ",".join("?" * len(rows))
+        # One statement reads the generation and the chunks from the same snapshot
+        with self._lock:
+            found = self._db.execute(
+                "SELECT g.value, c.row, c.chunk_id, c.text, c.metadata FROM"
+                " (SELECT COALESCE((SELECT value FROM settings WHERE key = 'generation'), '0') AS value) g"
+                f" LEFT JOIN chunks c ON c.row IN ({placeholders or 'NULL'})", list(rows)).fetchall()
+        if generation is not None and int(found[0][0]) != generation:
+            return None
+        return {
+            row: Document(id=chunk_id, page_content=text, metadata=json.loads(metadata))
+            for _, row, chunk_id, text, metadata in found if row is not None
+        }
+
+    # ----- Chroma collection subset -----
+    def count(self):
+        return self._db.execute("SELECT COUNT(*) FROM live").fetchone()[0]
+
+    def get(self, include=("documents", "metadatas"), limit=None, offset=0, ids=None):
+        query = "SELECT c.row, c.chunk_id, c.text, c.metadata FROM live l JOIN chunks c ON c.row = l.row"
+        params = []
+        if ids is not None:
+            query += f" WHERE l.chunk_id IN ({','.join('?' * len(ids))})"
+            params += list(ids)
+        query += " ORDER BY c.row LIMIT ? OFFSET ?"
+        params += [-1 if limit is None else limit, offset]
+        with self._lock:
+            for _ in range(3):
+                generation, maps = self._mapped_generation()
+                # The generation is read in the same statement as the rows
+                found = self._db.execute(
+                    f"SELECT (SELECT COALESCE((SELECT value FROM settings WHERE key = 'generation'), '0')), q.*"
+                    f" FROM ({query}) q ORDER BY q.row", params).fetchall()
+                if not found or int(found[0][0]) == generation:
+                    break
+            else:
+                raise RuntimeError(f"{self.directory} kept being compacted during a read")
+        rows = [r[1:] for r in found]
+        result = {"ids": [r[1] for r in rows]}
+        if "documents" in include:
+            result["documents"] = [r[2] for r in rows]
+        if "metadatas" in include:
+            result["metadatas"] = [json.loads(r[3]) for r in rows]
+        if "embeddings" in include:
+            result["embeddings"] = [self._dequantize(maps, r[0]).tolist() for r in rows]
+        return result
+
+    @staticmethod
+    def _dequantize(maps, row):
+        vectors, scales, _ = maps
+        vector = np.asarray(vectors[row], dtype=np.float32)
+        return vector * (scales[row] / 127.0) if scales is not None else vector
+
+    def _quantize(self, vectors):
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+        if self.dtype_name != "int8":
+            return vectors.astype(self.dtype), None
+        scales = np.abs(vectors).max(axis=1)
+        scales[scales == 0] = 1.0
+        quantized = np.round(vectors / scales[:, None] * 127).astype(np.int8)
+        return quantized, scales.astype(np.float32)
+
+    def _write_locked(self):
+        if self.read_only:
+            raise PermissionError(f"{self.directory} is a read-only snapshot")
+        lock = open(self.lock_path, "a")
+        if fcntl is not None:
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        # Another process may have compacted into a new generation
+        self._use_generation(self._generation())
+        return lock
+
+    def upsert(self, ids, embeddings, metadatas=None, documents=None):
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        metadatas = metadatas or [{} for _ in ids]
+        documents = documents or ["" for _ in ids]
+        last = {chunk_id: i for i, chunk_id in enumerate(ids)}
+        if len(last) < len(ids):
+            # An id given twice keeps its last entry, like Chroma's upsert
+            keep = sorted(last.values())
+            ids, vectors = [ids[i] for i in keep], vectors[keep]
+            metadatas, documents = [metadatas[i] for i in keep], [documents[i] for i in keep]
+        with self._lock:
+            lock = self._write_locked()
+            try:
+                if self.dim is None:
+                    self.dim = int(vectors.shape[1])
+                    self._db.execute("INSERT OR IGNORE INTO settings VALUES ('dim', ?)", (str(self.dim),))
+                    self._db.execute("INSERT OR IGNORE INTO settings VALUES ('dtype', ?)", (self.dtype_name,))
+                self._delete_locked(ids)
+                quantized, scales = self._quantize(vectors)
+                masks = np.array([1 << self._bit_for((m or {}).get("role", "general")) for m in metadatas],
+                                 dtype=np.uint64)
+                first_row = self.roles_path.stat().st_size // 8 if self.roles_path.exists() else 0
+                # Drop any partial rows a crashed writer left past the last complete one
+                with open(self.vectors_path, "ab") as f:
+                    f.truncate(first_row * self.dim * quantized.itemsize)
+                    f.write(quantized.tobytes())
+                if scales is not None:
+                    with open(self.scales_path, "ab") as f:
+                        f.truncate(first_row * 4)
+                        f.write(scales.tobytes())
+                rows = range(first_row, first_row + len(ids))
+                self._db.executemany(
+                    "INSERT OR REPLACE INTO chunks (row, chunk_id, text, metadata) VALUES (?, ?, ?, ?)",
+                    [(r, i, d, json.dumps(m or {})) for r, i, d, m in zip(rows, ids, documents, metadatas)],
+                )
+                self._db.executemany("INSERT OR REPLACE INTO live (chunk_id, row) VALUES (?, ?)", zip(ids, rows))
+                self._db.commit()
+                # Publishing the role masks makes the rows visible to readers
+                with open(self.roles_path, "ab") as f:
+                    f.write(masks.tobytes())
+                    f.flush()
+                    os.fsync(f.fileno())
+            finally:
+                lock.close()
+
+    def _delete_locked(self, ids):
+        rows = []
+        for i in range(0, len(ids), 500):
+            batch = list(ids[i:i + 500])
+            rows += [r[0] for r in self._db.execute(
+                f"SELECT row FROM live WHERE chunk_id IN ({','.join('?' * len(batch))})", batch)]
+            self._db.executemany("DELETE FROM live WHERE chunk_id = ?", [(c,) for c in batch])
+        if rows and self.roles_path.exists():
+            # Clearing the mask hides the row from every role at once
+            masks = np.memmap(self.roles_path, dtype=np.uint64, mode="r+")
+            masks[rows] = 0
+            masks.flush()
+            del masks
+        return len(rows)
+
+    def delete(self, ids):
+        with self._lock:
+            lock = self._write_locked()
+            try:
+                deleted = self._delete_locked(list(ids))
+                self._db.commit()
+                return deleted
+            finally:
+                lock.close()
+
+    def dead_rows(self) -> int:
+        maps = self._mapped()
+        return 0 if maps is None else int(len(maps[2]) - self.count())
+
+    def compact_if_needed(self, ratio=RAG_NUMPY_COMPACT_RATIO):
+        """Compact once deleted rows make up ``ratio`` of the files; returns the rows removed."""
+        dead = self.dead_rows()
+        if not dead or dead < ratio * (dead + self.count()):
+            return 0
+        return self.compact()
+
+    def compact(self):
+        """Rewrite the files without deleted rows, as a new generation; returns the rows removed.
+
+        Readers keep searching the old generation until the switch commits,
+        then pick up the new files on their next search.
+        """
+        with self._lock:
+            lock = self._write_locked()
+            try:
+                generation, maps = self._mapped_generation()
+                if maps is None:
+                    return 0
+                vectors, scales, masks = maps
+                keep = np.flatnonzero(np.asarray(masks) != 0)
+                remap = {int(old): new for new, old in enumerate(keep)}
+                new_paths = self._paths(generation + 1)
+                for path, data in zip(new_paths, (vectors, scales, masks)):
+                    if data is not None:
+                        np.asarray(data[keep]).tofile(path)
+                        with open(path, "rb") as f:
+                            os.fsync(f.fileno())
+                chunks = self._db.execute("SELECT row, chunk_id, text, metadata FROM chunks").fetchall()
+                self._db.execute("DELETE FROM chunks")
+                self._db.executemany(
+                    "INSERT INTO chunks (row, chunk_id, text, metadata) VALUES (?, ?, ?, ?)",
+                    [(remap[r], c, t, m) for r, c, t, m in chunks if r in remap],
+                )
+                self._db.execute("UPDATE live SET row = -1 - row")
+                self._db.executemany("UPDATE live SET row = ? WHERE row = ?",
+                                     [(new, -1 - old) for old, new in remap.items()])
+                self._db.execute("INSERT OR REPLACE INTO settings VALUES ('generation', ?)", (str(generation + 1),))
+                # The switch: rows, chunks and files change together
+                self._db.commit()
+                for path in self._paths(generation):
+                    # Readers still mapping the old files keep their pages
+                    path.unlink(missing_ok=True)
+                self._use_generation(generation + 1)
+                return len(masks) - len(keep)
+            except BaseException:
+                self._db.rollback()
+                raise
+            finally:
+                lock.close()
+
+    def export(self, directory):
+        """Write the live rows, compacted, into a new store directory.
+
+        Holds the write lock while copying, so the export is consistent with
+        concurrent upserts and deletes. Meant for immutable snapshots; open
+        the result with ``read_only=True``.
+        """
+        directory = Path(directory)
+        directory.mkdir(parents=True)
+        with self._lock:
+            lock = self._write_locked()
+            try:
+                maps = self._mapped()
+                db = sqlite3.connect(directory / "meta.db")
+                self._create_schema(db)
+                # The export is compacted: its files start over at generation 0
+                db.executemany("INSERT INTO settings VALUES (?, ?)", self._db.execute(
+                    "SELECT key, value FROM settings WHERE key != 'generation'").fetchall())
+                db.executemany("INSERT INTO roles VALUES (?, ?)", self._role_bits().items())
+                if maps is not None:
+                    vectors, scales, masks = maps
+                    keep = np.flatnonzero(np.asarray(masks) != 0)
+                    vectors_path, scales_path, roles_path = self._paths(0)
+                    np.asarray(vectors[keep]).tofile(directory / vectors_path.name)
+                    if scales is not None:
+                        np.asarray(scales[keep]).tofile(directory / scales_path.name)
+                    np.asarray(masks[keep]).tofile(directory / roles_path.name)
+                    remap = {int(old): new for new, old in enumerate(keep)}
+                    rows = self._db.execute(
+                        "SELECT c.row, c.chunk_id, c.text, c.metadata FROM live l JOIN chunks c ON c.row = l.row")
+                    for batch in iter(lambda: rows.fetchmany(1000), []):
+                        batch = [(remap[r], c, t, m) for r, c, t, m in batch if r in remap]
+                        db.executemany("INSERT INTO chunks VALUES (?, ?, ?, ?)", batch)
+                        db.executemany("INSERT INTO live VALUES (?, ?)", [(c, r) for r, c, _, _ in batch])
+                db.commit()
+                db.close()
+            finally:
+                lock.close()
+        for path in directory.iterdir():
+            with open(path, "rb") as f:
+                os.fsync(f.fileno())
+        return directory
+
+    def import_collection(self, collection, page=1000):
+        """Copy every chunk, with its stored embedding, from a Chroma collection."""
+        offset, copied = 0, 0
+        while True:
+            rows = collection.get(include=["embeddings", "documents", "metadatas"], limit=page, offset=offset)
+            if len(rows["ids"]):
+                self.upsert(rows["ids"], rows["embeddings"], rows["metadatas"], rows["documents"])
+            copied += len(rows["ids"])
+            if len(rows["ids"]) < page:
+                return copied
+            offset += page
+
+
+class MemmapRetriever(BaseRetriever):
+    """Retriever over a MemmapVectorStore, restricted to the visible roles."""
+
+    store: Any
+    embeddings: Any
+    k: int = 4
+    roles: Optional[List[str]] = None
+
+    def search_batch(self, queries, vectors):
+        # Rows and documents must come from the same store and generation,
+        # even if a newer snapshot is swapped in or the store is compacted
+        store = self.store.current()
+        if store is None:
+            return [[] for _ in queries]
+        with metrics.stage("vector_search", shards=1):
+            return store.search_documents(vectors, self.roles, self.k)
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun):
+        with metrics.stage("embed_query", purpose="retrieval"):
+            vector = self.embeddings.embed_query(query)
+        return self.search_batch([query], [vector])[0]
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager):
+        with metrics.stage("embed_query", purpose="retrieval"):
+            vector = await self.embeddings.aembed_query(query)
+        return (await asyncio.to_thread(self.search_batch, [query], [vector]))[0]
@@ -1,7 +1,27 @@
-from openai import OpenAI
+from collections import Counter
+from functools import lru_cache
+import math
 import os
+import re
+import threading
 
-client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+from . import metrics
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    # Built on first use so importing the classifier (and using the local
+    # router) never constructs an OpenAI client.
+    global _client
+    if _client is None:
+        with _client_lock:
+            if _client is None:
+                from openai import OpenAI
+
+                _client = OpenAI(api_key=os.getenv("OPENAI_API_KEY"))
+    return _client
 
 def detect_query_type_llm(question: str) -> str:
     prompt = f"""
@@ -24,10 +44,195 @@ Here is the question:
 Answer:
     """
 
-    response = client.chat.completions.create(
+    response = get_client().chat.completions.create(
         model="gpt-4",
         messages=[{"role": "user", "content": prompt}],
         temperature=0
     )
 
     return response.choices[0].message.content.strip().upper()
+
+
+# ==============================
+# ===== Local query router =====
+# ==============================
+# Rules built from the terms listed in the classifier prompt above, so most
+# questions are routed without any network call. Only low-confidence
+# questions fall back to detect_query_type_llm.
+
+SQL_TERMS = {
+    "average": 2.0, "avg": 2.0, "mean": 1.5, "median": 2.0, "sum": 2.0,
+    "filter": 2.0, "greater than": 2.5,
+    "less than": 2.5, "more than": 1.5, "fewer than": 2.0, "at least": 1.0, "at most": 1.0,
+    "group by": 3.0, "per department": 2.0, "by department": 1.5,
+    "highest": 1.5, "lowest": 1.5, "maximum": 1.5, "minimum": 1.5, "sorted": 1.5,
+    "rank": 1.0, "list all": 1.5, "details of employee": 3.0, "employee id": 2.0,
+    "salary": 1.0, "performance rating": 1.0, "leave balance": 1.0, "attendance": 1.0,
+}
+
+RAG_TERMS = {
+    "summary": 2.5, "summarize": 2.5, "summarise": 2.5, "overview": 2.0, "explain": 2.0,
+    "describe": 2.0, "definition": 2.0, "define": 2.0, "what is": 1.0, "what are": 1.0,
+    "why": 1.5, "how does": 1.5, "how do": 1.5, "process": 2.0, "policy": 2.0,
+    "policies": 2.0, "procedure": 2.0, "guidelines": 2.0, "highlights": 2.0, "report": 1.0,
+    "strategy": 1.5, "architecture": 1.5, "benefits": 1.5,
+}
+
+# Words that count or rank ("how many", "total", "top") are as common in
+# questions about documents ("how many leaves can I take", "the top risks in
+# the report"). They only count for SQL next to a noun of the tabular data.
+TABULAR_NOUN = r"(employees?|staff|salar(y|ies)|departments?|columns?|rows?|records?|headcount)"
+AGGREGATE_WORD = r"(how many|total|top( \d+)?|bottom( \d+)?|count( of)?|number of)"
+
+SQL_PATTERNS = [
+    (re.compile(rf"\b{AGGREGATE_WORD}\b(\W+\w+){{0,4}}?\W+{TABULAR_NOUN}\b"), 3.0),
+    (re.compile(rf"\b{TABULAR_NOUN}\b(\W+\w+){{0,4}}?\W+(total|count|top|bottom)\b"), 2.0),
+    (re.compile(r"\b(greater|less|more|fewer)\s+than\s+\d"), 2.0),
+    (re.compile(r"\b[a-z]{2,}emp\d{3,}\b"), 3.0),
+    (re.compile(r"\b(>|<|>=|<=)\s*\d"), 2.5),
+]
+
+LABELLED_EXAMPLES = [
+    ("What is the average salary in the Finance department?", "SQL"),
+    ("How many employees work in Sales?", "SQL"),
+    ("Top 5 employees by performance rating", "SQL"),
+    ("List employees with attendance greater than 95", "SQL"),
+    ("Total leaves taken by the marketing team", "SQL"),
+    ("Give me the details of employee FINEMP1006", "SQL"),
+    ("Count of employees per location", "SQL"),
+    ("Who has the highest leave balance?", "SQL"),
+    ("Summarize the Q2 marketing report", "RAG"),
+    ("What is the leave policy?", "RAG"),
+    ("Explain the onboarding process for new hires", "RAG"),
+    ("Give me the campaign highlights from the marketing summary", "RAG"),
+    ("Describe the system architecture in the engineering document", "RAG"),
+    ("What were the key financial risks mentioned in the quarterly report?", "RAG"),
+    ("What benefits do employees get?", "RAG"),
+    ("Overview of the company's revenue growth strategy", "RAG"),
+    # Counting and ranking words asked about documents
+    ("How many leaves can I take per year?", "RAG"),
+    ("List the top 3 marketing campaigns in Q4", "RAG"),
+    ("What are the top risks in the quarterly report?", "RAG"),
+    ("What was the total revenue growth in the annual report?", "RAG"),
+    ("Who is the CEO?", "RAG"),
+    ("Who approves reimbursement claims?", "RAG"),
+]
+
+ROUTER_CONFIDENCE_THRESHOLD = float(os.getenv("ROUTER_CONFIDENCE_THRESHOLD", "0.65"))
+ROUTER_USE_EXAMPLES = os.getenv("ROUTER_USE_EXAMPLES", "true").lower() == "true"
+ROUTER_LLM_FALLBACK = os.getenv("ROUTER_LLM_FALLBACK", "true").lower() == "true"
+
+
+def _normalize(question: str) -> str:
+    return re.sub(r"\s+", " ", question.strip().lower())
+
+
+def _rule_scores(question: str):
+    sql = sum(w for term, w in SQL_TERMS.items() if re.search(rf"\b{re.escape(term)}\b", question))
+    sql += sum(w for pattern, w in SQL_PATTERNS if pattern.search(question))
+    rag = sum(w for term, w in RAG_TERMS.items() if re.search(rf"\b{re.escape(term)}\b", question))
+    return sql, rag
+
+
+def _char_ngrams(text: str, n: int = 3) -> Counter:
+    text = f" {text} "
+    return Counter(text[i:i + n] for i in range(len(text) - n + 1))
+
+
+def _cosine(a: Counter, b: Counter) -> float:
+    dot = sum(v * b.get(k, 0) for k, v in a.items())
+    norm = math.sqrt(sum(v * v for v in a.values())) * math.sqrt(sum(v * v for v in b.values()))
+    return dot / norm if norm else 0.0
+
+
+_example_vectors = [(_char_ngrams(_normalize(q)), label) for q, label in LABELLED_EXAMPLES]
+
+
+def _example_scores(question: str, k: int = 3):
+    # k-nearest labelled examples by character-trigram cosine similarity
+    vector = _char_ngrams(question)
+    nearest = sorted(((_cosine(vector, ex), label) for ex, label in _example_vectors), reverse=True)[:k]
+    sql = sum(score for score, label in nearest if label == "SQL")
+    rag = sum(score for score, label in nearest if label == "RAG")
+    return sql, rag
+
+
+def classify_query_local(question: str):
+    """Route a question without any network call.
+
+    Returns ``(label, confidence)`` where label is "SQL" or "RAG" and
+    confidence is in [0, 1].
+    """
+    question = _normalize(question)
+    sql, rag = _rule_scores(question)
+    if ROUTER_USE_EXAMPLES:
+        ex_sql, ex_rag = _example_scores(question)
+        sql += ex_sql
+        rag += ex_rag
+    if sql + rag == 0:
+        return "RAG", 0.5
+    label = "SQL" if sql > rag else "RAG"
+    # Smoothed share of the winning side; a single weak hit stays below the threshold
+    confidence = (max(sql, rag) + 0.5) / (sql + rag + 1.0)
+    return label, round(confidence, 3)
+
+
+@lru_cache(maxsize=4096)
+def _local_route(normalized_question: str):
+    return classify_query_local(normalized_question)
+
+
+@lru_cache(maxsize=4096)
+def _llm_route(normalized_question: str) -> str:
+    # Only decisions the LLM actually made are cached; a failed call raises
+    # and is tried again the next time the question is asked
+    llm_label = detect_query_type_llm(normalized_question)
+    return "SQL" if "SQL" in llm_label else "RAG"
+
+
+def _route(normalized_question: str):
+    label, confidence = _local_route(normalized_question)
+    if confidence >= ROUTER_CONFIDENCE_THRESHOLD or not ROUTER_LLM_FALLBACK:
+        return label, confidence, "local"
+    try:
+        return _llm_route(normalized_question), confidence, "llm"
+    except Exception as e:
+        print(f"[Router] LLM fallback failed, using local label: {e}")
+        return label, confidence, "local"
+
+
+def detect_query_type(question: str) -> str:
+    with metrics.stage("classification"):
+        label, _, source = _route(_normalize(question))
+    metrics.event("route", route=label, source=source)
+    return label
+
+
+def measure_routing_agreement(questions, llm_labels=None) -> dict:
+    """Compare the local router against the LLM classifier offline.
+
+    ``llm_labels`` can be a precomputed list aligned with ``questions``;
+    otherwise detect_query_type_llm is called for each question.
+    """
+    confusion = Counter()
+    disagreements = []
+    low_confidence = 0
+    for i, question in enumerate(questions):
+        local_label, confidence = classify_query_local(question)
+        expected = llm_labels[i] if llm_labels is not None else detect_query_type_llm(question)
+        expected = "SQL" if "SQL" in expected.upper() else "RAG"
+        confusion[(expected, local_label)] += 1
+        if confidence < ROUTER_CONFIDENCE_THRESHOLD:
+            low_confidence += 1
+        if expected != local_label:
+            disagreements.append({"question": question, "llm": expected, "local": local_label,
+                                  "confidence": confidence})
+    total = len(questions)
+    agreed = total - len(disagreements)
+    return {
+        "total": total,
+        "agreement": agreed / total if total else 0.0,
+        "fallback_rate": low_confidence / total if total else 0.0,
+        "confusion": {f"llm={e},local={l}": n for (e, l), n in sorted(confusion.items())},
+        "disagreements": disagreements,
+    }
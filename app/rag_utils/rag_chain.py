@@ -1,14 +1,313 @@
-from .rag_module import get_rag_chain
+import asyncio
+import contextlib
+import json
+import os
+import time
+
+from . import metrics
+from .answer_cache import answer_cache, normalize_question
+from .context_packing import count_tokens
+from .query_classifier import detect_query_type
+from .structured_engine import StructuredQueryError, aask_sql, has_tables
+from .rag_module import (
+    get_embeddings, get_question_answering_chain, get_retriever, pack_retrieved_context, visible_roles,
+)
+from .summaries import find_summary
+
+
+# ==============================
+# ===== Concurrency / timeouts =====
+# ==============================
+# Upper bound on questions being answered at once by this worker. Requests
+# beyond the limit wait for a free slot instead of piling onto the OpenAI API.
+RAG_MAX_CONCURRENCY = int(os.getenv("RAG_MAX_CONCURRENCY", "16"))
+
+# Per-stage timeouts in seconds (0 disables the timeout for that stage).
+RAG_RETRIEVAL_TIMEOUT = float(os.getenv("RAG_RETRIEVAL_TIMEOUT", "15"))
+RAG_GENERATION_TIMEOUT = float(os.getenv("RAG_GENERATION_TIMEOUT", "60"))
+
+_rag_semaphore = asyncio.Semaphore(RAG_MAX_CONCURRENCY)
+# Questions currently retrieving or generating; background ingestion backs off
+# while this is above its threshold
+_questions_in_flight = 0
+
+
+def questions_in_flight() -> int:
+    return _questions_in_flight
+
+
+@contextlib.asynccontextmanager
+async def _question_slot():
+    global _questions_in_flight
+    async with _rag_semaphore:
+        _questions_in_flight += 1
+        try:
+            yield
+        finally:
+            _questions_in_flight -= 1
+
+
+# Generation calls in flight for one ask_rag_batch call
+RAG_BATCH_CONCURRENCY = int(os.getenv("RAG_BATCH_CONCURRENCY", "8"))
+
+
+async def _with_timeout(coro, timeout: float, stage: str):
+    if not timeout:
+        return await coro
+    try:
+        return await asyncio.wait_for(coro, timeout=timeout)
+    except asyncio.TimeoutError:
+        raise TimeoutError(f"RAG {stage} stage timed out after {timeout}s")
+
+
+async def retrieve_context(question: str, role: str, cohere_api_key: str = None):
+    # The retriever (and the optional reranker wrapped around it) is awaited
+    # through its async interface so the event loop is free during the search.
+    retriever = get_retriever(user_role=role, cohere_api_key=cohere_api_key)
+    docs = await _with_timeout(retriever.ainvoke(question), RAG_RETRIEVAL_TIMEOUT, "retrieval")
+    return pack_retrieved_context(docs)
+
+
+async def summary_answer(question: str, role: str):
+    # Summary questions naming one visible document are answered from the
+    # summaries built at index time: ``(answer, None)`` when the stored
+    # summary is the answer, ``(None, context)`` to generate from the much
+    # shorter summaries instead of retrieved chunks. None: use retrieval.
+    return await asyncio.to_thread(find_summary, question, visible_roles(role))
+
+
+async def lookup_cached_answer(question: str, role: str):
+    # Exact (role, normalized question) match first; only on a miss is the
+    # query embedded for the near-duplicate lookup. Returns the embedding too
+    # so the caller can store it with the fresh answer.
+    answer = answer_cache.get(role, question, record_miss=not answer_cache.semantic_enabled)
+    if answer is not None or not answer_cache.semantic_enabled:
+        metrics.cache_lookup("answer", "miss" if answer is None else "hit")
+        return answer, None
+    with metrics.stage("embed_query", purpose="answer_cache"):
+        embedding = await get_embeddings().aembed_query(question)
+    answer = answer_cache.get(role, question, embedding)
+    metrics.cache_lookup("answer", "miss" if answer is None else "semantic_hit")
+    return answer, embedding
+
+
+def _count_generation_tokens(question: str, context, answer: str):
+    # The stuff chain returns plain text, so usage is counted locally
+    metrics.count_tokens("generation", "prompt", count_tokens(question)
+                         + sum(count_tokens(doc.page_content) for doc in context))
+    metrics.count_tokens("generation", "completion", count_tokens(answer))
 
 
 async def ask_rag(question: str, role: str, cohere_api_key: str = None) -> dict:
-    chain = get_rag_chain(user_role=role, cohere_api_key=cohere_api_key)
-    result = chain.invoke({"input": question})
-    return {"answer": result["answer"]}
+    if metrics.trace_id.get() is None:
+        metrics.new_trace()
+    with metrics.stage("request", path="rag", role=role.lower()):
+        answer, embedding = await lookup_cached_answer(question, role)
+        if answer is not None:
+            return {"answer": answer}
+
+        summary = await summary_answer(question, role)
+        if summary and summary[0] is not None:
+            answer_cache.put(role, question, summary[0], embedding)
+            return {"answer": summary[0]}
+
+        async with _question_slot():
+            if summary:
+                context = pack_retrieved_context(summary[1])
+            else:
+                context = await retrieve_context(question, role, cohere_api_key)
+            with metrics.stage("generation"):
+                answer = await _with_timeout(
+                    get_question_answering_chain().ainvoke({"input": question, "context": context}),
+                    RAG_GENERATION_TIMEOUT,
+                    "generation",
+                )
+        _count_generation_tokens(question, context, answer)
+        answer_cache.put(role, question, answer, embedding)
+        return {"answer": answer}
 
     """
       # result now includes: {"context": [...], "answer": "..."}
     return {
         "answer": result["answer"],
         "context": result["context"]
-    }"""
\ No newline at end of file
+    }"""
+
+
+async def ask_rag_batch(questions, role: str, cohere_api_key: str = None,
+                        max_concurrency: int = RAG_BATCH_CONCURRENCY) -> list:
+    """Answer many questions for one role, sharing the expensive steps.
+
+    Identical questions (after normalization) are answered once. Cache
+    misses take the same summary route as ``ask_rag``; the rest are
+    embedded in one call and searched with one query per collection. Each
+    answer is then generated on its own, at most ``max_concurrency`` at a
+    time for this batch. Every generation also takes a slot of the
+    worker-wide RAG_MAX_CONCURRENCY limit, so it counts as a question in
+    flight for ingestion back-pressure. The retrieval and generation
+    timeouts apply as in ``ask_rag``. Returns one dict per input question,
+    in input order: ``{"answer": ...}`` or ``{"error": ...}``. A failure
+    only fails the items it concerns.
+    """
+    if metrics.trace_id.get() is None:
+        metrics.new_trace()
+    keys = [normalize_question(q) for q in questions]
+    unique = {}
+    for question, key in zip(questions, keys):
+        unique.setdefault(key, question)
+
+    results = {}
+    pending = []
+    for key, question in unique.items():
+        answer = answer_cache.get(role, question, record_miss=not answer_cache.semantic_enabled)
+        if answer is not None:
+            metrics.cache_lookup("answer", "hit")
+            results[key] = {"answer": answer}
+        else:
+            pending.append(key)
+
+    with metrics.stage("request", path="rag_batch", role=role.lower()):
+        vectors = []
+        if pending:
+            try:
+                # Query and document embeddings are the same model and space here
+                with metrics.stage("embed_query", purpose="batch"):
+                    vectors = await _with_timeout(get_embeddings().aembed_documents([unique[k] for k in pending]),
+                                                  RAG_RETRIEVAL_TIMEOUT, "retrieval")
+            except Exception as e:
+                results.update((k, {"error": f"embedding failed: {e}"}) for k in pending)
+                pending = []
+        embeddings = dict(zip(pending, vectors))
+
+        if pending and answer_cache.semantic_enabled:
+            still_pending = []
+            for key in pending:
+                answer = answer_cache.get(role, unique[key], embeddings[key])
+                metrics.cache_lookup("answer", "miss" if answer is None else "semantic_hit")
+                if answer is None:
+                    still_pending.append(key)
+                else:
+                    results[key] = {"answer": answer}
+            pending = still_pending
+
+        contexts = {}
+        if pending:
+            summaries = await asyncio.gather(*(summary_answer(unique[k], role) for k in pending))
+            to_retrieve = []
+            for key, summary in zip(pending, summaries):
+                if summary and summary[0] is not None:
+                    answer_cache.put(role, unique[key], summary[0], embeddings[key])
+                    results[key] = {"answer": summary[0]}
+                elif summary:
+                    contexts[key] = pack_retrieved_context(summary[1])
+                else:
+                    to_retrieve.append(key)
+            pending = [k for k in pending if k not in results]
+
+            if to_retrieve:
+                retriever = get_retriever(user_role=role, cohere_api_key=cohere_api_key)
+                try:
+                    # Bulk search and reranking block, so they run off the event loop
+                    async with _question_slot():
+                        retrieved = await _with_timeout(
+                            asyncio.to_thread(retriever.search_batch, [unique[k] for k in to_retrieve],
+                                              [embeddings[k] for k in to_retrieve]),
+                            RAG_RETRIEVAL_TIMEOUT, "retrieval",
+                        )
+                    contexts.update((k, pack_retrieved_context(docs)) for k, docs in zip(to_retrieve, retrieved))
+                except Exception as e:
+                    results.update((k, {"error": f"retrieval failed: {e}"}) for k in to_retrieve)
+                    pending = [k for k in pending if k not in results]
+
+        if pending:
+            chain = get_question_answering_chain()
+            batch_slots = asyncio.Semaphore(max(1, max_concurrency))
+
+            async def generate(key):
+                async with batch_slots, _question_slot():
+                    return await _with_timeout(chain.ainvoke({"input": unique[key], "context": contexts[key]}),
+                                               RAG_GENERATION_TIMEOUT, "generation")
+
+            with metrics.stage("generation_batch"):
+                answers = await asyncio.gather(*(generate(k) for k in pending), return_exceptions=True)
+            for key, answer in zip(pending, answers):
+                if isinstance(answer, Exception):
+                    results[key] = {"error": f"generation failed: {answer}"}
+                    continue
+                _count_generation_tokens(unique[key], contexts[key], answer)
+                answer_cache.put(role, unique[key], answer, embeddings[key])
+                results[key] = {"answer": answer}
+
+    return [dict(results[key]) for key in keys]
+
+
+async def answer_question(question: str, role: str, cohere_api_key: str = None) -> dict:
+    # Aggregates and lookups over tabular uploads go to the DuckDB engine for
+    # exact answers; everything else (or anything it cannot answer) to RAG.
+    # One trace id per question; asyncio.to_thread carries it into the classifier
+    metrics.new_trace()
+    route = await asyncio.to_thread(detect_query_type, question)
+    if route == "SQL" and await asyncio.to_thread(has_tables, role):
+        try:
+            with metrics.stage("request", path="sql", role=role.lower()):
+                result = await _with_timeout(aask_sql(question, role), RAG_GENERATION_TIMEOUT, "sql")
+            return {"answer": result["answer"]}
+        except StructuredQueryError:
+            metrics.event("sql_fallback")
+    return await ask_rag(question, role, cohere_api_key)
+
+
+async def ask_rag_stream(question: str, role: str, cohere_api_key: str = None):
+    # Same retrieval as ask_rag, but answer tokens are yielded as soon as the
+    # model produces them. The generation timeout applies to the wait for each
+    # token, so a long answer that keeps streaming is not cut off.
+    if metrics.trace_id.get() is None:
+        metrics.new_trace()
+    answer, embedding = await lookup_cached_answer(question, role)
+    if answer is not None:
+        yield answer
+        return
+
+    summary = await summary_answer(question, role)
+    if summary and summary[0] is not None:
+        answer_cache.put(role, question, summary[0], embedding)
+        yield summary[0]
+        return
+
+    parts = []
+    async with _question_slot():
+        started = time.perf_counter()
+        if summary:
+            context = pack_retrieved_context(summary[1])
+        else:
+            context = await retrieve_context(question, role, cohere_api_key)
+        generation_started = time.perf_counter()
+        tokens = get_question_answering_chain().astream({"input": question, "context": context})
+        first_token = True
+        while True:
+            try:
+                token = await _with_timeout(tokens.__anext__(), RAG_GENERATION_TIMEOUT, "generation")
+            except StopAsyncIteration:
+                break
+            if first_token:
+                first_token = False
+                metrics.observe_stage("time_to_first_token", time.perf_counter() - started)
+            parts.append(token)
+            yield token
+    metrics.observe_stage("generation", time.perf_counter() - generation_started)
+    metrics.observe_stage("request", time.perf_counter() - started, path="rag_stream", role=role.lower())
+    answer = "".join(parts)
+    _count_generation_tokens(question, context, answer)
+    answer_cache.put(role, question, answer, embedding)
+
+
+async def stream_rag_sse(question: str, role: str, cohere_api_key: str = None):
+    # Server-Sent Events framing for ask_rag_stream, meant to be returned as
+    # StreamingResponse(..., media_type="text/event-stream"). Tokens are JSON
+    # encoded so newlines inside markdown answers survive the framing.
+    try:
+        async for token in ask_rag_stream(question, role, cohere_api_key):
+            yield f"data: {json.dumps({'token': token})}\n\n"
+    except Exception as e:
+        yield f"event: error\ndata: {json.dumps({'detail': str(e)})}\n\n"
+    yield "event: done\ndata: {}\n\n"
@@ -1,58 +1,302 @@
 # ========== CONFIG ==========
 from pathlib import Path
 import os
-import pandas as pd
+import threading
 from collections import defaultdict
 from langchain_core.documents import Document
 import sqlite3
 
-
-from langchain_community.document_loaders import UnstructuredMarkdownLoader
-from langchain_text_splitters import RecursiveCharacterTextSplitter
-from langchain_community.vectorstores import Chroma
-from langchain_openai import ChatOpenAI, OpenAIEmbeddings
-
 # Core LangChain prompt templates
 from langchain_core.prompts import ChatPromptTemplate
 
-# Document combination chain
-from langchain.chains.combine_documents.stuff import create_stuff_documents_chain
+from . import index_state, metrics, summaries
+from .answer_cache import answer_cache
+from .indexing_pipeline import EmbeddingPipeline
+from .structured_engine import register_csv_table
+
+# The OpenAI clients, the Chroma collection and the stuff-documents chain are
+# built on first use (or by warm_up()) rather than at import time, so tools
+# that only need part of this module do not pay for all of it. The heavy
+# langchain/pandas imports are deferred into the builders for the same reason.
+_init_lock = threading.RLock()
+_components = {}
+
+
+def _lazy(name, factory):
+    component = _components.get(name)
+    if component is None:
+        with _init_lock:
+            component = _components.get(name)
+            if component is None:
+                component = factory()
+                _components[name] = component
+    return component
+
+
+# Send LangChain traces to the hosted LangSmith endpoint. Off by default: it
+# adds a network call per run and is unreachable from air-gapped deployments;
+# the local metrics module covers per-stage timings.
+RAG_REMOTE_TRACING = os.getenv("RAG_REMOTE_TRACING", "false").lower() == "true"
 
 
-# Retrieval chain (moved to langchain.chains)
-from langchain.chains import create_retrieval_chain
+def _configure_environment():
+    from .secret_key import openapi_key,langchain_key,cohere_api_key
 
-from .secret_key import openapi_key,langchain_key,cohere_api_key
+    if RAG_REMOTE_TRACING:
+        os.environ["LANGCHAIN_TRACING_V2"] = "true"
+        os.environ["LANGCHAIN_ENDPOINT"] = "https://api.smith.langchain.com"
+        os.environ["LANGCHAIN_PROJECT"] = "RAG"
+        os.environ["LANGCHAIN_API_KEY"] = langchain_key
+    os.environ["OPENAI_API_KEY"] = openapi_key
+    os.environ["COHERE_API_KEY"] = cohere_api_key
+    return True
 
 
+def configure_environment():
+    return _lazy("environment", _configure_environment)
 
-os.environ["LANGCHAIN_TRACING_V2"] = "true"
-os.environ["LANGCHAIN_ENDPOINT"] = "https://api.smith.langchain.com"
-os.environ["LANGCHAIN_PROJECT"] = "RAG"
-os.environ["LANGCHAIN_API_KEY"] = langchain_key
-os.environ["OPENAI_API_KEY"] = openapi_key
-os.environ["COHERE_API_KEY"] = cohere_api_key
+
+# Components built from the embeddings or the model; rebuilt after an override
+_DEPENDENT_COMPONENTS = ("vectorstore", "shards", "memmap_store", "snapshots", "lexical_index",
+                         "question_answering_chain")
+
+
+def override_components(**components):
+    # Swap in replacements (e.g. offline fakes for benchmarks) by component
+    # name: environment, embeddings, model, vectorstore, ...
+    with _init_lock:
+        for name in _DEPENDENT_COMPONENTS:
+            if name not in components:
+                _components.pop(name, None)
+        _components.update(components)
+        _chain_registry.clear()
 
 
 # ==============================
 # ====Split,load,embed==========
 # ==============================
 
-openai_embeddings = OpenAIEmbeddings(model="text-embedding-3-small")
-vectorstore = Chroma(
-    collection_name="my_collection",
-    persist_directory="chroma_db",
-    embedding_function=openai_embeddings
-)
+# Directory of the persistent embedding cache ("" disables it)
+EMBEDDING_MODEL = "text-embedding-3-small"
+EMBEDDING_CACHE_DIR = os.getenv("RAG_EMBEDDING_CACHE_DIR", "embedding_cache")
+
+
+def _build_embeddings():
+    from langchain_openai import OpenAIEmbeddings
+
+    configure_environment()
+    embeddings = OpenAIEmbeddings(model=EMBEDDING_MODEL)
+    if EMBEDDING_CACHE_DIR:
+        from .embedding_cache import CachedEmbeddings
+
+        embeddings = CachedEmbeddings(embeddings, EMBEDDING_MODEL, cache_dir=EMBEDDING_CACHE_DIR)
+    return embeddings
+
+
+def _build_vectorstore():
+    from langchain_community.vectorstores import Chroma
+
+    return Chroma(
+        collection_name="my_collection",
+        persist_directory="chroma_db",
+        embedding_function=get_embeddings()
+    )
+
+
+def get_embeddings():
+    return _lazy("embeddings", _build_embeddings)
+
+
+def get_vectorstore():
+    return _lazy("vectorstore", _build_vectorstore)
+
+
+def _build_shards():
+    from .vector_shards import ShardSet
+
+    vectorstore = get_vectorstore()
+    # Shards share the persistent client (and so the chroma_db directory)
+    shards = ShardSet(vectorstore._client, get_embeddings(), vectorstore._collection.name)
+    if partitioned() and not shards.roles() and vectorstore._collection.count():
+        # First start with partitioning on: move the existing index over once
+        copied = shards.partition_existing(vectorstore._collection)
+        print(f"Copied {copied} chunks into per-role collections.")
+    return shards
+
+
+def get_shards():
+    return _lazy("shards", _build_shards)
+
+
+def partitioned():
+    from .vector_shards import RAG_PARTITIONED_COLLECTIONS
+
+    return RAG_PARTITIONED_COLLECTIONS
+
+
+def _build_memmap_store():
+    from .numpy_store import MemmapVectorStore
+
+    store = MemmapVectorStore()
+    if not store.count() and Path("chroma_db").exists() and get_vectorstore()._collection.count():
+        # First start on the numpy backend: copy the Chroma index over once
+        copied = store.import_collection(get_vectorstore()._collection)
+        print(f"Copied {copied} chunks into the memory-mapped vector store.")
+    return store
+
+
+def get_memmap_store():
+    return _lazy("memmap_store", _build_memmap_store)
+
+
+def memmap_backend():
+    from .numpy_store import RAG_VECTOR_BACKEND
+
+    return RAG_VECTOR_BACKEND in ("numpy", "snapshot")
+
+
+def snapshot_serving():
+    # Workers search read-only snapshots; indexing still writes the live store
+    from .numpy_store import RAG_VECTOR_BACKEND
+
+    return RAG_VECTOR_BACKEND == "snapshot"
+
+
+def _on_snapshot_swap(manager):
+    # A newer snapshot (possibly from another process) is being served: what
+    # was derived from the old one is rebuilt
+    with _init_lock:
+        serving = bool(_chain_registry)
+        _components.pop("lexical_index", None)
+        _chain_registry.clear()
+    answer_cache.clear()
+    if serving:
+        # Rebuild the chains before the next questions need them
+        prewarm_rag_chains()
+
+
+def _build_snapshots():
+    from .snapshots import SnapshotManager, publish_snapshot
+
+    manager = SnapshotManager(on_swap=_on_snapshot_swap)
+    if manager.version is None and get_memmap_store().count():
+        # First start in snapshot mode: publish what is already indexed
+        publish_snapshot(get_memmap_store())
+        manager.refresh()
+    return manager.start()
+
+
+def get_snapshots():
+    return _lazy("snapshots", _build_snapshots)
+
+
+def _search_store():
+    # What retrievers search: the live store, or the current snapshot of it
+    return get_snapshots() if snapshot_serving() else get_memmap_store()
+
+
+def _vector_collections():
+    # Every collection holding chunks under the current storage layout
+    if memmap_backend():
+        store = _search_store().current()
+        return [store] if store is not None else []
+    return get_shards().collections() if partitioned() else [get_vectorstore()._collection]
+
+
+def vector_count():
+    return sum(collection.count() for collection in _vector_collections())
+
+
+def delete_chunks(ids):
+    if memmap_backend():
+        get_memmap_store().delete(ids)
+    elif partitioned():
+        get_shards().delete(ids)
+    else:
+        get_vectorstore().delete(ids=ids)
+
+
+def new_pipeline(**kwargs):
+    if memmap_backend():
+        # The memory-mapped store takes the collection's place; Chroma is not opened
+        store = get_memmap_store()
+        return EmbeddingPipeline(None, get_embeddings(), collection_for=lambda doc: store, **kwargs)
+    # Writes go to the role's shard when collections are partitioned
+    collection_for = get_shards().collection_for if partitioned() else None
+    return EmbeddingPipeline(get_vectorstore(), get_embeddings(), collection_for=collection_for, **kwargs)
+
+
+# Split .md files along their headings instead of fixed 1000-char windows
+MARKDOWN_SPLITTER = os.getenv("RAG_MARKDOWN_SPLITTER", "true").lower() == "true"
+TEXT_CHUNK_SIZE = 1000
+TEXT_CHUNK_OVERLAP = 200
+# Bump when a loader or splitter changes the chunks it produces
+CHUNKER_REVISION = 3
+
+
+def chunker_version() -> str:
+    # Part of every stored file digest: files chunked under other settings
+    # count as changed and are split and embedded again
+    from .markdown_splitter import MARKDOWN_CHUNK_CHARS, MARKDOWN_MIN_CHUNK_CHARS
+
+    config = (CHUNKER_REVISION, MARKDOWN_SPLITTER, MARKDOWN_CHUNK_CHARS, MARKDOWN_MIN_CHUNK_CHARS,
+              TEXT_CHUNK_SIZE, TEXT_CHUNK_OVERLAP)
+    return index_state.content_hash(repr(config))[:12]
+
+
+def file_digest(filepath) -> str:
+    return f"{index_state.file_hash(filepath)}:{chunker_version()}"
+
+
+def split_documents(docs):
+    from langchain_text_splitters import RecursiveCharacterTextSplitter
+
+    from .markdown_splitter import split_markdown
+
+    splits, others = [], []
+    for doc in docs:
+        if MARKDOWN_SPLITTER and str(doc.metadata.get("source", "")).lower().endswith(".md"):
+            splits.extend(split_markdown(doc))
+        else:
+            others.append(doc)
+    if others:
+        text_splitter = RecursiveCharacterTextSplitter(chunk_size=TEXT_CHUNK_SIZE, chunk_overlap=TEXT_CHUNK_OVERLAP)
+        splits.extend(text_splitter.split_documents(others))
+    return splits
 
 
 def embed_documents_to_vectorstore(docs):
-    text_splitter = RecursiveCharacterTextSplitter(chunk_size=1000, chunk_overlap=200)
-    splits = text_splitter.split_documents(docs)
-    vectorstore.add_documents(splits)
-    
+    # Split whole Documents and add them to the vector store. Files should go
+    # through run_indexer instead; chunks added here are still recorded in
+    # indexed_chunks and the lexical index, so they can be found and removed
+    # like indexed ones. Ids are keyed on the loaded file's path as run_indexer
+    # keys them, so adding the same documents twice, or documents of a file
+    # that was already indexed, does not duplicate them.
+    lexical_index = _components.get("lexical_index")
+    conn = index_state.connect()
+
+    def record_batch(batch):
+        index_state.record_chunks(conn, [(chunk_id, *info) for chunk_id, _, info in batch])
+        if lexical_index is not None:
+            lexical_index.add_many((chunk_id, chunk) for chunk_id, chunk, _ in batch)
+        conn.commit()
+
+    assigners = {}
+    try:
+        with new_pipeline(on_batch_written=record_batch) as pipeline:
+            for chunk in split_documents(docs):
+                # Documents built by hand have no filepath; their source stands in
+                filepath = chunk.metadata.get("filepath") or chunk.metadata.get("source", "")
+                role = chunk.metadata.get("role", "general")
+                assigner = assigners.setdefault((filepath, role), index_state.ChunkIdAssigner(filepath, role))
+                chunk_id, chunk_hash = assigner.assign(chunk.page_content)
+                chunk.metadata["chunk_id"] = chunk_id
+                pipeline.add(chunk_id, chunk, (filepath, role, chunk_hash))
+    finally:
+        conn.close()
+
     print("Documents embedded and saved to vectorstore.")
-    print("Total documents:", len(vectorstore.get()["documents"]))
+    print("Total documents:", vector_count())
     #print("Chunks being added:")
     #for chunk in splits:
     #    print(f"---\n{chunk.page_content[:150]}...\nMetadata: {chunk.metadata}")
@@ -60,21 +304,50 @@ def embed_documents_to_vectorstore(docs):
 
 
 
-def load_file(filepath, role):
+# Rows read from a CSV per pandas chunk; bounds loader memory for large exports
+CSV_CHUNK_ROWS = int(os.getenv("RAG_CSV_CHUNK_ROWS", "10000"))
+
+
+def iter_csv_documents(filepath, role, chunksize=CSV_CHUNK_ROWS, usecols=None, dtype=None,
+                       rows_per_document=1):
+    """Yield Documents from a CSV lazily, ``chunksize`` rows at a time.
+
+    ``usecols`` and ``dtype`` are passed to ``pd.read_csv`` (column selection
+    and dtype hints; ``dtype=str`` skips type inference entirely). Each
+    Document covers ``rows_per_document`` rows and records them as
+    ``row_start``/``row_end`` (0-based, inclusive) in its metadata.
+    """
+    import pandas as pd
+
+    source = Path(filepath).name
+    filepath = str(filepath)
+    row = 0
+    for frame in pd.read_csv(filepath, chunksize=chunksize, usecols=usecols, dtype=dtype):
+        columns = list(frame.columns)
+        lines, start = [], row
+        for values in frame.itertuples(index=False, name=None):
+            lines.append("\n".join(f"{k}: {v}" for k, v in zip(columns, values)))
+            row += 1
+            if len(lines) == rows_per_document:
+                yield _csv_document(lines, role, source, start, row - 1, filepath)
+                lines, start = [], row
+        if lines:
+            yield _csv_document(lines, role, source, start, row - 1, filepath)
+
+
+def _csv_document(lines, role, source, row_start, row_end, filepath):
+    return Document(
+        page_content="\n\n".join(lines),
+        metadata={"role": role.lower(), "source": source, "filepath": filepath,
+                  "row_start": row_start, "row_end": row_end}
+    )
+
+
+def load_file(filepath, role, **csv_options):
     ext = Path(filepath).suffix.lower()
     try:
         if ext == ".csv":
-            df1 = pd.read_csv(filepath)
-            documents = []
-            for row in df1.to_dict(orient="records"):
-                content = "\n".join(f"{k}: {v}" for k, v in row.items())
-                documents.append(
-                    Document(
-                        page_content=content,
-                        metadata={"role": role.lower(), "source": Path(filepath).name}
-                    )
-                )
-            return documents  # Return a list of documents
+            return list(iter_csv_documents(filepath, role, **csv_options))  # Return a list of documents
 
         elif ext == ".md":
             with open(filepath, "r", encoding="utf-8") as f:
@@ -82,7 +355,7 @@ def load_file(filepath, role):
             return [
                 Document(
                     page_content=content,
-                    metadata={"role": role.lower(), "source": Path(filepath).name}
+                    metadata={"role": role.lower(), "source": Path(filepath).name, "filepath": str(filepath)}
                 )
             ]
         else:
@@ -93,30 +366,224 @@ def load_file(filepath, role):
         return None
 
 
+def iter_file_documents(filepath, role, **csv_options):
+    if Path(filepath).suffix.lower() == ".csv":
+        # CSV exports can be far larger than memory allows as one list
+        yield from iter_csv_documents(filepath, role, **csv_options)
+        return
+    docs = load_file(filepath, role)
+    if not docs:
+        return
+    yield from (docs if isinstance(docs, list) else [docs])
+
+
+def iter_file_chunks(filepath, role):
+    # Split one loaded Document at a time so a file is never held as chunks
+    for doc in iter_file_documents(filepath, role):
+        yield from split_documents([doc])
+
+
+def stream_file(conn, pipeline, filepath, role, errors=None):
+    """Feed the chunks of one file that are not in the vector store yet to the pipeline.
+
+    Returns ``(file_digest, stale_ids, new_count)``, ``(None, [], 0)`` when
+    neither the file nor the chunker settings changed since it was last
+    indexed, or ``None`` if it could not be read (the reason is stored in
+    ``errors[filepath]`` when given).
+    """
+    errors = {} if errors is None else errors
+    try:
+        digest = file_digest(filepath)
+    except OSError as e:
+        print(f"Failed to process {filepath}: {e}")
+        errors[filepath] = str(e)
+        return None
+    if index_state.is_file_unchanged(conn, filepath, role, digest):
+        return None, [], 0
+
+    existing = index_state.stored_chunk_ids(conn, filepath)
+    assigner = index_state.ChunkIdAssigner(filepath, role)
+    seen = set()
+    new_count = 0
+    try:
+        for chunk in iter_file_chunks(filepath, role):
+            chunk_id, chunk_hash = assigner.assign(chunk.page_content)
+            seen.add(chunk_id)
+            if chunk_id in existing:
+                continue
+            chunk.metadata["chunk_id"] = chunk_id
+            pipeline.add(chunk_id, chunk, (filepath, role, chunk_hash))
+            new_count += 1
+    except Exception as e:
+        # Chunks already handed to the pipeline are kept; the file stays pending
+        print(f"Failed to process {filepath}: {e}")
+        errors[filepath] = str(e)
+        return None
+    if not seen:
+        # Nothing could be loaded; leave the row pending like before
+        errors[filepath] = "no content could be loaded (unsupported or empty file)"
+        return None
+    return digest, sorted(existing - seen), new_count
+
+
 def run_indexer():
-    conn = sqlite3.connect("roles_docs.db")
+    conn = index_state.connect()
+    index_state.release_stale_jobs(conn)
+    index_state.requeue_outdated_files(conn, chunker_version())
     c = conn.cursor()
-    c.execute("SELECT id, filepath, role FROM documents WHERE embedded = 0")
-    
-    all_docs = []
+    # Files that already failed RAG_INDEX_MAX_ATTEMPTS times are not retried,
+    # and files the ingestion worker is indexing right now are left to it
+    c.execute("SELECT id, filepath, role FROM documents WHERE embedded = 0 AND attempts < ?"
+              " AND status NOT IN ('loading', 'embedding')",
+              (index_state.RAG_INDEX_MAX_ATTEMPTS,))
+    pending = index_state.claim_documents(conn, c.fetchall(), claimable=("pending", "done", "failed"))
+    conn.commit()
+    try:
+        index_documents(conn, pending)
+    except BaseException:
+        # Hand the files this run had not finished back to the queue
+        conn.rollback()
+        conn.executemany(
+            "UPDATE documents SET status = 'pending' WHERE id = ? AND status IN ('loading', 'embedding')",
+            [(row[0],) for row in pending],
+        )
+        raise
+    finally:
+        conn.commit()
+        conn.close()
+
+
+def index_documents(conn, pending, before_batch=None, **pipeline_options):
+    """Index ``(id, filepath, role)`` rows of the documents table in one pipeline pass.
 
-    for doc_id, path, role in c.fetchall():
-        docs = load_file(path, role)
-        if docs:
-            if isinstance(docs, list):
-                all_docs.extend(docs)
-            else:
-                all_docs.append(docs)
+    Chunks of all the files share embedding batches. Each row's job status
+    is updated and committed as it moves through loading, embedding and
+    done or failed. ``before_batch`` is called before each embedding batch
+    is submitted; the background worker uses it to yield to chat traffic.
+    Returns the totals.
 
-            # Mark this file as embedded
-            c.execute("UPDATE documents SET embedded = 1 WHERE id = ?", (doc_id,))
+    Progress is checkpointed: every written batch commits its chunk records,
+    so a crash or API error costs at most the batches in flight. The next
+    run skips the chunks already recorded and embeds only the rest. A file
+    whose batch fails is counted as a failed attempt and retried later, up
+    to RAG_INDEX_MAX_ATTEMPTS. The other files carry on.
 
-    if all_docs:
-        embed_documents_to_vectorstore(all_docs)
+    A file with several pending rows (uploaded again before it was indexed)
+    is indexed once, with the role of its latest row; the other rows share
+    that row's outcome.
+    """
+    latest = {}
+    for row in pending:
+        latest[str(row[1])] = row
+    duplicates = defaultdict(list)
+    for doc_id, path, _ in pending:
+        if latest[str(path)][0] != doc_id:
+            duplicates[latest[str(path)][0]].append(doc_id)
+
+    totals = {"added": 0, "deleted": 0, "failed": 0}
+    errors = {}
+    failed_batches = {}  # filepath -> error of a batch that could not be embedded or written
+    changed_roles = set()
+
+    # Keep the in-memory lexical index current if this process has one loaded
+    lexical_index = _components.get("lexical_index")
+
+    def record_batch(batch):
+        index_state.record_chunks(conn, [(chunk_id, *info) for chunk_id, _, info in batch])
+        if lexical_index is not None:
+            lexical_index.add_many((chunk_id, chunk) for chunk_id, chunk, _ in batch)
+        # Renew the lease on this pass's jobs, so no other indexer takes them over
+        index_state.touch_documents(conn, [row[0] for row in pending])
+        # Checkpoint: written chunks survive a crash and are not embedded again
         conn.commit()
 
-    conn.close()
-    print(f"Indexed {len(all_docs)} document chunks.")
+    def batch_failed(batch, error):
+        print(f"Embedding batch of {len(batch)} chunks failed: {error}")
+        for _, _, (path, _, _) in batch:
+            failed_batches.setdefault(path, str(error))
+
+    def set_status(doc_id, status):
+        for row_id in [doc_id, *duplicates[doc_id]]:
+            index_state.set_document_status(conn, row_id, status)
+        conn.commit()
+
+    def fail(doc_id, path, error):
+        for row_id in [doc_id, *duplicates[doc_id]]:
+            status = index_state.record_failure(conn, row_id, error)
+        conn.commit()
+        totals["failed"] += 1
+        print(f"Indexing {path} failed ({'giving up' if status == 'failed' else 'will retry'}): {error}")
+
+    def finalize(doc_id, path, role, digest, stale, new_count):
+        # Runs once every new chunk of the file has been written (or failed)
+        if path in failed_batches:
+            # Chunks of the file that were written stay recorded; a retry
+            # embeds only the missing ones and then removes the stale ones
+            fail(doc_id, path, failed_batches[path])
+            return
+        if stale:
+            delete_chunks(stale)
+            index_state.forget_chunks(conn, stale)
+            if lexical_index is not None:
+                lexical_index.remove(stale)
+        if digest:
+            index_state.record_file(conn, path, role, digest)
+        if stale or new_count:
+            changed_roles.add(role.lower())
+        totals["added"] += new_count
+        totals["deleted"] += len(stale)
+
+        # Mark this file as embedded
+        chunks = len(index_state.stored_chunk_ids(conn, path))
+        for row_id in [doc_id, *duplicates[doc_id]]:
+            conn.execute("UPDATE documents SET embedded = 1 WHERE id = ?", (row_id,))
+            index_state.set_document_status(conn, row_id, "done", chunks=chunks)
+        conn.commit()
+
+    with new_pipeline(on_batch_written=record_batch, on_batch_failed=batch_failed,
+                      before_batch=before_batch, **pipeline_options) as pipeline:
+        for doc_id, path, role in latest.values():
+            set_status(doc_id, "loading")
+            if Path(path).suffix.lower() == ".csv":
+                # Tabular uploads also feed the DuckDB engine behind the SQL route
+                try:
+                    register_csv_table(conn, path, role)
+                except Exception as e:
+                    print(f"Failed to register {path} for SQL queries: {e}")
+            result = stream_file(conn, pipeline, path, role, errors)
+            if result is None:
+                fail(doc_id, path, errors.get(path, "could not be read"))
+                continue
+            set_status(doc_id, "embedding")
+            pipeline.after_pending(lambda args=(doc_id, path, role, *result): finalize(*args))
+
+    if summaries.RAG_SUMMARIES:
+        # Once per new document version: map-reduce the file into section and
+        # document summaries for summary questions
+        try:
+            summaries.refresh_summaries(conn, get_summary_model, iter_file_chunks, before_batch=before_batch)
+        except Exception as e:
+            print(f"Summarizing documents failed: {e}")
+
+    if memmap_backend() and totals["deleted"]:
+        removed = get_memmap_store().compact_if_needed()
+        if removed:
+            print(f"Compacted the vector store: {removed} deleted rows dropped.")
+
+    if snapshot_serving() and (changed_roles or get_snapshots().version is None):
+        # Workers in every process pick the new version up on their next poll
+        from .snapshots import publish_snapshot
+
+        publish_snapshot(get_memmap_store())
+        get_snapshots().refresh()
+
+    if changed_roles:
+        # Cached answers of roles that can see the changed documents are now stale
+        answer_cache.invalidate_for_document_roles(changed_roles)
+        invalidate_rag_chains()
+    print(f"Indexed {totals['added']} new chunks, removed {totals['deleted']} stale chunks.")
+    print("Total chunks in vectorstore:", vector_count())
+    return totals
 
 
 # ==============================
@@ -142,53 +609,230 @@ chat_prompt = ChatPromptTemplate.from_messages([
 # ==============================
 # ========== MODEL ==========
 # ==============================
-model = ChatOpenAI(
-    model="gpt-4o",  
-    temperature=0.2
-)
+def _build_model():
+    from langchain_openai import ChatOpenAI
+
+    configure_environment()
+    return ChatOpenAI(
+        model="gpt-4o",  
+        temperature=0.2
+    )
+
+
+def _build_question_answering_chain():
+    # Document combination chain
+    from langchain.chains.combine_documents.stuff import create_stuff_documents_chain
+
+    return create_stuff_documents_chain(get_model(), chat_prompt)
+
+
+def _build_summary_model():
+    from langchain_openai import ChatOpenAI
 
-question_answering_chain = create_stuff_documents_chain(model, chat_prompt)
+    configure_environment()
+    return ChatOpenAI(model=summaries.RAG_SUMMARY_MODEL, temperature=0)
+
+
+def get_model():
+    return _lazy("model", _build_model)
+
+
+def get_summary_model():
+    # Index-time section/document summaries (see summaries.py)
+    return _lazy("summary_model", _build_summary_model)
+
+
+def get_question_answering_chain():
+    return _lazy("question_answering_chain", _build_question_answering_chain)
 
 # ==============================
 # Add a Reranker
 # ==============================
-def wrap_with_reranker(retriever, cohere_api_key, top_n=4):
-    #print("[INFO] Using Cohere reranker.")
-    reranker = CohereRerank(cohere_api_key=cohere_api_key, top_n=top_n)
-    return ContextualCompressionRetriever(
-        base_compressor=reranker,
-        base_retriever=retriever
+def get_reranker(cohere_api_key: str = None):
+    from .reranker import RAG_RERANKER, CohereReranker, LexicalReranker
+
+    if cohere_api_key:
+        print("Using cohere reranker")
+        return CohereReranker(cohere_api_key)
+    if RAG_RERANKER == "lexical":
+        return LexicalReranker()
+    if RAG_RERANKER == "cohere":
+        configure_environment()
+        return CohereReranker(os.environ["COHERE_API_KEY"])
+    return None
+
+
+def wrap_with_reranker(retriever, reranker, top_n=4):
+    from .reranker import RerankingRetriever
+
+    return RerankingRetriever(
+        base_retriever=retriever, reranker=reranker, top_n=top_n, budget_ms=reranker.budget_ms
     )
 
-def get_rag_chain(user_role: str,cohere_api_key: str = None):
-    user_role = user_role.lower()
+# Chunks returned by retrieval (context packing then fits them to the token
+# budget, so fewer may reach the LLM), and candidates fetched per retriever
+# before fusion
+RAG_TOP_K = int(os.getenv("RAG_TOP_K", "8"))
+RAG_FETCH_K = int(os.getenv("RAG_FETCH_K", "8"))
+# Fuse vector search with the in-memory BM25 index (exact ids, quarters, codes)
+RAG_HYBRID = os.getenv("RAG_HYBRID", "true").lower() == "true"
+
+
+def _build_lexical_index():
+    from .lexical_index import LexicalIndex
+
+    # Loaded once from the collection; afterwards kept current by run_indexer
+    index = LexicalIndex()
+    for collection in _vector_collections():
+        offset, page = 0, 1000
+        while True:
+            rows = collection.get(include=["documents", "metadatas"], limit=page, offset=offset)
+            for chunk_id, text, metadata in zip(rows["ids"], rows["documents"], rows["metadatas"]):
+                index.add(chunk_id, Document(page_content=text, metadata={**(metadata or {}), "chunk_id": chunk_id}))
+            if len(rows["ids"]) < page:
+                break
+            offset += page
+    print(f"Lexical index loaded with {len(index)} chunks.")
+    return index
+
 
+def get_lexical_index():
+    return _lazy("lexical_index", _build_lexical_index)
+
+
+def visible_roles(user_role: str):
+    # Roles whose documents user_role may retrieve; None means all of them
+    user_role = user_role.lower()
     if user_role == "c-level":
+        return None
+    if user_role == "general":
+        return ["general"]
+    return [user_role, "general"]
+
+
+def _build_retriever(user_role: str, cohere_api_key: str = None):
+
+    from .reranker import RAG_RERANK_FETCH_K
+
+    reranker = get_reranker(cohere_api_key)
+    # With a reranker, over-fetch candidates and let it pick the final top-k
+    candidates = RAG_RERANK_FETCH_K if reranker else RAG_TOP_K
+    k = max(RAG_FETCH_K, candidates) if RAG_HYBRID else candidates
+
+    from .vector_shards import ShardedRetriever
+
+    # The query is embedded once and the search timed on its own
+    if memmap_backend():
+        from .numpy_store import MemmapRetriever
+
+        # Exact top-k over the memory-mapped matrix; the role bitmask does the filtering
+        retriever = MemmapRetriever(
+            store=_search_store(), embeddings=get_embeddings(), k=k, roles=visible_roles(user_role)
+        )
+
+    elif partitioned():
+        # One collection per visible role, searched concurrently; no filter needed
+        retriever = ShardedRetriever(
+            shards=get_shards().stores_for(visible_roles(user_role)),
+            embeddings=get_embeddings(),
+            k=k,
+        )
+
+    elif user_role == "c-level":
         # C-level sees everything
-        retriever = vectorstore.as_retriever(search_kwargs={"k": 4})
+        retriever = ShardedRetriever(shards=[get_vectorstore()], embeddings=get_embeddings(), k=k)
 
     elif user_role == "general":
         # General role sees only general documents
-        retriever = vectorstore.as_retriever(search_kwargs={
-            "k": 4,
-            "filter": {"role": "general"}
-        })
+        retriever = ShardedRetriever(
+            shards=[get_vectorstore()], embeddings=get_embeddings(), k=k,
+            filter={"role": "general"}
+        )
 
     else:
         # All other roles see their docs + general
-        retriever = vectorstore.as_retriever(search_kwargs={
-            "k": 4,
-            "filter": {
+        retriever = ShardedRetriever(
+            shards=[get_vectorstore()], embeddings=get_embeddings(), k=k,
+            filter={
                 "role": {"$in": [user_role, "general"]}
             }
-        })
+        )
+
+    if RAG_HYBRID:
+        from .lexical_index import HybridRetriever
+
+        retriever = HybridRetriever(
+            vector_retriever=retriever,
+            lexical_index=get_lexical_index(),
+            roles=visible_roles(user_role),
+            k=candidates,
+            fetch_k=k,
+        )
 
     # wrap with reranker
-    if cohere_api_key:
-        print("Using cohere reranker")
-        retriever = wrap_with_reranker(retriever, cohere_api_key)
+    if reranker:
+        retriever = wrap_with_reranker(retriever, reranker, top_n=RAG_TOP_K)
+
+    return retriever
+
+
+# ==============================
+# ===== Chain registry =====
+# ==============================
+# One retriever + retrieval chain per (role, reranker config), built once and
+# shared by every request. Entries are dropped when the index changes or a
+# role is created, and rebuilt on the next use (or by prewarm_rag_chains).
+_chain_registry = {}
+
+
+def pack_retrieved_context(docs):
+    from .context_packing import pack_context
+
+    with metrics.stage("context_packing") as extra:
+        packed, stats = pack_context(docs)
+        extra.update(kept=stats["kept"], candidates=stats["candidates"], tokens=stats["tokens_out"])
+    metrics.context_tokens.observe(stats["tokens_out"])
+    metrics.count_tokens("context_packing", "kept", stats["tokens_out"])
+    metrics.count_tokens("context_packing", "baseline", stats["tokens_baseline"])
+    metrics.count_tokens("context_packing", "saved", max(0, stats["tokens_saved"]))
+    return packed
+
+
+def _build_registry_entry(user_role: str, cohere_api_key: str = None):
+    from langchain_core.runnables import RunnableLambda
+
+    # Retrieval chain (moved to langchain.chains)
+    from langchain.chains import create_retrieval_chain
+
+    retriever = _build_retriever(user_role, cohere_api_key)
+    # create_retrieval_chain only extracts "input" for plain retrievers
+    packed_retriever = (
+        RunnableLambda(lambda x: x["input"]) | retriever | RunnableLambda(pack_retrieved_context)
+    )
+    return {
+        "retriever": retriever,
+        "chain": create_retrieval_chain(packed_retriever, get_question_answering_chain()),
+    }
 
-    return create_retrieval_chain(retriever, question_answering_chain)
+
+def _registry_entry(user_role: str, cohere_api_key: str = None):
+    key = (user_role.lower(), cohere_api_key or None)
+    entry = _chain_registry.get(key)
+    if entry is None:
+        with _init_lock:
+            entry = _chain_registry.get(key)
+            if entry is None:
+                entry = _build_registry_entry(key[0], cohere_api_key)
+                _chain_registry[key] = entry
+    return entry
+
+
+def get_retriever(user_role: str, cohere_api_key: str = None):
+    return _registry_entry(user_role, cohere_api_key)["retriever"]
+
+
+def get_rag_chain(user_role: str,cohere_api_key: str = None):
+    return _registry_entry(user_role, cohere_api_key)["chain"]
     """
     from langchain_core.runnables import RunnableLambda, RunnableMap
 
@@ -200,6 +844,73 @@ def get_rag_chain(user_role: str,cohere_api_key: str = None):
     })"""
 
 
+def invalidate_rag_chains():
+    with _init_lock:
+        _chain_registry.clear()
+
+
+def known_roles(db_path="roles_docs.db"):
+    roles = {"c-level", "general"}
+    try:
+        conn = sqlite3.connect(db_path)
+        try:
+            rows = conn.execute("SELECT DISTINCT role FROM documents").fetchall()
+        finally:
+            conn.close()
+        roles.update(r[0].lower() for r in rows if r[0])
+    except sqlite3.Error as e:
+        print(f"Could not read roles from {db_path}: {e}")
+    return sorted(roles)
+
+
+def prewarm_rag_chains(roles=None, cohere_api_key: str = None):
+    # Build chains ahead of the first question for every role we know about
+    for role in roles or known_roles():
+        _registry_entry(role, cohere_api_key)
+
+
+def register_role(role: str):
+    # Call after a role is created (admin tab) so its chain is ready
+    if partitioned():
+        get_shards().store(role)
+    invalidate_rag_chains()
+    prewarm_rag_chains(known_roles() + [role.lower()])
+
+
+# ==============================
+# ========== STARTUP ==========
+# ==============================
+def warm_up():
+    # Build every lazily created component up front. Meant to be called by the
+    # server once it is bound (e.g. from a startup hook via asyncio.to_thread),
+    # so the first question does not pay for client construction.
+    configure_environment()
+    get_embeddings()
+    if snapshot_serving():
+        get_snapshots()
+    elif memmap_backend():
+        get_memmap_store()
+    else:
+        get_vectorstore()
+    get_question_answering_chain()
+    prewarm_rag_chains()
+
+
+# Old module-level names, resolved lazily for callers that still import them
+_LEGACY_COMPONENTS = {
+    "openai_embeddings": get_embeddings,
+    "vectorstore": get_vectorstore,
+    "model": get_model,
+    "question_answering_chain": get_question_answering_chain,
+}
+
+
+def __getattr__(name):
+    if name in _LEGACY_COMPONENTS:
+        return _LEGACY_COMPONENTS[name]()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+
 """
 # ========== MAIN EXECUTION ==========
 if __name__ == "__main__":
@@ -0,0 +1,207 @@
+import asyncio
+import math
+import os
+import threading
+from collections import Counter, OrderedDict
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from typing import Any
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.retrievers import BaseRetriever
+
+from . import metrics
+from .lexical_index import document_key, tokenize
+
+
+# ==============================
+# ========== CONFIG ==========
+# ==============================
+# "lexical" (local, default), "cohere" (needs an API key) or "none"
+RAG_RERANKER = os.getenv("RAG_RERANKER", "lexical").lower()
+# Candidates fetched before reranking down to the final top-k
+RAG_RERANK_FETCH_K = int(os.getenv("RAG_RERANK_FETCH_K", "20"))
+# Per-request reranking budget; over budget the retriever order is kept
+RAG_RERANK_BUDGET_MS = float(os.getenv("RAG_RERANK_BUDGET_MS", "50"))
+RAG_REMOTE_RERANK_BUDGET_MS = float(os.getenv("RAG_REMOTE_RERANK_BUDGET_MS", "1500"))
+RAG_RERANK_CACHE_SIZE = int(os.getenv("RAG_RERANK_CACHE_SIZE", "50000"))
+
+
+class Reranker:
+    """Scores a batch of candidate chunks against a query (higher is better).
+
+    Scores must depend only on (query, chunk) so they can be cached.
+    ``rank_prior`` is the weight the retriever's original order keeps in the
+    final ranking.
+    """
+
+    name = "base"
+    rank_prior = 0.0
+    budget_ms = RAG_RERANK_BUDGET_MS
+
+    def score(self, query: str, docs) -> list:
+        raise NotImplementedError
+
+
+class LexicalReranker(Reranker):
+    """Feature-based local reranker.
+
+    Blends query-term coverage, a saturated term-frequency score, exact
+    matches of id-like tokens (e.g. FINEMP1006, Q3), query bigram matches
+    and a source-name match. Its rank prior keeps a share of the retriever
+    order, so it refines that order instead of replacing it.
+    """
+
+    name = "lexical"
+    rank_prior = 0.8
+
+    def __init__(self, weights=None):
+        self.weights = weights or {"coverage": 1.0, "tf": 0.5, "exact_id": 1.0, "bigram": 0.5, "source": 0.3}
+
+    def score(self, query: str, docs) -> list:
+        terms = tokenize(query)
+        unique = set(terms)
+        id_terms = {t for t in unique if any(c.isdigit() for c in t)}
+        bigrams = set(zip(terms, terms[1:]))
+        w = self.weights
+        scores = []
+        for doc in docs:
+            tokens = tokenize(doc.page_content)
+            counts = Counter(tokens)
+            matched = unique & counts.keys()
+            coverage = len(matched) / len(unique) if unique else 0.0
+            tf = sum(counts[t] / (counts[t] + 1.5) for t in matched) / len(unique) if unique else 0.0
+            exact_id = len(id_terms & matched) / len(id_terms) if id_terms else 0.0
+            doc_bigrams = set(zip(tokens, tokens[1:])) if bigrams else set()
+            bigram = len(bigrams & doc_bigrams) / len(bigrams) if bigrams else 0.0
+            source = set(tokenize(str(doc.metadata.get("source", ""))))
+            source_match = len(unique & source) / len(unique) if unique else 0.0
+            scores.append(
+                w["coverage"] * coverage + w["tf"] * tf + w["exact_id"] * exact_id
+                + w["bigram"] * bigram + w["source"] * source_match
+            )
+        return scores
+
+
+class CohereReranker(Reranker):
+    """Cohere rerank endpoint behind the same interface (remote call)."""
+
+    name = "cohere"
+    budget_ms = RAG_REMOTE_RERANK_BUDGET_MS
+
+    def __init__(self, api_key: str, model: str = "rerank-english-v3.0"):
+        import cohere
+
+        self.client = cohere.Client(api_key)
+        self.model = model
+
+    def score(self, query: str, docs) -> list:
+        response = self.client.rerank(
+            model=self.model, query=query, documents=[d.page_content for d in docs], top_n=len(docs)
+        )
+        scores = [0.0] * len(docs)
+        for result in response.results:
+            scores[result.index] = result.relevance_score
+        return scores
+
+
+class ScoreCache:
+    """LRU of reranker scores per (reranker, query, chunk)."""
+
+    def __init__(self, max_entries=RAG_RERANK_CACHE_SIZE):
+        self.max_entries = max_entries
+        self._scores = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get_many(self, keys):
+        with self._lock:
+            found = {}
+            for key in keys:
+                if key in self._scores:
+                    self._scores.move_to_end(key)
+                    found[key] = self._scores[key]
+            return found
+
+    def put_many(self, items):
+        with self._lock:
+            for key, score in items:
+                self._scores[key] = score
+                self._scores.move_to_end(key)
+            while len(self._scores) > self.max_entries:
+                self._scores.popitem(last=False)
+
+
+score_cache = ScoreCache()
+_executor = ThreadPoolExecutor(max_workers=4, thread_name_prefix="rerank")
+
+
+class RerankingRetriever(BaseRetriever):
+    """Over-fetches from a base retriever and keeps the reranker's top_n.
+
+    Scoring runs as one batch per request. Cached scores are reused, and when
+    scoring does not finish within budget_ms the base retriever's order is
+    returned unchanged.
+    """
+
+    base_retriever: Any
+    reranker: Any
+    top_n: int = 4
+    budget_ms: float = RAG_RERANK_BUDGET_MS
+
+    def _keys(self, query, docs):
+        normalized = " ".join(tokenize(query))
+        return [(self.reranker.name, normalized, document_key(d)) for d in docs]
+
+    def _score_all(self, query, docs, keys):
+        cached = score_cache.get_many(keys)
+        missing = [i for i, key in enumerate(keys) if key not in cached]
+        metrics.cache_lookup("rerank_scores", "hit", len(cached))
+        metrics.cache_lookup("rerank_scores", "miss", len(missing))
+        if missing:
+            with metrics.stage("rerank_score", reranker=self.reranker.name):
+                fresh = self.reranker.score(query, [docs[i] for i in missing])
+            new = [(keys[i], s) for i, s in zip(missing, fresh)]
+            score_cache.put_many(new)
+            cached.update(new)
+        return [cached[key] for key in keys]
+
+    def _order(self, docs, scores):
+        prior = self.reranker.rank_prior
+        final = [score + prior / math.log2(rank + 2) for rank, score in enumerate(scores)]
+        ranked = sorted(range(len(docs)), key=lambda i: final[i], reverse=True)
+        return [docs[i] for i in ranked[:self.top_n]]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun):
+        return self._rerank(query, self.base_retriever.invoke(query))
+
+    def search_batch(self, queries, vectors):
+        results = self.base_retriever.search_batch(queries, vectors)
+        return [self._rerank(query, docs) for query, docs in zip(queries, results)]
+
+    def _rerank(self, query, docs):
+        if len(docs) <= 1:
+            return docs
+        keys = self._keys(query, docs)
+        with metrics.stage("rerank", reranker=self.reranker.name):
+            future = _executor.submit(self._score_all, query, docs, keys)
+            try:
+                scores = future.result(timeout=self.budget_ms / 1000)
+            except FutureTimeoutError:
+                metrics.event("rerank_over_budget", reranker=self.reranker.name)
+                return docs[:self.top_n]
+            return self._order(docs, scores)
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager):
+        docs = await self.base_retriever.ainvoke(query)
+        if len(docs) <= 1:
+            return docs
+        keys = self._keys(query, docs)
+        with metrics.stage("rerank", reranker=self.reranker.name):
+            try:
+                scores = await asyncio.wait_for(
+                    asyncio.get_running_loop().run_in_executor(_executor, self._score_all, query, docs, keys),
+                    timeout=self.budget_ms / 1000,
+                )
+            except asyncio.TimeoutError:
+                metrics.event("rerank_over_budget", reranker=self.reranker.name)
+                return docs[:self.top_n]
+            return self._order(docs, scores)
@@ -0,0 +1,147 @@
+import os
+import shutil
+import threading
+import time
+from pathlib import Path
+
+from . import metrics
+from .numpy_store import MemmapVectorStore
+
+try:
+    import fcntl
+except ImportError:  # Windows: single publisher only
+    fcntl = None
+
+
+# ==============================
+# ========== CONFIG ==========
+# ==============================
+# Versioned read-only copies of the memory-mapped store, one directory each
+# (v00000001, ...), plus a CURRENT file naming the live version
+RAG_SNAPSHOT_DIR = os.getenv("RAG_SNAPSHOT_DIR", "index_snapshots")
+# How often serving workers look for a newer version
+RAG_SNAPSHOT_POLL_SECONDS = float(os.getenv("RAG_SNAPSHOT_POLL_SECONDS", "2"))
+# Old versions kept on disk. A worker still serving a removed one keeps its
+# open maps, so in-flight searches finish on it
+RAG_SNAPSHOT_KEEP = int(os.getenv("RAG_SNAPSHOT_KEEP", "3"))
+# A version is removed only this long after its successor was published, so
+# every worker has polled and swapped away from it first
+RAG_SNAPSHOT_GRACE_SECONDS = float(os.getenv("RAG_SNAPSHOT_GRACE_SECONDS", str(5 * RAG_SNAPSHOT_POLL_SECONDS)))
+
+
+# ==============================
+# ===== Publishing (indexer) =====
+# ==============================
+# A snapshot directory is complete before CURRENT names it, and CURRENT is
+# replaced with os.replace, so a reader sees either the old version or the
+# new one, never a partial write.
+
+def _version_dir(root, version):
+    return Path(root) / f"v{version:08d}"
+
+
+def current_version(root=RAG_SNAPSHOT_DIR):
+    try:
+        return int((Path(root) / "CURRENT").read_text().strip())
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def publish_snapshot(store, root=RAG_SNAPSHOT_DIR, keep=RAG_SNAPSHOT_KEEP, grace_seconds=RAG_SNAPSHOT_GRACE_SECONDS):
+    """Export ``store`` as the next snapshot version and make it current. Returns the version.
+
+    Versions beyond the newest ``keep`` are removed once their successor is
+    ``grace_seconds`` old.
+    """
+    root = Path(root)
+    root.mkdir(parents=True, exist_ok=True)
+    with open(root / "publish.lock", "a") as lock:
+        if fcntl is not None:
+            # One publisher at a time, so versions are never reused
+            fcntl.flock(lock, fcntl.LOCK_EX)
+        existing = [int(p.name[1:]) for p in root.glob("v*") if p.name[1:].isdigit()]
+        version = max(existing, default=0) + 1
+        with metrics.stage("snapshot_publish"):
+            store.export(_version_dir(root, version))
+            pointer = root / f"CURRENT.{os.getpid()}"
+            pointer.write_text(f"{version}\n")
+            os.replace(pointer, root / "CURRENT")
+        versions = sorted(existing) + [version]
+        now = time.time()
+        for old, successor in zip(versions[:max(0, len(versions) - keep)], versions[1:]):
+            try:
+                superseded_for = now - _version_dir(root, successor).stat().st_mtime
+            except FileNotFoundError:
+                superseded_for = grace_seconds
+            if superseded_for >= grace_seconds:
+                shutil.rmtree(_version_dir(root, old), ignore_errors=True)
+    metrics.event("snapshot_published")
+    print(f"Published index snapshot v{version} ({store.count()} chunks).")
+    return version
+
+
+# ==============================
+# ===== Serving (workers) =====
+# ==============================
+class SnapshotManager:
+    """The current read-only snapshot, swapped for newer versions as they are published.
+
+    Every worker process maps the same snapshot files read-only, so the
+    vectors sit once in the page cache however many workers there are.
+    ``current()`` is what a search uses; a search that started on the old
+    version finishes on it, and the old maps are released once no retriever
+    holds them. Call ``start()`` to check for new versions in the background,
+    or ``refresh()`` to check now.
+    """
+
+    def __init__(self, root=RAG_SNAPSHOT_DIR, on_swap=None, poll_seconds=RAG_SNAPSHOT_POLL_SECONDS):
+        self.root = Path(root)
+        self.on_swap = on_swap
+        self.poll_seconds = poll_seconds
+        self.version = None
+        self._store = None
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self.refresh()
+
+    def current(self):
+        # None until a first snapshot is published
+        return self._store
+
+    def refresh(self):
+        """Open the current version if it is newer; True when a swap happened."""
+        with self._lock:
+            version = current_version(self.root)
+            if version is None or version == self.version:
+                return False
+            store = MemmapVectorStore(_version_dir(self.root, version), read_only=True)
+            if store.dim:
+                # Map the files before the first request needs them
+                store.search([[0.0] * store.dim], k=1)
+            self._store, self.version = store, version
+        metrics.event("snapshot_swap")
+        print(f"Serving index snapshot v{version}.")
+        if self.on_swap is not None:
+            self.on_swap(self)
+        return True
+
+    def _watch(self):
+        while not self._stop.wait(self.poll_seconds):
+            try:
+                self.refresh()
+            except Exception as e:
+                # Keep serving the version we have
+                print(f"[Snapshots] could not open v{current_version(self.root)}: {e}")
+
+    def start(self):
+        if self._thread is None or not self._thread.is_alive():
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._watch, name="snapshot-watcher", daemon=True)
+            self._thread.start()
+        return self
+
+    def stop(self, timeout=None):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
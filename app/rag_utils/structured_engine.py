@@ -0,0 +1,289 @@
+import hashlib
+import os
+import re
+import threading
+import time
+from pathlib import Path
+
+from . import index_state
+
+
+# ==============================
+# ========== CONFIG ==========
+# ==============================
+STRUCTURED_DATA_DIR = os.getenv("RAG_STRUCTURED_DATA_DIR", "structured_data")
+RESULT_ROW_LIMIT = int(os.getenv("RAG_SQL_ROW_LIMIT", "200"))
+
+# Columns only these roles may query, whatever table they appear in
+SENSITIVE_COLUMNS = {
+    "salary", "date_of_birth", "email", "leave_balance", "leaves_taken",
+    "attendance_pct", "performance_rating", "last_review_date", "manager_id",
+}
+SENSITIVE_COLUMN_ROLES = {"c-level", "hr"}
+# Roles that see every row; other department roles only see rows whose
+# `department` column matches their role (when the table has one)
+ALL_ROWS_ROLES = {"c-level", "hr"}
+
+FORBIDDEN_SQL = re.compile(
+    r"\b(insert|update|delete|drop|create|alter|attach|detach|copy|pragma|install|load|set|"
+    r"reset|export|import|call|checkpoint|vacuum|grant|revoke|truncate)\b",
+    re.IGNORECASE,
+)
+
+
+class StructuredQueryError(Exception):
+    """The question could not be answered from the registered tables."""
+
+
+# ==============================
+# ===== Table registry =====
+# ==============================
+# One row per uploaded file. Table names carry a hash of the path, so two
+# roles uploading files with the same name never share (or overwrite) a table.
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS structured_tables (
+        filepath TEXT PRIMARY KEY,
+        table_name TEXT NOT NULL UNIQUE,
+        parquet_path TEXT NOT NULL,
+        role TEXT NOT NULL,
+        content_hash TEXT NOT NULL,
+        registered_at REAL NOT NULL
+    )
+"""
+
+
+def ensure_schema(conn):
+    columns = conn.execute("PRAGMA table_info(structured_tables)").fetchall()
+    if columns and not any(name == "filepath" and pk for _, name, _, _, _, pk in columns):
+        # Registries written before tables were keyed by path: rename each
+        # table after its file, keeping the Parquet copy it already has
+        rows = conn.execute(
+            "SELECT filepath, parquet_path, role, content_hash, registered_at FROM structured_tables"
+        ).fetchall()
+        conn.execute("DROP TABLE structured_tables")
+        conn.execute(SCHEMA)
+        conn.executemany(
+            "INSERT OR REPLACE INTO structured_tables VALUES (?, ?, ?, ?, ?, ?)",
+            [(filepath, table_name_for(filepath), *rest) for filepath, *rest in rows],
+        )
+        conn.commit()
+        invalidate_role_databases()
+    else:
+        conn.execute(SCHEMA)
+
+
+def table_name_for(filepath) -> str:
+    name = re.sub(r"[^a-z0-9_]", "_", Path(filepath).stem.lower())
+    name = name if name[:1].isalpha() else f"t_{name}"
+    return f"{name}_{hashlib.sha1(str(filepath).encode()).hexdigest()[:8]}"
+
+
+def register_csv_table(conn, filepath, role):
+    """Convert a CSV upload to Parquet and register it for the SQL route.
+
+    Re-registering an unchanged file is a no-op. Returns the table name.
+    """
+    import duckdb
+
+    ensure_schema(conn)
+    table = table_name_for(filepath)
+    digest = index_state.file_hash(filepath)
+    row = conn.execute(
+        "SELECT content_hash, role FROM structured_tables WHERE filepath = ?", (str(filepath),)
+    ).fetchone()
+    if row == (digest, role.lower()):
+        return table
+
+    Path(STRUCTURED_DATA_DIR).mkdir(parents=True, exist_ok=True)
+    parquet_path = str(Path(STRUCTURED_DATA_DIR) / f"{table}.parquet")
+    tmp_path = parquet_path + ".tmp"
+    with duckdb.connect() as db:
+        db.execute(
+            f"COPY (SELECT * FROM read_csv_auto(?)) TO '{tmp_path}' (FORMAT PARQUET)", [str(filepath)]
+        )
+    os.replace(tmp_path, parquet_path)
+    conn.execute(
+        "INSERT OR REPLACE INTO structured_tables VALUES (?, ?, ?, ?, ?, ?)",
+        (str(filepath), table, parquet_path, role.lower(), digest, time.time()),
+    )
+    invalidate_role_databases()
+    return table
+
+
+def visible_tables(conn, user_role):
+    ensure_schema(conn)
+    user_role = user_role.lower()
+    rows = conn.execute("SELECT table_name, parquet_path, role FROM structured_tables").fetchall()
+    return [
+        (name, path) for name, path, role in rows
+        if user_role == "c-level" or role in (user_role, "general")
+    ]
+
+
+# ==============================
+# ===== Per-role databases =====
+# ==============================
+# Each role gets an in-memory DuckDB holding only the tables, columns and rows
+# it may see. External file access is disabled and the configuration locked
+# before any generated SQL runs against it.
+_role_databases = {}
+_role_lock = threading.Lock()
+
+
+def invalidate_role_databases():
+    with _role_lock:
+        for db in _role_databases.values():
+            db["connection"].close()
+        _role_databases.clear()
+
+
+def _build_role_database(user_role):
+    import duckdb
+
+    conn = index_state.connect()
+    try:
+        tables = visible_tables(conn, user_role)
+    finally:
+        conn.close()
+
+    db = duckdb.connect()
+    schema = {}
+    for name, parquet_path in tables:
+        columns = db.execute("DESCRIBE SELECT * FROM read_parquet(?)", [parquet_path]).fetchall()
+        allowed = [
+            (col, col_type) for col, col_type, *_ in columns
+            if user_role in SENSITIVE_COLUMN_ROLES or col.lower() not in SENSITIVE_COLUMNS
+        ]
+        if not allowed:
+            continue
+        where = ""
+        params = [parquet_path]
+        if user_role not in ALL_ROWS_ROLES and any(col.lower() == "department" for col, *_ in columns):
+            where = " WHERE lower(department) = ?"
+            params.append(user_role)
+        select_list = ", ".join(f'"{col}"' for col, _ in allowed)
+        db.execute(f'CREATE TABLE "{name}" AS SELECT {select_list} FROM read_parquet(?){where}', params)
+        schema[name] = allowed
+    db.execute("SET enable_external_access = false")
+    db.execute("SET lock_configuration = true")
+    return {"connection": db, "schema": schema}
+
+
+def get_role_database(user_role):
+    user_role = user_role.lower()
+    with _role_lock:
+        db = _role_databases.get(user_role)
+        if db is None:
+            db = _build_role_database(user_role)
+            _role_databases[user_role] = db
+    return db
+
+
+def has_tables(user_role) -> bool:
+    return bool(get_role_database(user_role)["schema"])
+
+
+# ==============================
+# ===== Question -> SQL =====
+# ==============================
+SQL_PROMPT = """You translate questions into a single DuckDB SQL query.
+
+Tables (only these exist; use only the listed columns):
+{schema}
+
+Rules:
+- Return exactly one SELECT statement (CTEs allowed) and nothing else, no explanation.
+- Only read from the tables above. Do not modify data or call file functions.
+- Use ILIKE for case-insensitive text matches.
+- If the question cannot be answered from these tables, return NONE.
+
+Question: {question}
+SQL:"""
+
+
+def describe_schema(schema) -> str:
+    return "\n".join(
+        f"- {name}({', '.join(f'{col} {col_type}' for col, col_type in columns)})"
+        for name, columns in schema.items()
+    )
+
+
+def extract_sql(text: str) -> str:
+    text = text.strip()
+    fenced = re.search(r"```(?:sql)?\s*(.*?)```", text, re.DOTALL | re.IGNORECASE)
+    if fenced:
+        text = fenced.group(1).strip()
+    return text.rstrip(";").strip()
+
+
+def validate_sql(sql: str, db) -> str:
+    if not sql or sql.upper() == "NONE":
+        raise StructuredQueryError("No SQL could be generated for this question.")
+    # Keywords inside string literals (e.g. ILIKE '%call center%') are fine
+    code = re.sub(r"'(?:[^']|'')*'", "''", sql)
+    if ";" in code:
+        raise StructuredQueryError("Only a single statement is allowed.")
+    if not re.match(r"^\s*(select|with)\b", code, re.IGNORECASE):
+        raise StructuredQueryError("Only SELECT queries are allowed.")
+    if FORBIDDEN_SQL.search(code):
+        raise StructuredQueryError("The generated query uses a forbidden statement.")
+    referenced = {t.lower() for t in db["connection"].get_table_names(sql)}
+    cte_names = {n.lower() for n in re.findall(r"(\w+)\s+as\s*\(", sql, re.IGNORECASE)}
+    unknown = referenced - cte_names - {t.lower() for t in db["schema"]}
+    if unknown:
+        raise StructuredQueryError(f"The generated query uses unknown tables: {', '.join(sorted(unknown))}")
+    return sql
+
+
+def run_sql(sql: str, db):
+    cursor = db["connection"].cursor()
+    try:
+        return cursor.execute(f"SELECT * FROM ({sql}) AS result LIMIT {RESULT_ROW_LIMIT}").fetchdf()
+    finally:
+        cursor.close()
+
+
+def format_result(sql: str, df, tables) -> str:
+    if df.empty:
+        table = "_No rows matched._"
+    else:
+        table = df.to_markdown(index=False, floatfmt=".2f")
+    sources = ", ".join(sorted(tables))
+    return f"### Result\n\n{table}\n\n**Query**\n```sql\n{sql}\n```\n\n**Source:** {sources}"
+
+
+def _prepare(question: str, user_role: str):
+    db = get_role_database(user_role)
+    if not db["schema"]:
+        raise StructuredQueryError("No tables are available for this role.")
+    prompt = SQL_PROMPT.format(schema=describe_schema(db["schema"]), question=question)
+    return db, prompt
+
+
+def _finish(raw: str, db) -> dict:
+    import duckdb
+
+    try:
+        sql = validate_sql(extract_sql(raw), db)
+        df = run_sql(sql, db)
+        tables = {t for t in db["connection"].get_table_names(sql) if t in db["schema"]}
+    except duckdb.Error as e:
+        raise StructuredQueryError(f"The generated query failed: {e}") from e
+    return {"answer": format_result(sql, df, tables), "sql": sql, "rows": len(df)}
+
+
+def ask_sql(question: str, user_role: str) -> dict:
+    from .rag_module import get_model
+
+    db, prompt = _prepare(question, user_role)
+    return _finish(get_model().invoke(prompt).content, db)
+
+
+async def aask_sql(question: str, user_role: str) -> dict:
+    import asyncio
+
+    from .rag_module import get_model
+
+    db, prompt = await asyncio.to_thread(_prepare, question, user_role)
+    raw = (await get_model().ainvoke(prompt)).content
+    return await asyncio.to_thread(_finish, raw, db)
@@ -0,0 +1,330 @@
+import os
+import re
+import sqlite3
+import threading
+import time
+from pathlib import Path
+
+from langchain_core.documents import Document
+
+from . import index_state, metrics
+
+
+# ==============================
+# ========== CONFIG ==========
+# ==============================
+# Precompute section and document summaries at index time and answer
+# "summarize X" questions from them
+RAG_SUMMARIES = os.getenv("RAG_SUMMARIES", "true").lower() == "true"
+# Map and reduce steps run on a smaller model than the answers
+RAG_SUMMARY_MODEL = os.getenv("RAG_SUMMARY_MODEL", "gpt-4o-mini")
+# Summarization calls in flight across the documents summarized together
+RAG_SUMMARY_WORKERS = int(os.getenv("RAG_SUMMARY_WORKERS", "8"))
+# Documents loaded and summarized together; bounds memory and lets the
+# ingestion worker yield to chat traffic between groups
+RAG_SUMMARY_GROUP_DOCS = int(os.getenv("RAG_SUMMARY_GROUP_DOCS", "8"))
+# Consecutive chunks are grouped into sections of at most this many characters
+RAG_SUMMARY_SECTION_CHARS = int(os.getenv("RAG_SUMMARY_SECTION_CHARS", "4000"))
+# Section summaries combined per reduce call; longer documents reduce in rounds
+RAG_SUMMARY_REDUCE_CHARS = int(os.getenv("RAG_SUMMARY_REDUCE_CHARS", "12000"))
+# Plain "summarize <document>" questions get the stored summary with no
+# generation; anything more specific is answered from the summaries
+RAG_SUMMARY_DIRECT = os.getenv("RAG_SUMMARY_DIRECT", "true").lower() == "true"
+
+# CSV uploads are answered by the SQL route, not summarized
+SUMMARY_EXTENSIONS = {".md"}
+
+MAP_PROMPT = (
+    "Summarize this section of the internal document \"{title}\" ({section}).\n"
+    "Keep every figure, date, name and target it states. Use short bullet points.\n\n{text}"
+)
+REDUCE_PROMPT = (
+    "Below are summaries of consecutive sections of the internal document \"{title}\".\n"
+    "Write one summary of the whole document: a two-sentence overview, then the key\n"
+    "points as bullets. Keep the figures, dates and targets.\n\n{text}"
+)
+
+
+# ==============================
+# ===== Index time: map-reduce =====
+# ==============================
+def split_sections(chunks, max_chars=RAG_SUMMARY_SECTION_CHARS):
+    """Group consecutive chunks into sections of at most ``max_chars``.
+
+    Chunks from the markdown splitter carry their heading path; a section is
+    named after the second-level headings it covers.
+    """
+    sections = []
+    for chunk in chunks:
+        path = [p for p in chunk.metadata.get("section", "").split(" > ") if p]
+        heading = path[1] if len(path) > 1 else (path[0] if path else "")
+        current = sections[-1] if sections else None
+        if current is None or len(current["text"]) + len(chunk.page_content) + 2 > max_chars:
+            current = {"headings": [], "text": ""}
+            sections.append(current)
+        current["text"] = f"{current['text']}\n\n{chunk.page_content}" if current["text"] else chunk.page_content
+        if heading and heading not in current["headings"]:
+            current["headings"].append(heading)
+    for position, section in enumerate(sections):
+        section["title"] = ", ".join(section["headings"]) or f"part {position + 1}"
+    return sections
+
+
+def document_title(chunks, filepath):
+    for chunk in chunks:
+        section = chunk.metadata.get("section")
+        if section:
+            return section.split(" > ")[0]
+    return Path(filepath).stem.replace("_", " ")
+
+
+def _summarize(model, prompt, inputs):
+    # One batch call for every document in the group, so sections of small
+    # and large documents share the same pool of in-flight requests
+    from langchain_core.output_parsers import StrOutputParser
+    from langchain_core.prompts import ChatPromptTemplate
+
+    chain = ChatPromptTemplate.from_messages([("human", prompt)]) | model | StrOutputParser()
+    return chain.batch(inputs, config={"max_concurrency": RAG_SUMMARY_WORKERS}, return_exceptions=True)
+
+
+def summarize_documents(conn, docs, model, load_chunks):
+    """Build and store section and document summaries for ``(filepath, role, content_hash)`` rows.
+
+    All sections of all documents are summarized in one parallel map step.
+    Their summaries are then reduced per document, again in parallel, in as
+    many rounds as RAG_SUMMARY_REDUCE_CHARS requires. A document whose map
+    or reduce call fails keeps its previous summaries and is retried on the
+    next indexing pass. Returns the number of documents summarized.
+    """
+    jobs = []
+    for filepath, role, digest in docs:
+        try:
+            chunks = list(load_chunks(filepath, role))
+        except Exception as e:
+            print(f"Summarizing {filepath} failed: {e}")
+            continue
+        if chunks:
+            jobs.append({"filepath": filepath, "role": role, "digest": digest,
+                         "title": document_title(chunks, filepath), "sections": split_sections(chunks)})
+    if not jobs:
+        return 0
+
+    with metrics.stage("summarize_map", documents=len(jobs)):
+        inputs = [{"title": job["title"], "section": section["title"], "text": section["text"]}
+                  for job in jobs for section in job["sections"]]
+        results = iter(_summarize(model, MAP_PROMPT, inputs))
+        for job in jobs:
+            for section in job["sections"]:
+                section["summary"] = next(results)
+            errors = [s["summary"] for s in job["sections"] if isinstance(s["summary"], Exception)]
+            job["error"] = errors[0] if errors else None
+
+    with metrics.stage("summarize_reduce", documents=len(jobs)):
+        for job in jobs:
+            job["parts"] = [] if job["error"] else [s["summary"] for s in job["sections"]]
+        while True:
+            # Documents with more than one part left reduce another round
+            rounds = [(job, group) for job in jobs if len(job["parts"]) > 1 for group in _groups(job["parts"])]
+            if not rounds:
+                break
+            results = _summarize(model, REDUCE_PROMPT,
+                                 [{"title": job["title"], "text": "\n\n---\n\n".join(group)} for job, group in rounds])
+            for job in jobs:
+                if len(job["parts"]) > 1:
+                    job["parts"] = []
+            for (job, _), result in zip(rounds, results):
+                if isinstance(result, Exception):
+                    job["error"] = job["error"] or result
+                elif not job["error"]:
+                    job["parts"].append(result)
+            for job in jobs:
+                if job["error"]:
+                    job["parts"] = []
+
+    stored = 0
+    for job in jobs:
+        if job["error"] or not job["parts"]:
+            print(f"Summarizing {job['filepath']} failed: {job['error']}")
+            continue
+        store_summaries(conn, job)
+        conn.commit()
+        stored += 1
+    return stored
+
+
+def _groups(parts, max_chars=RAG_SUMMARY_REDUCE_CHARS):
+    groups, size = [[]], 0
+    for part in parts:
+        if groups[-1] and size + len(part) > max_chars:
+            groups.append([])
+            size = 0
+        groups[-1].append(part)
+        size += len(part)
+    if len(groups) == len(parts) > 1:
+        # Every part is over the limit on its own: pair them so each round shrinks
+        groups = [parts[i:i + 2] for i in range(0, len(parts), 2)]
+    return groups
+
+
+def store_summaries(conn, job):
+    created = time.time()
+    conn.execute("DELETE FROM document_summaries WHERE filepath = ?", (str(job["filepath"]),))
+    rows = [(str(job["filepath"]), job["role"].lower(), job["digest"], "document", 0, job["title"],
+             job["parts"][0], created)]
+    rows += [(str(job["filepath"]), job["role"].lower(), job["digest"], "section", position, section["title"],
+              section["summary"], created) for position, section in enumerate(job["sections"])]
+    conn.executemany(
+        "INSERT INTO document_summaries (filepath, role, content_hash, level, position, title, summary, created_at)"
+        " VALUES (?, ?, ?, ?, ?, ?, ?, ?)",
+        rows,
+    )
+
+
+def refresh_summaries(conn, get_model, load_chunks, before_batch=None, group_size=RAG_SUMMARY_GROUP_DOCS):
+    """Summarize indexed documents whose current version has no summary yet.
+
+    Documents are summarized ``group_size`` at a time, and ``before_batch``
+    (the indexer's throttle) is called before each group. Summaries of
+    files no longer indexed are dropped. Cheap when nothing changed, so it
+    can run after every indexing pass.
+    """
+    conn.execute("DELETE FROM document_summaries WHERE filepath NOT IN (SELECT filepath FROM indexed_files)")
+    conn.commit()
+    stale = [
+        row for row in conn.execute(
+            "SELECT f.filepath, f.role, f.content_hash FROM indexed_files f"
+            " LEFT JOIN document_summaries s ON s.filepath = f.filepath AND s.level = 'document'"
+            " WHERE s.filepath IS NULL OR s.content_hash != f.content_hash OR s.role != f.role"
+        )
+        if Path(row[0]).suffix.lower() in SUMMARY_EXTENSIONS
+    ]
+    if not stale:
+        return 0
+    model = get_model()
+    summarized = 0
+    for start in range(0, len(stale), max(1, group_size)):
+        if before_batch is not None:
+            before_batch()
+        summarized += summarize_documents(conn, stale[start:start + group_size], model, load_chunks)
+    print(f"Summarized {summarized} of {len(stale)} documents.")
+    return summarized
+
+
+# ==============================
+# ===== Query time =====
+# ==============================
+SUMMARY_REQUEST = re.compile(
+    r"\b(summar(y|ies|ize|ise|izing|ising)|overview|tl;?dr|gist|recap|key (points|takeaways))\b", re.I
+)
+# Words that ask for a summary without saying what should be in it
+REQUEST_WORDS = {
+    "summary", "summaries", "summarize", "summarise", "summarizing", "summarising", "overview", "tldr",
+    "tl", "dr", "gist", "recap", "key", "points", "takeaways", "give", "me", "provide", "show", "please",
+    "can", "you", "could", "brief", "short", "quick", "document", "doc", "file", "report", "of", "the",
+    "a", "an", "for", "on", "about", "in", "to", "and", "what", "is", "s",
+}
+QUARTERS = {"first quarter": "q1", "second quarter": "q2", "third quarter": "q3", "fourth quarter": "q4"}
+
+
+def is_summary_question(question: str) -> bool:
+    return bool(SUMMARY_REQUEST.search(question))
+
+
+def _tokens(text):
+    text = text.lower()
+    for words, quarter in QUARTERS.items():
+        text = text.replace(words, quarter)
+    return set(re.findall(r"[a-z0-9]+", text))
+
+
+class SummaryIndex:
+    """Stored document summaries, matched to questions by document name.
+
+    Reloaded from the documents database whenever an indexing pass (in this
+    or another process) has changed the summaries.
+    """
+
+    def __init__(self, db_path=index_state.DB_PATH):
+        self.db_path = db_path
+        self._conn = None
+        self._signature = None
+        self._documents = []
+        self._lock = threading.Lock()
+
+    def _load(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        signature = self._conn.execute("SELECT COUNT(*), MAX(created_at) FROM document_summaries").fetchone()
+        if signature == self._signature:
+            return
+        documents = {}
+        rows = self._conn.execute(
+            "SELECT filepath, role, level, title, summary FROM document_summaries ORDER BY filepath, level, position")
+        for filepath, role, level, title, summary in rows:
+            doc = documents.setdefault(filepath, {"filepath": filepath, "role": role, "sections": []})
+            if level == "document":
+                stem = Path(filepath).stem.replace("_", " ")
+                doc.update(title=title, summary=summary, name=_tokens(stem) - REQUEST_WORDS,
+                           words=_tokens(f"{stem} {title}"))
+            else:
+                doc["sections"].append((title, summary))
+        self._documents = [d for d in documents.values() if "summary" in d]
+        self._signature = signature
+
+    def match(self, question, roles=None):
+        """The visible document the question names, or None when no single document stands out."""
+        with self._lock:
+            try:
+                self._load()
+            except sqlite3.OperationalError:
+                # No summaries table yet
+                return None
+            documents = self._documents
+        asked = _tokens(question)
+        scored = []
+        for doc in documents:
+            if roles is not None and doc["role"] not in roles:
+                continue
+            # Share of the file name's distinctive words the question mentions
+            named = len(asked & doc["name"])
+            if doc["name"] and named:
+                scored.append((named / len(doc["name"]), len(asked & doc["words"]), doc))
+        scored.sort(key=lambda s: (s[0], s[1]), reverse=True)
+        if not scored or scored[0][0] < 0.5 or (len(scored) > 1 and scored[1][:2] == scored[0][:2]):
+            return None
+        return scored[0][2]
+
+
+summary_index = SummaryIndex()
+
+
+def summary_context(doc):
+    source = Path(doc["filepath"]).name
+    context = [Document(page_content=doc["summary"],
+                        metadata={"source": source, "role": doc["role"], "section": "Document summary"})]
+    context += [Document(page_content=summary, metadata={"source": source, "role": doc["role"], "section": title})
+                for title, summary in doc["sections"]]
+    return context
+
+
+def find_summary(question, roles=None):
+    """Answer a summary question from the stored summaries.
+
+    Returns ``(answer, context)``: a finished answer when the question just
+    asks for the summary of a document, otherwise ``(None, context)`` with
+    the document and section summaries to generate from. None when the
+    question is not a summary question or names no single visible document.
+    """
+    if not RAG_SUMMARIES or not is_summary_question(question):
+        return None
+    doc = summary_index.match(question, roles)
+    if doc is None:
+        return None
+    leftover = _tokens(question) - doc["words"] - REQUEST_WORDS
+    if RAG_SUMMARY_DIRECT and not leftover:
+        metrics.event("summary_route", kind="direct")
+        answer = f"## {doc['title']}\n\n{doc['summary']}\n\n**Source:** {Path(doc['filepath']).name}"
+        return answer, None
+    metrics.event("summary_route", kind="generated")
+    return None, summary_context(doc)
@@ -0,0 +1,162 @@
+import asyncio
+import os
+import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, List, Optional
+
+from langchain_core.callbacks import CallbackManagerForRetrieverRun
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from . import metrics
+
+
+# ==============================
+# ========== CONFIG ==========
+# ==============================
+# Store each role's chunks in its own Chroma collection instead of filtering
+# one shared collection by `role` metadata
+RAG_PARTITIONED_COLLECTIONS = os.getenv("RAG_PARTITIONED_COLLECTIONS", "false").lower() == "true"
+SHARD_SEPARATOR = "__"
+
+_executor = ThreadPoolExecutor(max_workers=8, thread_name_prefix="shard-search")
+
+
+def shard_name(base_name: str, role: str) -> str:
+    # Chroma names allow [a-zA-Z0-9._-] and must end alphanumerically
+    safe = re.sub(r"[^a-z0-9._-]", "-", role.lower()).strip("-._") or "default"
+    return f"{base_name}{SHARD_SEPARATOR}{safe}"
+
+
+class ShardSet:
+    """One Chroma collection per role, created on first use."""
+
+    def __init__(self, client, embeddings, base_name: str):
+        self.client = client
+        self.embeddings = embeddings
+        self.base_name = base_name
+        self._stores = {}
+        self._lock = threading.Lock()
+
+    def store(self, role: str):
+        from langchain_community.vectorstores import Chroma
+
+        role = role.lower()
+        with self._lock:
+            vectorstore = self._stores.get(role)
+            if vectorstore is None:
+                vectorstore = Chroma(
+                    collection_name=shard_name(self.base_name, role),
+                    embedding_function=self.embeddings,
+                    client=self.client,
+                )
+                self._stores[role] = vectorstore
+        return vectorstore
+
+    def roles(self):
+        prefix = f"{self.base_name}{SHARD_SEPARATOR}"
+        names = [getattr(c, "name", c) for c in self.client.list_collections()]
+        return sorted(n[len(prefix):] for n in names if n.startswith(prefix))
+
+    def stores_for(self, roles=None):
+        # roles=None means every existing shard (C-level)
+        return [self.store(r) for r in (self.roles() if roles is None else roles)]
+
+    def collection_for(self, document):
+        return self.store(document.metadata.get("role", "general"))._collection
+
+    def delete(self, ids):
+        # A chunk's shard is not tracked separately; deleting unknown ids is a no-op
+        for vectorstore in self.stores_for():
+            vectorstore._collection.delete(ids=list(ids))
+
+    def count(self) -> int:
+        return sum(v._collection.count() for v in self.stores_for())
+
+    def collections(self):
+        return [v._collection for v in self.stores_for()]
+
+    def partition_existing(self, collection, page=500):
+        """Copy chunks (with their embeddings) from a shared collection into role shards."""
+        offset, copied = 0, 0
+        while True:
+            rows = collection.get(include=["embeddings", "documents", "metadatas"], limit=page, offset=offset)
+            by_role = {}
+            for i, chunk_id in enumerate(rows["ids"]):
+                role = (rows["metadatas"][i] or {}).get("role", "general")
+                by_role.setdefault(role, []).append(i)
+            for role, idx in by_role.items():
+                self.store(role)._collection.upsert(
+                    ids=[rows["ids"][i] for i in idx],
+                    embeddings=[rows["embeddings"][i] for i in idx],
+                    documents=[rows["documents"][i] for i in idx],
+                    metadatas=[rows["metadatas"][i] for i in idx],
+                )
+            copied += len(rows["ids"])
+            if len(rows["ids"]) < page:
+                return copied
+            offset += page
+
+
+class ShardedRetriever(BaseRetriever):
+    """Embeds the query once and searches every visible shard concurrently.
+
+    Per-shard top-k lists are merged by distance into one top-k. With a
+    single shard and a ``filter`` it is the plain role-filtered search over
+    the shared collection. Query embedding and search are timed as separate
+    stages either way.
+    """
+
+    shards: List[Any]
+    embeddings: Any
+    k: int = 4
+    filter: Optional[dict] = None
+
+    def _search_shard(self, vectorstore, embedding):
+        return vectorstore.similarity_search_by_vector_with_relevance_scores(
+            embedding, k=self.k, filter=self.filter)
+
+    def _query_shard(self, vectorstore, vectors):
+        # One Chroma round trip for every query vector
+        result = vectorstore._collection.query(
+            query_embeddings=vectors, n_results=self.k, where=self.filter,
+            include=["documents", "metadatas", "distances"],
+        )
+        return [
+            [(Document(id=chunk_id, page_content=text, metadata=metadata or {}), distance)
+             for chunk_id, text, metadata, distance in zip(ids, texts, metadatas, distances)]
+            for ids, texts, metadatas, distances in zip(
+                result["ids"], result["documents"], result["metadatas"], result["distances"])
+        ]
+
+    def search_batch(self, queries, vectors):
+        """Top-k documents for many already embedded queries, in query order."""
+        with metrics.stage("vector_search", shards=len(self.shards)):
+            futures = [_executor.submit(self._query_shard, v, vectors) for v in self.shards]
+            per_shard = [f.result() for f in futures]
+        return [self._merge([shard[i] for shard in per_shard]) for i in range(len(vectors))]
+
+    def _merge(self, results):
+        merged = [pair for shard_results in results for pair in shard_results]
+        merged.sort(key=lambda pair: pair[1])  # Chroma returns distances: lower is closer
+        return [doc for doc, _ in merged[:self.k]]
+
+    def _get_relevant_documents(self, query: str, *, run_manager: CallbackManagerForRetrieverRun):
+        with metrics.stage("embed_query", purpose="retrieval"):
+            embedding = self.embeddings.embed_query(query)
+        with metrics.stage("vector_search", shards=len(self.shards)):
+            if len(self.shards) == 1:
+                return self._merge([self._search_shard(self.shards[0], embedding)])
+            futures = [_executor.submit(self._search_shard, v, embedding) for v in self.shards]
+            return self._merge([f.result() for f in futures])
+
+    async def _aget_relevant_documents(self, query: str, *, run_manager):
+        with metrics.stage("embed_query", purpose="retrieval"):
+            embedding = await self.embeddings.aembed_query(query)
+        loop = asyncio.get_running_loop()
+        with metrics.stage("vector_search", shards=len(self.shards)):
+            results = await asyncio.gather(*[
+                loop.run_in_executor(_executor, self._search_shard, v, embedding) for v in self.shards
+            ])
+        return self._merge(results)
@@ -0,0 +1,33 @@
+import sys
+from pathlib import Path
+
+import pytest
+
+# rag_utils and benchmarks are imported from the app directory, as the
+# server and the benchmarks do
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
+
+
+@pytest.fixture
+def workdir(tmp_path, monkeypatch):
+    # roles_docs.db, structured_data/ and the stores use relative paths
+    monkeypatch.chdir(tmp_path)
+    return tmp_path
+
+
+@pytest.fixture
+def indexer(workdir, monkeypatch):
+    # rag_module with the offline fakes; its components are dropped after the test
+    from chromadb.api.client import SharedSystemClient
+
+    from benchmarks.fakes import FakeChatModel, FakeEmbeddings
+    from rag_utils import rag_module
+
+    # Chroma caches clients by path, and "chroma_db" is relative to each workdir
+    SharedSystemClient.clear_system_cache()
+    monkeypatch.setattr(rag_module, "_components", {})
+    monkeypatch.setattr(rag_module, "_chain_registry", {})
+    rag_module.override_components(environment=True, embeddings=FakeEmbeddings(), model=FakeChatModel(),
+                                   summary_model=FakeChatModel())
+    yield rag_module
+    SharedSystemClient.clear_system_cache()
@@ -0,0 +1,64 @@
+import numpy as np
+import pytest
+
+from benchmarks.fakes import FakeEmbeddings
+from rag_utils.answer_cache import AnswerCache
+
+embeddings = FakeEmbeddings()
+
+
+def test_answers_are_scoped_to_the_role():
+    cache = AnswerCache(semantic_threshold=0)
+    cache.put("finance", "What was Q3 revenue?", "finance answer")
+    assert cache.get("Finance", "what was q3 revenue") == "finance answer"
+    assert cache.get("marketing", "What was Q3 revenue?") is None
+    assert cache.get("c-level", "What was Q3 revenue?") is None
+
+
+def test_semantic_match_stays_within_the_role():
+    cache = AnswerCache(semantic_threshold=0.8)
+    cache.put("finance", "What was the Q3 revenue?", "finance answer",
+              embedding=embeddings.embed_query("What was the Q3 revenue?"))
+    similar = embeddings.embed_query("What was the Q3 revenue figure?")
+    assert cache.get("finance", "What was the Q3 revenue figure?", embedding=similar) == "finance answer"
+    assert cache.get("hr", "What was the Q3 revenue figure?", embedding=similar) is None
+
+
+def test_a_role_is_required():
+    cache = AnswerCache()
+    with pytest.raises(ValueError):
+        cache.put("", "question", "answer")
+    with pytest.raises(ValueError):
+        cache.get(None, "question")
+
+
+def test_indexing_invalidates_the_roles_that_can_see_the_documents():
+    cache = AnswerCache(semantic_threshold=0)
+    for role in ("finance", "hr", "c-level"):
+        cache.put(role, "question", f"{role} answer")
+    cache.invalidate_for_document_roles(["finance"])
+    assert cache.get("finance", "question") is None
+    assert cache.get("c-level", "question") is None
+    assert cache.get("hr", "question") == "hr answer"
+
+    cache.invalidate_for_document_roles(["general"])
+    assert cache.get("hr", "question") is None
+
+
+@pytest.mark.parametrize("cached, asked", [
+    ("What is the salary of FINEMP1006?", "What is the salary of FINEMP1007?"),
+    ("What was the Q3 revenue?", "What was the Q4 revenue?"),
+    ("Marketing spend in 2023", "Marketing spend in 2024"),
+])
+def test_semantic_match_requires_the_same_ids_and_numbers(cached, asked):
+    cache = AnswerCache(semantic_threshold=0.5)
+    cache.put("finance", cached, "cached answer", embedding=embeddings.embed_query(cached))
+    vector = embeddings.embed_query(asked)
+    assert float(np.dot(vector, embeddings.embed_query(cached))) > 0.5
+    assert cache.get("finance", asked, embedding=vector) is None
+    # The same IDs in other words still match
+    assert cache.get("finance", f"{cached} please", embedding=embeddings.embed_query(f"{cached} please")) == "cached answer"
+
+
+def test_semantic_match_is_off_by_default():
+    assert not AnswerCache().semantic_enabled
@@ -0,0 +1,43 @@
+from langchain_core.documents import Document
+
+from rag_utils.context_packing import BASELINE_K, pack_context
+
+
+def doc(text, source="a.md", **metadata):
+    return Document(page_content=text, metadata={"source": source, **metadata})
+
+
+def paragraph(seed, words=60):
+    return " ".join(f"{seed}{i}" for i in range(words))
+
+
+def test_duplicates_are_dropped():
+    text = paragraph("alpha")
+    packed, stats = pack_context([doc(text), doc(text.upper()), doc(paragraph("beta"), "b.md")], budget=10_000)
+    assert stats["duplicates"] == 1
+    assert [d.metadata["source"] for d in packed] == ["a.md", "b.md"]
+
+
+def test_splitter_overlap_is_trimmed():
+    first = paragraph("alpha")
+    overlap = first[-100:]
+    second = overlap + " " + paragraph("beta")
+    packed, stats = pack_context([doc(first), doc(second)], budget=10_000)
+    assert stats["trimmed_chars"] >= 100
+    assert not packed[1].page_content.split("\n", 1)[1].startswith(overlap)
+
+
+def test_never_packs_more_than_the_old_top_k():
+    # Short top chunks: a generous budget must not pull in the long tail
+    docs = [doc(f"short chunk {i}", f"{i}.md") for i in range(BASELINE_K)]
+    docs += [doc(paragraph(f"tail{i}", 200), f"tail{i}.md") for i in range(4)]
+    packed, stats = pack_context(docs, budget=10_000)
+    assert stats["tokens_out"] <= stats["tokens_baseline"]
+    assert all(not d.metadata["source"].startswith("tail") for d in packed)
+
+
+def test_budget_limits_adaptive_k_but_keeps_the_best_chunk():
+    docs = [doc(paragraph(f"w{i}", 100), f"{i}.md") for i in range(6)]
+    packed, stats = pack_context(docs, budget=1)
+    assert len(packed) == 1 and packed[0].metadata["source"] == "0.md"
+    assert stats["over_budget"] == 5
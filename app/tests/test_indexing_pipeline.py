@@ -0,0 +1,96 @@
+import sqlite3
+import threading
+import time
+
+import pytest
+from langchain_core.documents import Document
+
+from benchmarks.rag_benchmark import register_documents
+from rag_utils.indexing_pipeline import EmbeddingPipeline
+
+
+class RecordingCollection:
+    def __init__(self):
+        self.upserts = []
+
+    def upsert(self, ids, embeddings, metadatas, documents):
+        self.upserts.append(list(ids))
+
+
+class SlowFirstEmbeddings:
+    """The first batch finishes last; the text "fail" makes a batch raise."""
+
+    def __init__(self):
+        self.calls = 0
+        self._lock = threading.Lock()
+
+    def embed_documents(self, texts):
+        with self._lock:
+            self.calls += 1
+            first = self.calls == 1
+        if first:
+            time.sleep(0.05)
+        if "fail" in texts:
+            raise RuntimeError("embedding failed")
+        return [[float(len(t))] for t in texts]
+
+
+class Store:
+    def __init__(self):
+        self._collection = RecordingCollection()
+
+
+def chunk(i):
+    return f"c{i}", Document(page_content=f"chunk {i}")
+
+
+def test_batches_are_written_in_order_and_callbacks_follow_their_batch():
+    store, written, done = Store(), [], []
+    with EmbeddingPipeline(store, SlowFirstEmbeddings(), on_batch_written=lambda b: written.append(len(b)),
+                           batch_size=2, workers=4, max_in_flight=2) as pipeline:
+        for i in range(3):
+            pipeline.add(*chunk(i))
+        pipeline.after_pending(lambda: done.append(list(store._collection.upserts)))
+        for i in range(3, 7):
+            pipeline.add(*chunk(i))
+            assert len(pipeline._in_flight) <= 2
+    assert store._collection.upserts == [["c0", "c1"], ["c2", "c3"], ["c4", "c5"], ["c6"]]
+    assert written == [2, 2, 2, 1]
+    # The callback ran once c2's batch was written, not after the whole run
+    assert done == [[["c0", "c1"], ["c2", "c3"]]]
+    assert pipeline.written == 7
+
+
+def test_a_failed_batch_is_reported_and_skipped():
+    store, failed = Store(), []
+    texts = ["a", "b", "fail", "c", "d"]
+    with EmbeddingPipeline(store, SlowFirstEmbeddings(), batch_size=2,
+                           on_batch_failed=lambda batch, e: failed.append([i for i, _, _ in batch])) as pipeline:
+        for i, text in enumerate(texts):
+            pipeline.add(f"c{i}", Document(page_content=text))
+    assert failed == [["c2", "c3"]]
+    assert store._collection.upserts == [["c0", "c1"], ["c4"]]
+
+
+def test_without_a_failure_handler_the_run_stops():
+    store, done = Store(), []
+    with pytest.raises(RuntimeError):
+        with EmbeddingPipeline(store, SlowFirstEmbeddings(), batch_size=1) as pipeline:
+            pipeline.add("c0", Document(page_content="fail"))
+            pipeline.after_pending(lambda: done.append(True))
+            pipeline.add("c1", Document(page_content="fine"))
+    assert done == []
+
+
+def test_a_file_with_several_pending_rows_is_indexed_once(indexer, workdir):
+    (workdir / "marketing").mkdir()
+    report = workdir / "marketing" / "q2.md"
+    report.write_text("# Q2\n\nCampaign spend rose.\n\n## Channels\n\nSearch led conversions.\n", encoding="utf-8")
+    register_documents("roles_docs.db", [(str(report), "marketing"), (str(report), "marketing")])
+    indexer.run_indexer()
+
+    conn = sqlite3.connect("roles_docs.db")
+    rows = conn.execute("SELECT status, embedded, chunks FROM documents ORDER BY id").fetchall()
+    conn.close()
+    assert rows[0] == rows[1] and rows[0][0] == "done" and rows[0][1] == 1
+    assert indexer.vector_count() == rows[0][2]
@@ -0,0 +1,61 @@
+from benchmarks.rag_benchmark import register_documents
+from rag_utils import index_state
+from rag_utils.ingestion import IngestionWorker
+
+
+def test_a_pending_row_is_claimed_once(workdir):
+    register_documents("roles_docs.db", [("a.md", "general"), ("b.md", "finance")])
+    first, second = index_state.connect(), index_state.connect()
+    try:
+        # Both select the same pending rows before either writes
+        selected = second.execute("SELECT id, filepath, role FROM documents WHERE status = 'pending'").fetchall()
+        assert len(IngestionWorker()._claim(first)) == 2
+        assert index_state.claim_documents(second, selected) == []
+        statuses = {job["status"] for job in (index_state.document_job(second, i) for i, _, _ in selected)}
+        assert statuses == {"loading"}
+    finally:
+        first.close()
+        second.close()
+
+
+def test_only_jobs_with_an_expired_lease_are_released(workdir):
+    register_documents("roles_docs.db", [("a.md", "general"), ("b.md", "finance")])
+    conn = index_state.connect()
+    try:
+        assert len(IngestionWorker()._claim(conn)) == 2
+        # b.md's indexer stopped renewing its lease long ago
+        conn.execute("UPDATE documents SET updated_at = 0 WHERE filepath = 'b.md'")
+        conn.commit()
+        # A second worker starting up leaves a.md to the indexer holding it
+        assert [row[1] for row in IngestionWorker()._claim(conn)] == ["b.md"]
+        assert index_state.document_job(conn, 1)["status"] == "loading"
+    finally:
+        conn.close()
+
+
+def write_corpus(root):
+    (root / "finance").mkdir()
+    report = root / "finance" / "report.md"
+    report.write_text("# Q3 report\n\nRevenue grew 12 percent.\n\n## Costs\n\nCosts fell 3 percent.\n",
+                      encoding="utf-8")
+    ledger = root / "finance" / "ledger.csv"
+    ledger.write_text("id,amount\n1,100\n2,250\n", encoding="utf-8")
+    return [(str(report), "finance"), (str(ledger), "finance")]
+
+
+def test_adding_documents_of_an_indexed_file_does_not_duplicate_them(indexer, workdir):
+    files = write_corpus(workdir)
+    register_documents("roles_docs.db", files)
+    indexer.run_indexer()
+    chunks = indexer.vector_count()
+    assert chunks
+
+    for filepath, role in files:
+        indexer.embed_documents_to_vectorstore(indexer.load_file(filepath, role))
+    assert indexer.vector_count() == chunks
+    conn = index_state.connect()
+    try:
+        recorded = conn.execute("SELECT DISTINCT filepath FROM indexed_chunks").fetchall()
+        assert sorted(row[0] for row in recorded) == sorted(filepath for filepath, _ in files)
+    finally:
+        conn.close()
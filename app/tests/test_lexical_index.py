@@ -0,0 +1,49 @@
+from langchain_core.documents import Document
+
+from rag_utils.lexical_index import LexicalIndex, reciprocal_rank_fusion
+
+
+def doc(text, role, chunk_id):
+    return Document(page_content=text, metadata={"role": role, "chunk_id": chunk_id})
+
+
+def build_index():
+    index = LexicalIndex()
+    index.add_many([
+        ("f1", doc("FINEMP1006 leave balance is 12 days", "hr", "f1")),
+        ("f2", doc("Q3 revenue grew 12 percent", "finance", "f2")),
+        ("f3", doc("The leave policy allows 24 days a year", "general", "f3")),
+    ])
+    return index
+
+
+def test_search_only_touches_the_given_roles():
+    index = build_index()
+    assert [d.metadata["chunk_id"] for d, _ in index.search("leave days", ["general"])] == ["f3"]
+    assert {d.metadata["chunk_id"] for d, _ in index.search("leave days")} == {"f1", "f3"}
+    assert index.search("leave days", ["marketing"]) == []
+
+
+def test_ids_match_exactly():
+    index = build_index()
+    hits = index.search("What is the leave balance of FINEMP1006?", ["hr", "general"])
+    assert hits[0][0].metadata["chunk_id"] == "f1"
+
+
+def test_re_adding_and_removing_chunks():
+    index = build_index()
+    index.add("f2", doc("Q3 costs fell", "finance", "f2"))
+    assert len(index) == 3
+    assert index.search("revenue", ["finance"]) == []
+    index.remove(["f2", "missing"])
+    assert len(index) == 2
+    assert index.search("costs", ["finance"]) == []
+
+
+def test_reciprocal_rank_fusion_rewards_agreement():
+    a, b, c = (doc(t, "general", t) for t in "abc")
+    vector = [a, b, c]
+    lexical = [b, c]
+    # Chunks both retrievers found outrank the vector search's lone top hit
+    assert [d.page_content for d in reciprocal_rank_fusion([vector, lexical], k=2)] == ["b", "c"]
+    assert reciprocal_rank_fusion([vector, []], k=2) == [a, b]
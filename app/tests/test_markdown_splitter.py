@@ -0,0 +1,56 @@
+from langchain_core.documents import Document
+
+from rag_utils.markdown_splitter import split_markdown
+
+REPORT = """# Q2 - April to June 2024
+
+## Revenue
+
+{revenue}
+
+## Cash Flow Analysis
+
+| Month | Inflow | Outflow |
+|-------|--------|---------|
+{rows}
+
+```
+net = inflow - outflow
+```
+"""
+
+
+def split(text, **kwargs):
+    return split_markdown(Document(page_content=text, metadata={"source": "q2.md", "role": "finance"}), **kwargs)
+
+
+def test_chunks_carry_their_heading_path():
+    text = REPORT.format(revenue="Revenue grew steadily. " * 20, rows="| April | 10 | 8 |")
+    chunks = split(text, max_chars=600, min_chars=0)
+    sections = [c.metadata["section"] for c in chunks]
+    assert "Q2 - April to June 2024 > Revenue" in sections
+    assert "Q2 - April to June 2024 > Cash Flow Analysis" in sections
+    assert all(c.metadata["source"] == "q2.md" and c.metadata["role"] == "finance" for c in chunks)
+
+
+def test_oversized_tables_split_by_rows_with_the_header():
+    rows = "\n".join(f"| Month {i} | {i * 10} | {i * 5} |" for i in range(60))
+    chunks = split(REPORT.format(revenue="Flat.", rows=rows), max_chars=400, min_chars=0)
+    table_chunks = [c.page_content for c in chunks if "| Month " in c.page_content]
+    assert len(table_chunks) > 1
+    for text in table_chunks:
+        assert "| Month | Inflow | Outflow |" in text
+        assert all(len(line.split("|")) == 5 for line in text.splitlines() if line.startswith("|"))
+    assert all(len(c.page_content) <= 400 for c in chunks)
+
+
+def test_code_blocks_are_kept_whole():
+    chunks = split(REPORT.format(revenue="Flat.", rows="| April | 10 | 8 |"), max_chars=600, min_chars=0)
+    assert any("```\nnet = inflow - outflow\n```" in c.page_content for c in chunks)
+
+
+def test_short_sibling_sections_are_merged():
+    text = "# Policy\n\n## Leave\n\nShort.\n\n## Travel\n\nAlso short.\n"
+    chunks = split(text, max_chars=1500, min_chars=300)
+    assert len(chunks) == 1
+    assert chunks[0].metadata["section"] == "Policy"
@@ -0,0 +1,96 @@
+import numpy as np
+import pytest
+
+from benchmarks.fakes import FakeEmbeddings
+from rag_utils.numpy_store import MemmapVectorStore
+from rag_utils.rag_module import visible_roles
+
+CHUNKS = {
+    "finance-1": ("finance", "quarterly revenue grew twelve percent"),
+    "hr-1": ("hr", "quarterly revenue of the hr team budget"),
+    "general-1": ("general", "office holidays and quarterly revenue calendar"),
+    "marketing-1": ("marketing", "campaign quarterly revenue attribution"),
+}
+
+
+@pytest.fixture(params=["float32", "int8"])
+def store(workdir, request):
+    embeddings = FakeEmbeddings()
+    store = MemmapVectorStore(workdir / "vector_store", dtype=request.param)
+    ids = list(CHUNKS)
+    store.upsert(ids, embeddings.embed_documents([CHUNKS[i][1] for i in ids]),
+                 [{"role": CHUNKS[i][0]} for i in ids], [CHUNKS[i][1] for i in ids])
+    store.query = np.asarray(embeddings.embed_query("quarterly revenue"))
+    return store
+
+
+def search_ids(store, user_role, k=10):
+    hits = store.search(store.query, visible_roles(user_role), k=k)[0]
+    return {doc.id for doc in store.documents([row for row, _ in hits]).values()}
+
+
+def test_roles_only_see_their_own_and_general_chunks(store):
+    assert search_ids(store, "finance") == {"finance-1", "general-1"}
+    assert search_ids(store, "general") == {"general-1"}
+    assert search_ids(store, "c-level") == set(CHUNKS)
+
+
+def test_unknown_role_sees_only_general_chunks(store):
+    assert search_ids(store, "engineering") == {"general-1"}
+
+
+def test_deleted_and_replaced_chunks_drop_out_of_the_mask(store):
+    store.delete(["general-1"])
+    assert search_ids(store, "finance") == {"finance-1"}
+    # Re-upserting under another role moves the chunk out of finance's view
+    vector = store.get(ids=["finance-1"], include=("embeddings",))["embeddings"]
+    store.upsert(["finance-1"], vector, [{"role": "hr"}], ["moved"])
+    assert search_ids(store, "finance") == set()
+    assert search_ids(store, "hr") == {"hr-1", "finance-1"}
+
+
+def test_compaction_keeps_the_role_masks(store):
+    store.delete(["marketing-1"])
+    store.compact()
+    assert store.dead_rows() == 0
+    assert search_ids(store, "finance") == {"finance-1", "general-1"}
+    assert search_ids(store, "c-level") == {"finance-1", "hr-1", "general-1"}
+
+
+def test_an_id_repeated_in_one_upsert_keeps_its_last_entry(store):
+    vector = store.get(ids=["finance-1"], include=("embeddings",))["embeddings"][0]
+    store.upsert(["finance-1", "finance-1"], [vector, vector], [{"role": "finance"}, {"role": "hr"}],
+                 ["first", "second"])
+    assert store.get(ids=["finance-1"])["documents"] == ["second"]
+    assert search_ids(store, "finance") == {"general-1"}
+    assert store.dead_rows() == 1
+
+
+def test_compact_if_needed_waits_for_the_ratio(store):
+    store.delete(["marketing-1"])
+    assert store.compact_if_needed(ratio=0.5) == 0
+    assert store.compact_if_needed(ratio=0.2) == 1
+    assert store.dead_rows() == 0
+
+
+def test_rows_found_before_a_compaction_are_not_resolved_after_it(store):
+    reader = MemmapVectorStore(store.directory)  # another worker process on the same files
+    generation, hits = reader._search(store.query, ["finance"], 10)
+    store.delete(["finance-1", "general-1"])
+    store.compact()
+    # The old rows now point at other chunks; the lookup refuses them
+    assert reader.documents([row for row, _ in hits[0]], generation) is None
+    assert reader.search_documents(store.query, ["finance"], 10) == [[]]
+    docs = reader.search_documents(store.query, ["hr"], 10)[0]
+    assert [doc.id for doc in docs] == ["hr-1"]
+    assert reader.get(ids=["hr-1"], include=("embeddings",))["embeddings"]
+
+
+def test_compaction_switches_to_a_new_generation_of_files(store):
+    store.delete(["marketing-1"])
+    store.compact()
+    assert store.generation == 1
+    assert sorted(p.name for p in store.directory.glob("roles*")) == ["roles.1.u64"]
+    reopened = MemmapVectorStore(store.directory)
+    reopened.query = store.query
+    assert search_ids(reopened, "c-level") == {"finance-1", "hr-1", "general-1"}
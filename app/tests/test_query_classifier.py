@@ -0,0 +1,51 @@
+import pytest
+
+from rag_utils import query_classifier
+from rag_utils.query_classifier import LABELLED_EXAMPLES, classify_query_local, measure_routing_agreement
+
+# Held out from LABELLED_EXAMPLES: the router has to get these from its rules.
+HELD_OUT = [
+    ("How many employees are in the finance department?", "SQL"),
+    ("Top 5 employees by salary", "SQL"),
+    ("Total salary paid per department", "SQL"),
+    ("Count employees who joined after 2020", "SQL"),
+    ("What is the date of birth of employee FINEMP1003?", "SQL"),
+    ("List employees in Mumbai with salary above 100000", "SQL"),
+    ("How many vacation days do new hires get?", "RAG"),
+    ("What were the top marketing channels last year?", "RAG"),
+    ("What does the expense policy say about travel?", "RAG"),
+    ("Who leads the engineering team?", "RAG"),
+]
+
+
+def test_held_out_questions_are_not_training_examples():
+    examples = {question for question, _ in LABELLED_EXAMPLES}
+    assert not examples & {question for question, _ in HELD_OUT}
+
+
+@pytest.mark.parametrize("question,label", HELD_OUT)
+def test_local_router_labels(question, label):
+    assert classify_query_local(question)[0] == label
+
+
+@pytest.mark.parametrize("question", [
+    "How many leaves can I take per year?",
+    "List the top 3 marketing campaigns in Q4",
+    "Who is the CEO?",
+    "What are the top risks in the quarterly report?",
+])
+def test_counting_words_alone_do_not_route_to_sql(question, monkeypatch):
+    monkeypatch.setattr(query_classifier, "ROUTER_LLM_FALLBACK", False)
+    assert query_classifier.detect_query_type(question) == "RAG"
+
+
+def test_measure_routing_agreement():
+    questions = [question for question, _ in HELD_OUT]
+    labels = [label for _, label in HELD_OUT]
+    labels[0] = "RAG"
+    report = measure_routing_agreement(questions, llm_labels=labels)
+    assert report["total"] == len(HELD_OUT)
+    assert report["agreement"] == pytest.approx(0.9)
+    assert report["confusion"]["llm=RAG,local=SQL"] == 1
+    assert [d["question"] for d in report["disagreements"]] == [questions[0]]
+    assert 0.0 <= report["fallback_rate"] <= 1.0
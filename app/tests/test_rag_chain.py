@@ -0,0 +1,72 @@
+import asyncio
+
+import pytest
+from langchain_core.documents import Document
+
+from benchmarks.fakes import FakeEmbeddings
+from rag_utils import rag_chain
+from rag_utils.answer_cache import answer_cache
+
+
+class FakeRetriever:
+    def search_batch(self, queries, vectors):
+        return [[Document(page_content=f"context for {q}", metadata={"source": "doc.md"})] for q in queries]
+
+
+class FakeChain:
+    def __init__(self, hang_on=None):
+        self.hang_on = hang_on
+        self.running = 0
+        self.peak = 0
+        self.in_flight = []
+
+    async def ainvoke(self, inputs):
+        self.running += 1
+        self.peak = max(self.peak, self.running)
+        self.in_flight.append(rag_chain.questions_in_flight())
+        try:
+            if inputs["input"] == self.hang_on:
+                await asyncio.sleep(60)
+            await asyncio.sleep(0.01)
+            return f"answer to {inputs['input']}"
+        finally:
+            self.running -= 1
+
+
+@pytest.fixture
+def chain(monkeypatch):
+    chain = FakeChain(hang_on="question 3")
+    monkeypatch.setattr(rag_chain, "get_embeddings", lambda: FakeEmbeddings())
+    monkeypatch.setattr(rag_chain, "get_retriever", lambda **kwargs: FakeRetriever())
+    monkeypatch.setattr(rag_chain, "get_question_answering_chain", lambda: chain)
+    monkeypatch.setattr(rag_chain, "find_summary", lambda question, roles: None)
+    monkeypatch.setattr(rag_chain, "RAG_GENERATION_TIMEOUT", 0.5)
+    monkeypatch.setattr(rag_chain, "_rag_semaphore", asyncio.Semaphore(2))
+    answer_cache.clear()
+    yield chain
+    answer_cache.clear()
+
+
+def test_batch_generation_respects_the_worker_limit_and_timeouts(chain):
+    questions = [f"question {i}" for i in range(8)]
+    results = asyncio.run(rag_chain.ask_rag_batch(questions, "finance", max_concurrency=8))
+    assert chain.peak == 2
+    assert min(chain.in_flight) >= 1
+    assert "timed out" in results[3]["error"]
+    assert [r["answer"] for i, r in enumerate(results) if i != 3] == [
+        f"answer to question {i}" for i in range(8) if i != 3]
+    assert rag_chain.questions_in_flight() == 0
+
+
+def test_batch_takes_the_summary_route_like_ask_rag(chain, monkeypatch):
+    def find_summary(question, roles):
+        if "summarize" in question:
+            return "stored summary", None
+        return None
+
+    monkeypatch.setattr(rag_chain, "find_summary", find_summary)
+    questions = ["summarize the report", "question 1", "Question 1?"]
+    results = asyncio.run(rag_chain.ask_rag_batch(questions, "finance"))
+    assert results == [{"answer": "stored summary"}, {"answer": "answer to question 1"},
+                       {"answer": "answer to question 1"}]
+    assert asyncio.run(rag_chain.ask_rag("summarize the report", "finance")) == {"answer": "stored summary"}
@@ -0,0 +1,66 @@
+import asyncio
+import time
+from typing import Any
+
+from langchain_core.documents import Document
+from langchain_core.retrievers import BaseRetriever
+
+from rag_utils import metrics, reranker
+from rag_utils.reranker import LexicalReranker, Reranker, RerankingRetriever
+
+
+class FixedRetriever(BaseRetriever):
+    docs: Any
+
+    def _get_relevant_documents(self, query, *, run_manager):
+        return list(self.docs)
+
+
+class SlowReranker(Reranker):
+    name = "slow"
+
+    def score(self, query, docs):
+        time.sleep(0.2)
+        return [float(i) for i in range(len(docs))]
+
+
+DOCS = [
+    Document(page_content="Company holidays and the leave calendar", metadata={"source": "calendar.md"}),
+    Document(page_content="Travel expenses are reimbursed within 30 days", metadata={"source": "travel.md"}),
+    Document(page_content="Quarterly revenue grew 12 percent in Q3", metadata={"source": "q3.md"}),
+]
+
+
+def retriever(scorer, budget_ms):
+    return RerankingRetriever(base_retriever=FixedRetriever(docs=DOCS), reranker=scorer,
+                              top_n=2, budget_ms=budget_ms)
+
+
+def record_events(monkeypatch):
+    events = []
+    monkeypatch.setattr(metrics, "event", lambda name, **labels: events.append(name))
+    return events
+
+
+def test_reranks_within_budget(monkeypatch):
+    events = record_events(monkeypatch)
+    docs = retriever(LexicalReranker(), budget_ms=5_000).invoke("Q3 revenue growth")
+    assert docs[0].metadata["source"] == "q3.md"
+    assert len(docs) == 2
+    assert "rerank_over_budget" not in events
+
+
+def test_over_budget_keeps_retriever_order(monkeypatch):
+    monkeypatch.setattr(reranker, "score_cache", reranker.ScoreCache())
+    events = record_events(monkeypatch)
+    docs = retriever(SlowReranker(), budget_ms=10).invoke("anything")
+    assert docs == DOCS[:2]
+    assert events == ["rerank_over_budget"]
+
+
+def test_async_over_budget_keeps_retriever_order(monkeypatch):
+    monkeypatch.setattr(reranker, "score_cache", reranker.ScoreCache())
+    events = record_events(monkeypatch)
+    docs = asyncio.run(retriever(SlowReranker(), budget_ms=10).ainvoke("something else"))
+    assert docs == DOCS[:2]
+    assert events == ["rerank_over_budget"]
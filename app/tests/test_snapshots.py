@@ -0,0 +1,38 @@
+from benchmarks.fakes import FakeEmbeddings
+from rag_utils.numpy_store import MemmapVectorStore
+from rag_utils.snapshots import SnapshotManager, _version_dir, publish_snapshot
+
+embeddings = FakeEmbeddings()
+
+
+def add(store, chunk_id, text, role="finance"):
+    store.upsert([chunk_id], embeddings.embed_documents([text]), [{"role": role}], [text])
+
+
+def test_a_pinned_version_keeps_serving_after_it_is_pruned(workdir):
+    live = MemmapVectorStore(workdir / "live")
+    add(live, "a", "quarterly revenue report")
+    publish_snapshot(live, workdir / "snapshots", keep=1, grace_seconds=0)
+    manager = SnapshotManager(workdir / "snapshots")
+    pinned = manager.current()
+    query = embeddings.embed_query("quarterly revenue")
+    assert pinned.search(query, ["finance"])[0]
+
+    add(live, "b", "holiday calendar", role="general")
+    publish_snapshot(live, workdir / "snapshots", keep=1, grace_seconds=0)
+    assert not _version_dir(workdir / "snapshots", 1).exists()
+    hits = pinned.search(query, ["finance"])[0]
+    assert [doc.id for doc in pinned.documents([row for row, _ in hits]).values()] == ["a"]
+
+    assert manager.refresh() and manager.version == 2
+    assert manager.current().count() == 2
+
+
+def test_versions_are_pruned_only_after_the_grace_period(workdir):
+    live = MemmapVectorStore(workdir / "live")
+    add(live, "a", "quarterly revenue report")
+    for _ in range(3):
+        publish_snapshot(live, workdir / "snapshots", keep=1, grace_seconds=60)
+    assert all(_version_dir(workdir / "snapshots", v).exists() for v in (1, 2, 3))
+    publish_snapshot(live, workdir / "snapshots", keep=1, grace_seconds=0)
+    assert [_version_dir(workdir / "snapshots", v).exists() for v in (1, 2, 3, 4)] == [False, False, False, True]
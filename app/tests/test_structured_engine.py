@@ -0,0 +1,98 @@
+import pytest
+
+from rag_utils import index_state, structured_engine
+from rag_utils.structured_engine import StructuredQueryError
+
+EMPLOYEES = """name,department,salary,email,city
+Asha,finance,100,asha@example.com,Pune
+Ben,marketing,90,ben@example.com,Delhi
+Cara,hr,80,cara@example.com,Mumbai
+"""
+
+
+@pytest.fixture
+def tables(workdir):
+    for role in ("hr", "finance"):
+        (workdir / role).mkdir()
+        (workdir / role / "employees.csv").write_text(EMPLOYEES)
+    (workdir / "general").mkdir()
+    (workdir / "general" / "holidays.csv").write_text("date,holiday\n2024-01-26,Republic Day\n")
+    conn = index_state.connect()
+    names = {
+        role: structured_engine.register_csv_table(conn, f"{role}/{file}", role)
+        for role, file in (("hr", "employees.csv"), ("finance", "employees.csv"), ("general", "holidays.csv"))
+    }
+    conn.commit()
+    conn.close()
+    structured_engine.invalidate_role_databases()
+    yield names
+    structured_engine.invalidate_role_databases()
+
+
+def test_same_file_name_in_two_roles_gets_two_tables(tables):
+    assert tables["hr"] != tables["finance"]
+
+
+def test_visible_tables_follow_roles(tables):
+    conn = index_state.connect()
+    try:
+        visible = {role: {name for name, _ in structured_engine.visible_tables(conn, role)}
+                   for role in ("finance", "general", "c-level")}
+    finally:
+        conn.close()
+    assert visible["finance"] == {tables["finance"], tables["general"]}
+    assert visible["general"] == {tables["general"]}
+    assert visible["c-level"] == set(tables.values())
+
+
+def test_department_roles_only_see_their_rows(tables):
+    db = structured_engine.get_role_database("finance")
+    rows = db["connection"].execute(f'SELECT name, department FROM "{tables["finance"]}"').fetchall()
+    assert rows == [("Asha", "finance")]
+
+    db = structured_engine.get_role_database("c-level")
+    count = db["connection"].execute(f'SELECT count(*) FROM "{tables["finance"]}"').fetchone()[0]
+    assert count == 3
+
+
+def test_sensitive_columns_are_dropped_for_other_roles(tables):
+    finance = {col for col, _ in structured_engine.get_role_database("finance")["schema"][tables["finance"]]}
+    assert finance == {"name", "department", "city"}
+    hr = {col for col, _ in structured_engine.get_role_database("hr")["schema"][tables["hr"]]}
+    assert {"salary", "email"} <= hr
+
+
+@pytest.mark.parametrize("sql", [
+    "",
+    "NONE",
+    "DELETE FROM t",
+    "SELECT 1; DROP TABLE t",
+    "WITH x AS (SELECT 1) INSERT INTO t SELECT * FROM x",
+    "SELECT * FROM read_csv_auto('/etc/passwd')",
+])
+def test_unsafe_queries_are_refused(tables, sql):
+    # File functions pass validation but fail on the locked-down connection
+    db = structured_engine.get_role_database("finance")
+    with pytest.raises(StructuredQueryError):
+        structured_engine._finish(sql, db)
+
+
+def test_validate_sql_rejects_tables_of_other_roles(tables):
+    db = structured_engine.get_role_database("finance")
+    with pytest.raises(StructuredQueryError, match="unknown tables"):
+        structured_engine.validate_sql(f'SELECT * FROM "{tables["hr"]}"', db)
+
+
+def test_validate_sql_accepts_a_select_with_keywords_in_literals(tables):
+    db = structured_engine.get_role_database("finance")
+    sql = structured_engine.extract_sql(
+        f"```sql\nWITH f AS (SELECT * FROM {tables['finance']}) SELECT name FROM f WHERE city ILIKE '%call%';\n```"
+    )
+    assert structured_engine.validate_sql(sql, db) == sql
+    assert structured_engine.run_sql(sql, db).empty
+
+
+def test_sensitive_columns_cannot_be_queried(tables):
+    db = structured_engine.get_role_database("finance")
+    with pytest.raises(StructuredQueryError, match="failed"):
+        structured_engine._finish(f"SELECT salary FROM {tables['finance']}", db)
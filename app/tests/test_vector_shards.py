@@ -0,0 +1,82 @@
+import chromadb
+import pytest
+from langchain_core.documents import Document
+
+from benchmarks.fakes import FakeEmbeddings
+from benchmarks.rag_benchmark import register_documents
+from rag_utils import vector_shards
+from rag_utils.vector_shards import ShardedRetriever, ShardSet
+
+TEXTS = {
+    "general": ["The leave policy allows 24 days a year", "Offices close on public holidays"],
+    "finance": ["Q3 revenue grew 12 percent", "Travel expenses are reimbursed monthly"],
+    "hr": ["FINEMP1006 has a leave balance of 12 days"],
+}
+
+
+@pytest.fixture
+def shards(workdir):
+    shard_set = ShardSet(chromadb.PersistentClient(path=str(workdir / "chroma")), FakeEmbeddings(), "docs")
+    for role, texts in TEXTS.items():
+        shard_set.store(role).add_documents(
+            [Document(page_content=t, metadata={"role": role}) for t in texts],
+            ids=[f"{role}-{i}" for i in range(len(texts))],
+        )
+    return shard_set
+
+
+def roles_of(docs):
+    return {d.metadata["role"] for d in docs}
+
+
+def test_each_role_has_its_own_collection(shards):
+    assert shards.roles() == ["finance", "general", "hr"]
+    assert shards.count() == 5
+    shards.delete(["hr-0", "missing"])
+    assert shards.count() == 4
+
+
+def test_search_covers_only_the_visible_shards(shards):
+    retriever = ShardedRetriever(shards=shards.stores_for(["finance", "general"]),
+                                 embeddings=shards.embeddings, k=10)
+    docs = retriever.invoke("leave balance")
+    assert len(docs) == 4
+    assert roles_of(docs) == {"finance", "general"}
+
+
+def test_fan_out_merges_by_distance(shards):
+    everything = ShardedRetriever(shards=shards.stores_for(), embeddings=shards.embeddings, k=3)
+    query = "Q3 revenue grew 12 percent"
+    assert everything.invoke(query)[0].page_content == query
+    vectors = [shards.embeddings.embed_query(query), shards.embeddings.embed_query("leave policy")]
+    batch = everything.search_batch([query, "leave policy"], vectors)
+    assert [d.page_content for d in batch[0]] == [d.page_content for d in everything.invoke(query)]
+    assert len(batch[1]) == 3
+
+
+def test_a_shared_collection_is_partitioned_by_role(shards, workdir):
+    shared = ShardSet(shards.client, shards.embeddings, "shared")
+    collection = shards.client.get_or_create_collection("shared")
+    store = shards.store("finance")._collection.get(include=["embeddings", "documents", "metadatas"])
+    collection.add(ids=store["ids"], embeddings=store["embeddings"], documents=store["documents"],
+                   metadatas=store["metadatas"])
+    assert shared.partition_existing(collection, page=1) == 2
+    assert shared.roles() == ["finance"]
+    assert shared.count() == 2
+
+
+def test_partitioned_index_keeps_roles_apart(indexer, workdir, monkeypatch):
+    monkeypatch.setattr(vector_shards, "RAG_PARTITIONED_COLLECTIONS", True)
+    files = []
+    for role, texts in TEXTS.items():
+        (workdir / role).mkdir()
+        path = workdir / role / f"{role}.md"
+        path.write_text("\n\n".join(f"# {t}\n\n{t}." for t in texts), encoding="utf-8")
+        files.append((str(path), role))
+    register_documents("roles_docs.db", files)
+    indexer.run_indexer()
+
+    assert indexer.get_shards().roles() == ["finance", "general", "hr"]
+    assert roles_of(indexer.get_retriever("finance").invoke("leave days")) <= {"finance", "general"}
+    assert roles_of(indexer.get_retriever("general").invoke("revenue")) == {"general"}
+    assert roles_of(indexer.get_retriever("c-level").invoke("leave balance")) >= {"hr"}
@@ -1,22 +1,39 @@
 # fin_solve_streamlit_ui.py
 import streamlit as st
-import requests
-from requests.auth import HTTPBasicAuth
 import base64
+import json
+import time
+
+from api_client import FinSolveClient
 
 API_URL = "http://localhost:8000"
 
 st.set_page_config(page_title="FinSolve Data Assistant", page_icon="🤖", layout="wide")
 
+
+# One pooled HTTP client per UI process, shared by every session
+@st.cache_resource
+def get_api_client():
+    return FinSolveClient(API_URL)
+
+
+api = get_api_client()
+
 # -------------------------
 # BACKGROUND IMAGES
 # -------------------------
-def set_bg_from_local(image_path):
+# Read and encoded once per process instead of on every rerun
+@st.cache_data
+def encode_image(image_path):
     try:
         with open(image_path, "rb") as image_file:
-            encoded = base64.b64encode(image_file.read()).decode()
+            return base64.b64encode(image_file.read()).decode()
     except Exception:
-        encoded = None
+        return None
+
+
+def set_bg_from_local(image_path):
+    encoded = encode_image(image_path)
 
     if encoded:
         css = f"""
@@ -185,14 +202,66 @@ if "role" not in st.session_state:
 if "page" not in st.session_state:
     st.session_state.page = "login"
 
-# Load roles into session state if not present
+# Role list, cached across reruns and sessions; cleared when a role is created
+@st.cache_data(ttl=300, show_spinner=False)
+def cached_roles(auth):
+    return api.roles(auth)
+
+
 def fetch_roles():
     try:
-        role_res = requests.get(f"{API_URL}/roles", auth=HTTPBasicAuth(*st.session_state.auth))
-        return role_res.json().get("roles", [])
+        return cached_roles(tuple(st.session_state.auth))
     except Exception:
         return []
 
+
+def invalidate_roles():
+    cached_roles.clear()
+
+# Follow a background ingestion job until it finishes (or we stop waiting)
+UPLOAD_POLL_SECONDS = 1.0
+UPLOAD_POLL_LIMIT = 120
+
+
+def poll_upload_job(job_id):
+    with st.status("Indexing document...", expanded=False) as status_box:
+        for _ in range(UPLOAD_POLL_LIMIT):
+            try:
+                job = api.upload_job(job_id, st.session_state.auth)
+            except Exception:
+                status_box.update(label="Could not fetch indexing status.", state="error")
+                return
+            state = job.get("status", "pending")
+            if state == "done":
+                status_box.update(label=f"Indexed {job.get('chunks', 0)} chunks.", state="complete")
+                return
+            if state == "failed":
+                status_box.update(label=f"Indexing failed: {job.get('error') or 'unknown error'}", state="error")
+                return
+            position = f" (queue position {job['queue_position']})" if job.get("queue_position") else ""
+            status_box.update(label=f"Indexing document: {state}{position}")
+            time.sleep(UPLOAD_POLL_SECONDS)
+        status_box.update(label="Still indexing in the background; check back later.", state="running")
+
+# Yield answer tokens from a text/event-stream response as they arrive
+def iter_sse_tokens(response, timings):
+    event = "message"
+    for line in response.iter_lines(decode_unicode=True):
+        if not line:
+            event = "message"
+            continue
+        if line.startswith("event:"):
+            event = line[len("event:"):].strip()
+        elif line.startswith("data:"):
+            payload = json.loads(line[len("data:"):].strip() or "{}")
+            if event == "error":
+                raise RuntimeError(payload.get("detail", "Streaming failed."))
+            if event == "done":
+                return
+            if "first_token" not in timings:
+                timings["first_token"] = time.perf_counter() - timings["start"]
+            yield payload.get("token", "")
+
 # -------------------------
 # LAYOUT - header + two columns
 # -------------------------
@@ -270,7 +339,7 @@ if st.session_state.page == "login":
         if st.button("Login", key="login_btn"):
             # attempt login
             try:
-                res = requests.get(f"{API_URL}/login", auth=HTTPBasicAuth(username, password))
+                res = api.login(username, password)
                 if res.status_code == 200:
                     st.session_state.auth = (username, password)
                     st.session_state.username = username
@@ -331,17 +400,19 @@ if st.session_state.page == "main":
                         st.warning("Please enter a question.")
                     else:
                         try:
-                            res = requests.post(
-                                f"{API_URL}/chat",
-                                json={"question": question, "role": st.session_state.role},
-                                auth=HTTPBasicAuth(*st.session_state.auth)
-                            )
+                            timings = {"start": time.perf_counter()}
+                            res = api.chat(question, st.session_state.role, st.session_state.auth)
                             if res.status_code == 200:
-                                answer = res.json().get("answer", "")
                                 st.markdown("<div class='answer'>", unsafe_allow_html=True)
                                 st.success("✅ Answer:")
-                                st.write(answer)
+                                if res.headers.get("content-type", "").startswith("text/event-stream"):
+                                    # Render tokens as they arrive instead of waiting for the full answer
+                                    st.write_stream(iter_sse_tokens(res, timings))
+                                else:
+                                    st.write(res.json().get("answer", ""))
                                 st.markdown("</div>", unsafe_allow_html=True)
+                                if "first_token" in timings:
+                                    st.caption(f"First token in {timings['first_token'] * 1000:.0f} ms")
                             else:
                                 st.error("❌ Something went wrong while processing your question.")
                         except Exception:
@@ -362,14 +433,12 @@ if st.session_state.page == "main":
                         st.warning("Please choose a file to upload.")
                     else:
                         try:
-                            res = requests.post(
-                                f"{API_URL}/upload-docs",
-                                files={"file": doc_file},
-                                data={"role": selected_role},
-                                auth=HTTPBasicAuth(*st.session_state.auth)
-                            )
+                            res = api.upload(doc_file, selected_role, st.session_state.auth)
                             if res.ok:
                                 st.success(res.json().get("message", "Uploaded successfully."))
+                                job_id = res.json().get("job_id")
+                                if job_id is not None:
+                                    poll_upload_job(job_id)
                             else:
                                 st.error(res.json().get("detail", "Something went wrong."))
                         except Exception:
@@ -387,11 +456,7 @@ if st.session_state.page == "main":
                         st.warning("Please fill username, password and role.")
                     else:
                         try:
-                            res = requests.post(
-                                f"{API_URL}/create-user",
-                                data={"username": new_user, "password": new_pass, "role": new_role},
-                                auth=HTTPBasicAuth(*st.session_state.auth)
-                            )
+                            res = api.create_user(new_user, new_pass, new_role, st.session_state.auth)
                             if res.ok:
                                 st.success(res.json().get("message", "User created."))
                             else:
@@ -407,13 +472,10 @@ if st.session_state.page == "main":
                         st.warning("Provide a role name.")
                     else:
                         try:
-                            res = requests.post(
-                                f"{API_URL}/create-role",
-                                data={"role_name": new_role_input},
-                                auth=HTTPBasicAuth(*st.session_state.auth)
-                            )
+                            res = api.create_role(new_role_input, st.session_state.auth)
                             if res.ok:
                                 st.success(res.json().get("message", "Role created."))
+                                invalidate_roles()
                                 st.session_state.roles = fetch_roles()  # Refresh role list
                                 st.rerun()  # Rerun so dropdowns get updated
                             else: